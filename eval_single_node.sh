@@ -11,7 +11,9 @@ model_base="${MODEL_BASE:-}"
 output_path=logs/$(TZ="America/New_York" date "+%Y%m%d")
 model_args="pretrained=${pretrained},\
 conv_template=qwen_1_5,\
-max_frames_num=32"
+max_frames_num=32,\
+shm_frame_cache_mb=${SHM_FRAME_CACHE_MB:-0},\
+prefix_cache_size=${PREFIX_CACHE_SIZE:-0}"
 
 if [ -n "$model_base" ]; then
     model_args="${model_args},model_base=${model_base}"
@@ -26,7 +28,9 @@ accelerate launch \
     --model $model_family \
     --model_args $model_args \
     --tasks $benchmark \
-    --batch_size 1 \
+    --batch_size ${BATCH_SIZE:-1} \
+    --video_affinity \
+    --sharding video \
     --log_samples \
     --log_samples_suffix $model \
     --output_path $output_path/$benchmark
\ No newline at end of file
@@ -139,6 +139,26 @@ def parse_eval_args() -> argparse.Namespace:
         default=None,
         help="Device to use (e.g. cuda, cuda:0, cpu)",
     )
+    parser.add_argument(
+        "--threads_per_rank",
+        type=int,
+        default=None,
+        metavar="N",
+        help="CPU threads each process splits between video decoding, torch and tokenizers. Default: the CPUs of the node divided by the local processes when several run on the node, no limits for a single process. 0 leaves every library at its own default.",
+    )
+    parser.add_argument(
+        "--video_affinity",
+        action="store_true",
+        default=False,
+        help="Run the requests of each rank grouped by video instead of in doc order, so frame, feature and KV caches are reused.",
+    )
+    parser.add_argument(
+        "--sharding",
+        type=str,
+        default="doc",
+        choices=["doc", "video"],
+        help="How docs are split between processes: 'doc' deals them round-robin, 'video' assigns whole videos to processes, balancing questions x video duration.",
+    )
     parser.add_argument(
         "--output_path",
         default=None,
@@ -503,6 +523,9 @@ def cli_evaluate_single(args: Union[argparse.Namespace, None] = None, datetime_s
         batch_size=args.batch_size,
         max_batch_size=args.max_batch_size,
         device=args.device,
+        threads_per_rank=args.threads_per_rank,
+        video_affinity=args.video_affinity,
+        sharding=args.sharding,
         use_cache=args.use_cache,
         limit=args.limit,
         check_integrity=args.check_integrity,
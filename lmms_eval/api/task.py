@@ -1,5 +1,6 @@
 import abc
 import ast
+import collections
 import inspect
 import itertools
 import json
@@ -375,7 +376,7 @@ class Task(abc.ABC):
         pass
 
     # @profile
-    def build_all_requests(self, limit=None, rank=None, world_size=None) -> None:
+    def build_all_requests(self, limit=None, rank=None, world_size=None, sharding="doc") -> None:
         """Build a set of Instances for a task, and store them in task.instances"""
         if self.has_test_docs():
             docs = self.test_docs()
@@ -388,7 +389,7 @@ class Task(abc.ABC):
 
         eval_logger.info(f"Building contexts for task {self._config.task} on rank {rank}...")
         instances = []
-        doc_id_iterator = utils.create_iterator([i for i in range(len(docs))], rank, world_size, limit)
+        doc_id_iterator = self.shard_doc_ids(docs, rank, world_size, limit, sharding)
         doc_id_iterator, doc_id_iterator_counting = itertools.tee(doc_id_iterator)
         total_docs = sum(1 for _ in doc_id_iterator_counting)
         pbar = tqdm(total=total_docs, desc=f"Building context", disable=(rank != 0))
@@ -588,8 +589,11 @@ class Task(abc.ABC):
         else:
             raise ValueError(f"Task dataset (path={self.DATASET_PATH}, name={self.DATASET_NAME}) must have valid or test docs!")
 
-    def doc_iterator(self, *, rank: int = 0, limit: Union[int, None] = None, world_size: int = 1) -> Iterator[Tuple[int, Any]]:
+    def doc_iterator(self, *, rank: int = 0, limit: Union[int, None] = None, world_size: int = 1, sharding: str = "doc") -> Iterator[Tuple[int, Any]]:
         limit = int(limit) if limit else None
+        if sharding == "video":
+            docs = self.eval_docs
+            return ((doc_id, docs[doc_id]) for doc_id in self.shard_doc_ids(docs, int(rank), int(world_size), limit, sharding))
         doc_iterator = utils.create_iterator(
             enumerate(self.eval_docs),
             rank=int(rank),
@@ -598,6 +602,42 @@ class Task(abc.ABC):
         )
         return doc_iterator
 
+    def shard_doc_ids(self, docs, rank, world_size, limit=None, sharding="doc") -> Iterator[int]:
+        """
+        Doc ids handled by `rank`. "doc" sharding deals them round-robin; "video" sharding keeps all
+        docs on the same visuals on one rank, balancing question count x video duration across
+        ranks, so each video is decoded and encoded once. The video assignment is computed (and the
+        videos probed) on rank 0 only, broadcast, and memoized, so request building and result
+        collection always agree.
+        """
+        if sharding not in ("doc", "video"):
+            raise ValueError(f"Unknown sharding {sharding}, expected 'doc' or 'video'")
+        doc_ids = list(range(len(docs)))
+        if sharding == "doc" or not world_size or world_size <= 1:
+            return utils.create_iterator(doc_ids, rank, world_size, limit)
+        cache_key = (world_size, limit)
+        shards = getattr(self, "_video_shards", {})
+        if cache_key not in shards:
+            shards[cache_key] = utils.compute_on_rank0(lambda: self.video_shards(docs, doc_ids[:limit], world_size))
+            self._video_shards = shards
+            eval_logger.info(f"Video sharding of task {self._config.task}: {len(shards[cache_key][rank])} of {len(doc_ids[:limit])} docs on rank {rank}")
+        return iter(shards[cache_key][rank])
+
+    def video_shards(self, docs, doc_ids, world_size) -> List[List[int]]:
+        """Doc ids of every rank under "video" sharding, see `shard_doc_ids`."""
+        group_keys = []
+        for doc_id in doc_ids:
+            visuals = tuple(visual for visual in (self.doc_to_visual(docs[doc_id]) or []) if isinstance(visual, str))
+            # docs without video files are spread individually
+            group_keys.append(visuals if visuals else ("doc", doc_id))
+        sizes = collections.Counter(group_keys)
+        if len(sizes) < world_size:
+            # some ranks would get no docs at all
+            eval_logger.warning(f"Task {self._config.task} has {len(sizes)} videos for {world_size} ranks, falling back to doc sharding")
+            return [list(utils.create_iterator(doc_ids, rank, world_size)) for rank in range(world_size)]
+        group_costs = {key: count * (utils.video_duration(key) if key[0] != "doc" else 1.0) for key, count in sizes.items()}
+        return utils.create_grouped_shards(doc_ids, group_keys, world_size, group_costs)
+
 
 class ConfigurableTask(Task):
     VERSION = "Yaml"
@@ -0,0 +1,258 @@
+"""
+Micro-benchmark of the video decode paths on synthetic clips and, optionally, on the real videos of a task.
+
+Example:
+    python -m lmms_eval.bench.video_decode --output decode_bench.json
+    python -m lmms_eval.bench.video_decode --tasks vsibench --max_task_videos 20 --threads 1,2,4 --output decode_bench.json
+
+Every (backend, frame count, thread count) configuration runs in a fresh worker process, so the
+reported peak RSS belongs to that configuration alone. Results are written as JSON together with
+the commit and decoder versions, so runs on different commits or nodes can be diffed directly.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import av
+import numpy as np
+from loguru import logger as eval_logger
+
+from lmms_eval.models.model_utils.load_video import read_video_decord, read_video_pyav
+from lmms_eval.models.model_utils.video_source import (
+    VIDEO_BACKEND_REGISTRY,
+    VideoSource,
+)
+
+# name -> (container extension, encoder)
+SYNTHETIC_FORMATS = {
+    "h264": ("mp4", "libx264"),
+    "vp9": ("webm", "libvpx-vp9"),
+    "h264_mkv": ("mkv", "libx264"),
+}
+# the legacy entry points plus every registered backend except the frame store, which does not decode
+DEFAULT_BACKENDS = ["read_video_pyav", "read_video_decord"] + [name for name in VIDEO_BACKEND_REGISTRY if name != "frame-store"]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, default="video_decode_bench.json", help="Path of the JSON report")
+    parser.add_argument("--backends", type=str, default=",".join(DEFAULT_BACKENDS), help="Comma separated backends to measure")
+    parser.add_argument("--frames", type=str, default="8,16,32,64", help="Comma separated numbers of sampled frames")
+    parser.add_argument("--threads", type=str, default="0", help="Comma separated decoder thread counts, 0 lets the decoder choose")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed decodes per video and configuration")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed decodes per video and configuration, also builds the probe index")
+    parser.add_argument("--formats", type=str, default=",".join(SYNTHETIC_FORMATS), help="Comma separated synthetic formats, empty to skip synthetic clips")
+    parser.add_argument("--duration", type=float, default=60.0, help="Length of the synthetic clips in seconds")
+    parser.add_argument("--resolution", type=str, default="640x480", help="WIDTHxHEIGHT of the synthetic clips")
+    parser.add_argument("--fps", type=int, default=30, help="Frame rate of the synthetic clips")
+    parser.add_argument("--gop", type=int, default=60, help="Keyframe interval of the synthetic clips")
+    parser.add_argument("--synthetic_dir", type=str, default=None, help="Where to write the synthetic clips, a temporary directory by default")
+    parser.add_argument("--tasks", type=str, default=None, help="Also benchmark the videos of these tasks. Separate each task with comma")
+    parser.add_argument("--max_task_videos", type=int, default=10, help="Number of task videos to benchmark per task")
+    parser.add_argument("--include_path", type=str, default=None, help="Additional path to include if there are external tasks")
+    return parser.parse_args()
+
+
+def make_synthetic_video(path, encoder, duration, width, height, fps, gop):
+    """Encode a moving gradient with some noise, so the encoder produces realistic P/B-frame sizes."""
+    rng = np.random.default_rng(0)
+    container = av.open(path, mode="w")
+    try:
+        stream = container.add_stream(encoder, rate=fps)
+        stream.width = width
+        stream.height = height
+        stream.pix_fmt = "yuv420p"
+        stream.options = {"g": str(gop)}
+        xs = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+        ys = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+        for i in range(int(duration * fps)):
+            shift = (i * 4) % 256
+            image = np.empty((height, width, 3), dtype=np.uint8)
+            image[..., 0] = (xs + shift) % 256
+            image[..., 1] = (ys + shift) % 256
+            image[..., 2] = rng.integers(0, 32, size=(height, width), dtype=np.uint8) + 96
+            frame = av.VideoFrame.from_ndarray(image, format="rgb24")
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    finally:
+        container.close()
+    return path
+
+
+def make_synthetic_videos(args):
+    formats = [name for name in args.formats.split(",") if name]
+    if not formats:
+        return []
+    width, height = (int(x) for x in args.resolution.lower().split("x"))
+    out_dir = args.synthetic_dir or tempfile.mkdtemp(prefix="lmms_eval_decode_bench_")
+    os.makedirs(out_dir, exist_ok=True)
+    videos = []
+    for name in formats:
+        extension, encoder = SYNTHETIC_FORMATS[name]
+        path = os.path.join(out_dir, f"{name}_{width}x{height}_{int(args.duration)}s.{extension}")
+        if not os.path.exists(path):
+            eval_logger.info(f"Encoding synthetic {name} clip {path}")
+            make_synthetic_video(path, encoder, args.duration, width, height, args.fps, args.gop)
+        videos.append({"path": path, "source": f"synthetic/{name}"})
+    return videos
+
+
+def collect_task_videos(args):
+    from lmms_eval.evaluator_utils import get_task_list
+    from lmms_eval.tasks import TaskManager, get_task_dict
+
+    task_manager = TaskManager("INFO", include_path=args.include_path)
+    task_dict = get_task_dict(args.tasks.split(","), task_manager)
+    videos = []
+    for task_output in get_task_list(task_dict):
+        task = task_output.task
+        if task is None:
+            continue
+        seen = set()
+        for doc in task.eval_docs:
+            for visual in task.doc_to_visual(doc) or []:
+                if isinstance(visual, str) and visual not in seen and os.path.exists(visual):
+                    seen.add(visual)
+                    videos.append({"path": visual, "source": f"task/{task_output.task_name}"})
+            if len(seen) >= args.max_task_videos:
+                break
+    return videos
+
+
+def describe_video(path):
+    container = av.open(path)
+    try:
+        stream = container.streams.video[0]
+        return {
+            "codec": stream.codec_context.name,
+            "container": container.format.name,
+            "width": stream.codec_context.width,
+            "height": stream.codec_context.height,
+            "frames": int(stream.frames or 0),
+            "duration": float(container.duration / av.time_base) if container.duration else None,
+        }
+    finally:
+        container.close()
+
+
+def build_decoder(backend, threads):
+    if backend == "read_video_pyav":
+        return lambda path, num_frames: read_video_pyav(path, num_frm=num_frames)
+    if backend == "read_video_decord":
+        return lambda path, num_frames: read_video_decord(path, num_frm=num_frames)
+    source = VideoSource(backend=backend, num_threads=threads, fallback=False)
+    return lambda path, num_frames: source.sample(path, num_frames, "uniform")
+
+
+def run_config(backend, num_frames, threads, videos, repeats, warmup):
+    """Runs in a fresh worker process; returns one result row per video."""
+    decode = build_decoder(backend, threads)
+    rows = []
+    for video in videos:
+        row = {"video": video, "backend": backend, "num_frames": num_frames, "threads": threads, "error": None}
+        try:
+            for _ in range(warmup):
+                frames = decode(video, num_frames)
+            latencies = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                frames = decode(video, num_frames)
+                latencies.append(time.perf_counter() - start)
+            latencies = np.array(latencies) * 1000
+            row.update(
+                {
+                    "decoded_frames": int(len(frames)),
+                    "frame_shape": list(frames.shape[1:]),
+                    "latency_ms": {
+                        "mean": float(latencies.mean()),
+                        "p50": float(np.percentile(latencies, 50)),
+                        "p90": float(np.percentile(latencies, 90)),
+                        "p99": float(np.percentile(latencies, 99)),
+                    },
+                    "frames_per_sec": float(len(frames) / (latencies.mean() / 1000)),
+                }
+            )
+        except Exception as e:
+            row["error"] = f"{type(e).__name__}: {e}"
+        rows.append(row)
+    # ru_maxrss is in KiB on Linux; the worker only ever ran this configuration
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    for row in rows:
+        row["peak_rss_mb"] = peak_rss_mb
+    return rows
+
+
+def run_benchmark(args, videos):
+    backends = [name for name in args.backends.split(",") if name]
+    for backend in backends:
+        if backend not in DEFAULT_BACKENDS and backend not in VIDEO_BACKEND_REGISTRY:
+            raise ValueError(f"Unknown backend {backend}, expected one of {DEFAULT_BACKENDS}")
+    frame_counts = [int(x) for x in args.frames.split(",")]
+    thread_counts = [int(x) for x in args.threads.split(",")]
+    paths = [video["path"] for video in videos]
+
+    results = []
+    for backend in backends:
+        # the legacy entry points do not take a thread count
+        for threads in thread_counts if backend not in ("read_video_pyav", "read_video_decord") else thread_counts[:1]:
+            for num_frames in frame_counts:
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                    rows = pool.submit(run_config, backend, num_frames, threads, paths, args.repeats, args.warmup).result()
+                for row in rows:
+                    if row["error"] is None:
+                        eval_logger.info(f"{backend:>18} frames={num_frames:<3} threads={threads:<2} p50={row['latency_ms']['p50']:8.1f}ms " f"fps={row['frames_per_sec']:8.1f} rss={row['peak_rss_mb']:7.0f}MB {row['video']}")
+                    else:
+                        eval_logger.warning(f"{backend:>18} frames={num_frames:<3} threads={threads:<2} failed on {row['video']}: {row['error']}")
+                results.extend(rows)
+    return results
+
+
+def environment_info():
+    from lmms_eval.utils import get_git_commit_hash
+
+    try:
+        import decord
+
+        decord_version = decord.__version__
+    except ImportError:
+        decord_version = None
+    return {
+        "git_hash": get_git_commit_hash(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "hostname": platform.node(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "cpu_affinity": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None,
+        "av": av.__version__,
+        "decord": decord_version,
+    }
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    videos = make_synthetic_videos(args)
+    if args.tasks:
+        videos += collect_task_videos(args)
+    if not videos:
+        raise ValueError("Nothing to benchmark, pass --formats and/or --tasks")
+    for video in videos:
+        video.update(describe_video(video["path"]))
+
+    report = {
+        "environment": environment_info(),
+        "config": vars(args),
+        "videos": videos,
+        "results": run_benchmark(args, videos),
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    eval_logger.info(f"Wrote {len(report['results'])} results to {args.output}")
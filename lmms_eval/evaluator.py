@@ -11,6 +11,7 @@ from typing import List, Optional, Union
 
 import numpy as np
 import torch
+from accelerate import DistributedType
 from datasets import Image, Sequence
 from loguru import logger as eval_logger
 from tqdm import tqdm
@@ -27,9 +28,15 @@ from lmms_eval.evaluator_utils import (
     prepare_print_tasks,
     print_writeout,
     run_task_tests,
+    video_affinity_collator,
 )
 from lmms_eval.loggers.evaluation_tracker import EvaluationTracker
 from lmms_eval.models import get_model
+from lmms_eval.models.model_utils.thread_budget import (
+    apply_thread_budget,
+    compute_thread_budget,
+    local_world_size,
+)
 from lmms_eval.tasks import TaskManager, get_task_dict
 from lmms_eval.utils import (
     create_iterator,
@@ -53,6 +60,9 @@ def simple_evaluate(
     batch_size: Optional[Union[int, str]] = None,
     max_batch_size: Optional[int] = None,
     device: Optional[str] = None,
+    threads_per_rank: Optional[int] = None,
+    video_affinity: bool = False,
+    sharding: str = "doc",
     use_cache: Optional[str] = None,
     cache_requests: bool = False,
     rewrite_requests_cache: bool = False,
@@ -90,7 +100,7 @@ def simple_evaluate(
     :param batch_size: int or str, optional
         Batch size for model
     :param max_batch_size: int, optional
-        Maximal batch size to try with automatic batch size detection
+        Maximal batch size with `batch_size="auto"`, where models batch requests up to a token budget
     :param device: str, optional
         PyTorch device (e.g. "cpu" or "cuda:0") for running models
     :param use_cache: str, optional
@@ -117,6 +127,14 @@ def simple_evaluate(
         If True, apply chat template to the prompt
     :param fewshot_as_multiturn: bool
         Whether to provide the fewshot examples as a multiturn conversation or a single user turn.
+    :param threads_per_rank: int
+        CPU threads of each process, split between video decoding, torch and tokenizers.
+        If None, derived from the CPU affinity and the number of local processes when several run on the node,
+        and not applied to a single process. If 0, no thread limits are applied.
+    :param video_affinity: bool
+        If True, each rank runs its requests grouped by video instead of in doc order, so the model's caches hit.
+    :param sharding: str
+        How docs are split between ranks: "doc" deals them round-robin, "video" assigns whole videos to ranks, balancing questions x duration.
     :param gen_kwargs: str
         String arguments for model generation
         Ignored for all tasks with loglikelihood output_type
@@ -162,14 +180,21 @@ def simple_evaluate(
     if model_args is None:
         model_args = ""
 
+    # applied before the model exists, so its tokenizer and decoders start with the budgeted thread pools
+    # a single process keeps the libraries' own defaults unless a budget is asked for
+    thread_budget = None
+    if threads_per_rank or (threads_per_rank is None and local_world_size() > 1):
+        thread_budget = apply_thread_budget(compute_thread_budget(threads_per_rank=threads_per_rank))
+
     ModelClass = get_model(model)
-    lm = ModelClass.create_from_arg_string(
-        model_args,
-        {
-            "batch_size": batch_size,
-            "device": device,
-        },
-    )
+    additional_config = {
+        "batch_size": batch_size,
+        "device": device,
+    }
+    if isinstance(batch_size, str) and batch_size.startswith("auto"):
+        # only models that support batch_size=auto take max_batch_size
+        additional_config["max_batch_size"] = max_batch_size
+    lm = ModelClass.create_from_arg_string(model_args, additional_config)
 
     if task_manager is None:
         task_manager = TaskManager(verbosity, model_name=model)
@@ -250,6 +275,8 @@ def simple_evaluate(
         apply_chat_template=apply_chat_template,
         fewshot_as_multiturn=fewshot_as_multiturn,
         verbosity=verbosity,
+        video_affinity=video_affinity,
+        sharding=sharding,
         cli_args=cli_args,
     )
 
@@ -275,6 +302,9 @@ def simple_evaluate(
                 "batch_size": batch_size,
                 "batch_sizes": (list(lm.batch_sizes.values()) if hasattr(lm, "batch_sizes") else []),
                 "device": device,
+                "thread_budget": thread_budget.to_dict() if thread_budget is not None else None,
+                "video_affinity": video_affinity,
+                "sharding": sharding,
                 "use_cache": use_cache,
                 "limit": limit,
                 "bootstrap_iters": bootstrap_iters,
@@ -311,6 +341,8 @@ def evaluate(
     apply_chat_template: bool = False,
     fewshot_as_multiturn: bool = False,
     verbosity: str = "INFO",
+    video_affinity: bool = False,
+    sharding: str = "doc",
     cli_args=None,
 ):
     """Instantiate and evaluate a model on a list of tasks.
@@ -333,6 +365,10 @@ def evaluate(
         If True, apply chat template to the prompt
     :param fewshot_as_multiturn: bool
         Whether to provide the fewshot examples as a multiturn conversation or a single user turn.
+    :param video_affinity: bool
+        If True, requests are sent to the model grouped by video and their responses restored to the original order.
+    :param sharding: str
+        "doc" or "video", how docs are split between ranks; used both to build requests and to collect results.
     :return
         Dictionary of results
     """
@@ -407,6 +443,7 @@ def evaluate(
             limit=limit,
             rank=lm.rank,
             world_size=lm.world_size,
+            sharding=sharding,
             # cache_requests=cache_requests, # later we will add them
             # rewrite_requests_cache=rewrite_requests_cache,
             # system_instruction=system_instruction,
@@ -442,12 +479,21 @@ def evaluate(
         for req in reqs:
             cloned_reqs.extend([req] * req.repeats)
 
-        if (lm.world_size > 1) and (padding_requests[reqtype] > 0):
+        # video sharding balances cost, not request counts, so padding would rerun the last request many
+        # times on the short ranks; only models with sharded weights (FSDP, DeepSpeed) need ranks in lockstep
+        accelerator = getattr(lm, "accelerator", None)
+        pad_ranks = sharding != "video" or (accelerator is not None and accelerator.distributed_type in (DistributedType.FSDP, DistributedType.DEEPSPEED))
+        if (lm.world_size > 1) and (padding_requests[reqtype] > 0) and pad_ranks:
             for _ in range(padding_requests[reqtype]):
                 cloned_reqs.extend([req] * req.repeats)
 
         # run requests through model
-        resps = getattr(lm, reqtype)(cloned_reqs)  # Choiszt run generate until
+        if video_affinity:
+            collator = video_affinity_collator(cloned_reqs, name_to_task)
+            ordered_reqs = [req for chunk in collator.get_batched(n=0) for req in chunk]
+            resps = collator.get_original(getattr(lm, reqtype)(ordered_reqs))
+        else:
+            resps = getattr(lm, reqtype)(cloned_reqs)  # Choiszt run generate until
 
         # put responses from model into a list of length K for each request.
         for x, req in zip(resps, cloned_reqs):
@@ -476,7 +522,7 @@ def evaluate(
             instances.sort(key=lambda x: x.idx)
         # iterate over different filters used
         for filter_key in task.instances[0].filtered_resps.keys():
-            doc_iterator = task.doc_iterator(rank=RANK, limit=limit, world_size=WORLD_SIZE)
+            doc_iterator = task.doc_iterator(rank=RANK, limit=limit, world_size=WORLD_SIZE, sharding=sharding)
             for doc_id, doc in doc_iterator:
                 requests = instances_by_doc_id[doc_id]
                 metrics = task.process_results(doc, [req.filtered_resps[filter_key] for req in requests])
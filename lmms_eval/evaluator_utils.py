@@ -13,7 +13,7 @@ from lmms_eval.api.metrics import (
     stderr_for_metric,
 )
 from lmms_eval.api.task import Task
-from lmms_eval.utils import eval_logger, positional_deprecated
+from lmms_eval.utils import Collator, eval_logger, positional_deprecated
 
 
 class TaskOutput:
@@ -187,6 +187,34 @@ def print_writeout(task) -> None:
             eval_logger.info(f"Request: {str(inst)}")
 
 
+def visual_key(instance, task) -> Tuple[str, ...]:
+    """Paths of the visuals of a request's doc; in-memory visuals (e.g. PIL images) count as ""."""
+    if task is None or len(instance.args) < 6:
+        return ()
+    doc_to_visual, doc_id, _, split = instance.args[2:6]
+    if not callable(doc_to_visual):
+        return ()
+    visuals = doc_to_visual(task.dataset[split][doc_id]) or []
+    return tuple(visual if isinstance(visual, str) else "" for visual in visuals)
+
+
+def video_affinity_collator(requests, name_to_task) -> Collator:
+    """
+    Collator ordering requests video-major: requests on the same visuals run back to back, in their
+    original order, so the frame, feature and KV caches of the model hit. Responses computed in
+    this order are mapped back with `get_original`.
+    """
+    keys = {}
+
+    def sort_fn(instance):
+        doc_key = (instance.task_name, instance.doc_id)
+        if doc_key not in keys:
+            keys[doc_key] = visual_key(instance, name_to_task.get(instance.task_name))
+        return keys[doc_key]
+
+    return Collator(requests, sort_fn=sort_fn)
+
+
 def get_sample_size(task, limit: Optional[int]) -> Union[int, None]:
     if limit is not None:
         limit = int(math.ceil(len(task.eval_docs) * limit)) if limit < 1.0 else int(limit)
@@ -21,12 +21,8 @@ from tqdm import tqdm
 from lmms_eval.api.instance import Instance
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
-
-# Conditional imports
-try:
-    from decord import VideoReader, cpu
-except ImportError:
-    eval_logger.warning("Decord is not installed. Video input will not be supported.")
+from lmms_eval.models.model_utils.frame_encoder import FrameEncoder
+from lmms_eval.models.model_utils.video_source import VideoSource
 
 # Constants and global configurations
 API_TYPE = os.getenv("API_TYPE", "openai")
@@ -60,6 +56,8 @@ class BatchGPT4(lmms):
         api_url: str = API_URL,
         modality: str = "image",
         max_frames_num: int = 10,
+        frame_format: str = "png",  # png, jpeg or webp; jpeg/webp payloads are much smaller for video frames
+        frame_quality: int = 90,
         timeout: int = 120,
         **kwargs,
     ) -> None:
@@ -70,6 +68,8 @@ class BatchGPT4(lmms):
         self.model_version = model_version
         self.modality = modality
         self.max_frames_num = max_frames_num
+        self.video_source = VideoSource()
+        self.frame_encoder = FrameEncoder(image_format=frame_format, quality=frame_quality)
         self.image_token = "<image>"
         self.timeout = timeout
 
@@ -83,30 +83,11 @@ class BatchGPT4(lmms):
 
     # Function to encode the image
     def encode_image(self, image: Image):
-        output_buffer = BytesIO()
-        image.save(output_buffer, format="PNG")
-        byte_data = output_buffer.getvalue()
-        base64_str = base64.b64encode(byte_data).decode("utf-8")
-        return base64_str
+        return self.frame_encoder.encode_image(image)
 
     # Function to encode the video
     def encode_video(self, video_path, for_get_frames_num):
-        vr = VideoReader(video_path, ctx=cpu(0))
-        total_frame_num = len(vr)
-        uniform_sampled_frames = np.linspace(0, total_frame_num - 1, for_get_frames_num, dtype=int)
-        frame_idx = uniform_sampled_frames.tolist()
-        frames = vr.get_batch(frame_idx).asnumpy()
-
-        base64_frames = []
-        for frame in frames:
-            img = Image.fromarray(frame)
-            output_buffer = BytesIO()
-            img.save(output_buffer, format="PNG")
-            byte_data = output_buffer.getvalue()
-            base64_str = base64.b64encode(byte_data).decode("utf-8")
-            base64_frames.append(base64_str)
-
-        return base64_frames
+        return self.frame_encoder.encode_video(self.video_source, video_path, for_get_frames_num, "uniform")
 
     def flatten(self, input):
         new_list = []
@@ -135,13 +116,13 @@ class BatchGPT4(lmms):
             if self.image_token not in contexts:
                 messages.append({"role": "user", "content": contexts})
                 for img in imgs:
-                    messages.append({"role": "user", "content": f"data:image/jpeg;base64,{img}"})
+                    messages.append({"role": "user", "content": self.frame_encoder.data_url(img)})
             else:
                 contexts_split = contexts.split(self.image_token)
                 for idx, context in enumerate(contexts_split):
                     if idx < len(imgs):
                         messages.append({"role": "user", "content": context})
-                        messages.append({"role": "user", "content": f"data:image/jpeg;base64,{imgs[idx]}"})
+                        messages.append({"role": "user", "content": self.frame_encoder.data_url(imgs[idx])})
                 if len(contexts_split) > len(imgs):
                     messages.append({"role": "user", "content": contexts_split[-1]})
 
@@ -13,6 +13,8 @@ from tqdm import tqdm
 from lmms_eval.api.instance import Instance
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
+from lmms_eval.models.model_utils.frame_encoder import FrameEncoder
+from lmms_eval.models.model_utils.video_source import VideoSource
 
 NUM_SECONDS_TO_SLEEP = 5
 
@@ -23,7 +25,6 @@ eval_logger = logger
 try:
     import anthropic
     import numpy as np
-    from decord import VideoReader, cpu
 except Exception as e:
     eval_logger.warning(f"Error importing claude: {e}")
 
@@ -40,6 +41,8 @@ class Claude(lmms):
         system_prompt: str = "",  # Whether you want some special system prompt here
         modality: str = "image",
         max_frames_num: int = 10,
+        frame_format: str = "jpeg",  # jpeg, png or webp
+        frame_quality: int = 75,
         continual_mode: bool = False,
         response_persistent_folder: str = None,
         **kwargs,
@@ -50,6 +53,8 @@ class Claude(lmms):
         self.system_prompt = system_prompt
         self.modality = modality
         self.max_frames_num = max_frames_num
+        self.video_source = VideoSource()
+        self.frame_encoder = FrameEncoder(image_format=frame_format, quality=frame_quality)
 
         self.continual_mode = continual_mode
         if self.continual_mode:
@@ -84,11 +89,7 @@ class Claude(lmms):
         self.device = self.accelerator.device
 
     def encode_image(self, image):
-        output_buffer = BytesIO()
-        image.save(output_buffer, format="JPEG")
-        byte_data = output_buffer.getvalue()
-        base64_str = base64.b64encode(byte_data).decode("utf-8")
-        return base64_str
+        return self.frame_encoder.encode_image(image)
 
     def flatten(self, input):
         new_list = []
@@ -131,22 +132,7 @@ class Claude(lmms):
         return self.shrink_image_to_file_size(img, max_file_size)
 
     def encode_video(self, video_path):
-        vr = VideoReader(video_path, ctx=cpu(0))
-        total_frame_num = len(vr)
-        uniform_sampled_frames = np.linspace(0, total_frame_num - 1, self.max_frames_num, dtype=int)
-        frame_idx = uniform_sampled_frames.tolist()
-        frames = vr.get_batch(frame_idx).asnumpy()
-
-        base64_frames = []
-        for frame in frames:
-            img = Image.fromarray(frame)
-            output_buffer = BytesIO()
-            img.save(output_buffer, format="JPEG")
-            byte_data = output_buffer.getvalue()
-            base64_str = base64.b64encode(byte_data).decode("utf-8")
-            base64_frames.append(f"{base64_str}")
-
-        return base64_frames
+        return self.frame_encoder.encode_video(self.video_source, video_path, self.max_frames_num, "uniform")
 
     def generate_until(self, requests) -> List[str]:
         client = anthropic.Anthropic()
@@ -158,7 +144,7 @@ class Claude(lmms):
             "type": "image",
             "source": {
                 "type": "base64",
-                "media_type": "image/jpeg",
+                "media_type": self.frame_encoder.mime_type,
             },
         }
         empty_text_block = {"type": "text"}
@@ -14,14 +14,11 @@ from tqdm import tqdm
 from lmms_eval.api.instance import Instance
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
+from lmms_eval.models.model_utils.frame_encoder import FrameEncoder
+from lmms_eval.models.model_utils.video_source import VideoSource
 
 import hashlib
 
-try:
-    from decord import VideoReader, cpu
-except ImportError:
-    pass
-
 from PIL import Image
 
 API_TYPE = os.getenv("API_TYPE", "openai")
@@ -56,6 +53,8 @@ class GPT4V(lmms):
         model_version: str = "gpt-4-vision-preview",
         modality: str = "video",
         max_frames_num: int = 10,
+        frame_format: str = "png",  # png, jpeg or webp; jpeg/webp payloads are much smaller for video frames
+        frame_quality: int = 90,
         timeout: int = 120,
         continual_mode: bool = False,
         response_persistent_folder: str = None,
@@ -68,6 +67,8 @@ class GPT4V(lmms):
         self.model_version = model_version
         self.modality = modality
         self.max_frames_num = max_frames_num
+        self.video_source = VideoSource()
+        self.frame_encoder = FrameEncoder(image_format=frame_format, quality=frame_quality)
         self.image_token = "<image>"
         self.timeout = timeout
         self.continual_mode = continual_mode
@@ -110,35 +111,11 @@ class GPT4V(lmms):
 
     # Function to encode the image
     def encode_image(self, image: Image):
-        output_buffer = BytesIO()
-        image.save(output_buffer, format="PNG")
-        byte_data = output_buffer.getvalue()
-        base64_str = base64.b64encode(byte_data).decode("utf-8")
-        return base64_str
+        return self.frame_encoder.encode_image(image)
 
     # Function to encode the video
     def encode_video(self, video_path, for_get_frames_num):
-        vr = VideoReader(video_path, ctx=cpu(0))
-        total_frame_num = len(vr)
-        uniform_sampled_frames = np.linspace(0, total_frame_num - 1, for_get_frames_num, dtype=int)
-
-        # Ensure the last frame is included
-        if total_frame_num - 1 not in uniform_sampled_frames:
-            uniform_sampled_frames = np.append(uniform_sampled_frames, total_frame_num - 1)
-
-        frame_idx = uniform_sampled_frames.tolist()
-        frames = vr.get_batch(frame_idx).asnumpy()
-
-        base64_frames = []
-        for frame in frames:
-            img = Image.fromarray(frame)
-            output_buffer = BytesIO()
-            img.save(output_buffer, format="PNG")
-            byte_data = output_buffer.getvalue()
-            base64_str = base64.b64encode(byte_data).decode("utf-8")
-            base64_frames.append(base64_str)
-
-        return base64_frames
+        return self.frame_encoder.encode_video(self.video_source, video_path, for_get_frames_num, "uniform_with_last")
 
     def flatten(self, input):
         new_list = []
@@ -182,13 +159,13 @@ class GPT4V(lmms):
                 payload["messages"].append(deepcopy(response_json))
                 payload["messages"][0]["content"].append({"type": "text", "text": contexts})
                 for img in imgs:
-                    payload["messages"][0]["content"].append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img}"}})
+                    payload["messages"][0]["content"].append({"type": "image_url", "image_url": {"url": self.frame_encoder.data_url(img)}})
             else:
                 contexts = contexts.split(self.image_token)
                 for idx, img in enumerate(imgs):
                     payload["messages"].append(deepcopy(response_json))
                     payload["messages"][idx]["content"].append({"type": "text", "text": contexts[idx]})
-                    payload["messages"][idx]["content"].append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img}"}})
+                    payload["messages"][idx]["content"].append({"type": "image_url", "image_url": {"url": self.frame_encoder.data_url(img)}})
 
                 # If n image tokens are in the contexts
                 # contexts will be splitted into n+1 chunks
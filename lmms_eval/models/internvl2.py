@@ -3,6 +3,7 @@ from typing import List, Optional, Tuple
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as T
 from accelerate import Accelerator, DistributedType
 from decord import VideoReader, cpu
@@ -14,6 +15,7 @@ from transformers import AutoModel, AutoTokenizer
 from lmms_eval.api.instance import Instance
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
+from lmms_eval.models.model_utils.video_source import VideoSource
 
 eval_logger = logging.getLogger("eval_logger")
 
@@ -49,16 +51,18 @@ def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_
     return best_ratio
 
 
-def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnail=False):
-    orig_width, orig_height = image.size
-    aspect_ratio = orig_width / orig_height
-
-    # calculate the existing image aspect ratio
+def tile_grid(width, height, image_size=448, min_num=1, max_num=6):
+    """The (columns, rows) tiling `dynamic_preprocess` picks for a width x height image."""
     target_ratios = set((i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if i * j <= max_num and i * j >= min_num)
     target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    return find_closest_aspect_ratio(width / height, target_ratios, width, height, image_size)
+
+
+def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnail=False):
+    orig_width, orig_height = image.size
 
     # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+    target_aspect_ratio = tile_grid(orig_width, orig_height, image_size=image_size, min_num=min_num, max_num=max_num)
 
     # calculate the target width and height
     target_width = image_size * target_aspect_ratio[0]
@@ -88,34 +92,42 @@ def load_image(image, input_size=448, max_num=6):
     return pixel_values
 
 
-def get_index(bound, fps, max_frame, first_idx=0, num_segments=32):
-    if bound:
-        start, end = bound[0], bound[1]
-    else:
-        start, end = -100000, 100000
-    start_idx = max(first_idx, round(start * fps))
-    end_idx = min(round(end * fps), max_frame)
-    seg_size = float(end_idx - start_idx) / num_segments
-    frame_indices = np.array([int(start_idx + (seg_size / 2) + np.round(seg_size * idx)) for idx in range(num_segments)])
-    return frame_indices
-
-
-def load_video(video_path, bound=None, input_size=448, max_num=1, num_segments=32):
-    vr = VideoReader(video_path, ctx=cpu(0))
-    max_frame = len(vr) - 1
-    fps = float(vr.get_avg_fps())
-
-    pixel_values_list, num_patches_list = [], []
-    transform = build_transform(input_size=input_size)
-    frame_indices = get_index(bound, fps, max_frame, first_idx=0, num_segments=num_segments)
-    for frame_index in frame_indices:
-        img = Image.fromarray(vr[frame_index].asnumpy()).convert("RGB")
-        img = dynamic_preprocess(img, image_size=input_size, use_thumbnail=True, max_num=max_num)
-        pixel_values = [transform(tile) for tile in img]
-        pixel_values = torch.stack(pixel_values)
-        num_patches_list.append(pixel_values.shape[0])
-        pixel_values_list.append(pixel_values)
-    pixel_values = torch.cat(pixel_values_list)
+def tile_frames(frames, image_size=448, max_num=1, use_thumbnail=True, chunk_size=8):
+    """
+    Batched torch equivalent of `dynamic_preprocess` + `build_transform` for a (T, H, W, 3) uint8 array.
+
+    All frames of a video share a resolution, so the tile grid is chosen once; each chunk of frames
+    is resized in one bicubic (antialiased, like PIL) interpolate, split into tiles with a reshape
+    and normalized in place. Returns (T * tiles_per_frame, 3, image_size, image_size) float32
+    pixel_values, ordered frame by frame like the per-frame path.
+    """
+    num_frames, height, width, _ = frames.shape
+    cols, rows = tile_grid(width, height, image_size=image_size, max_num=max_num)
+    add_thumbnail = use_thumbnail and cols * rows != 1
+    mean = torch.tensor(IMAGENET_MEAN).view(1, 1, 3, 1, 1) * 255
+    std = torch.tensor(IMAGENET_STD).view(1, 1, 3, 1, 1) * 255
+
+    chunks = []
+    for start in range(0, num_frames, chunk_size):
+        x = torch.from_numpy(np.ascontiguousarray(frames[start : start + chunk_size])).permute(0, 3, 1, 2).float()
+        resized = F.interpolate(x, size=(rows * image_size, cols * image_size), mode="bicubic", align_corners=False, antialias=True)
+        # (B, 3, rows * s, cols * s) -> (B, rows * cols, 3, s, s), tiles in row-major order
+        tiles = resized.view(-1, 3, rows, image_size, cols, image_size).permute(0, 2, 4, 1, 3, 5).reshape(-1, rows * cols, 3, image_size, image_size)
+        if add_thumbnail:
+            thumbnail = F.interpolate(x, size=(image_size, image_size), mode="bicubic", align_corners=False, antialias=True)
+            tiles = torch.cat([tiles, thumbnail.unsqueeze(1)], dim=1)
+        # PIL rounds to uint8 before ToTensor
+        tiles = tiles.round_().clamp_(0, 255).sub_(mean).div_(std)
+        chunks.append(tiles.reshape(-1, 3, image_size, image_size))
+    return torch.cat(chunks), cols * rows + int(add_thumbnail)
+
+
+def load_video(video_path, input_size=448, max_num=1, num_segments=32, video_source=None):
+    # the middle frame of `num_segments` equal segments of the whole video
+    video_source = video_source if video_source is not None else VideoSource()
+    frames = video_source.sample(video_path, num_segments, "segment_midpoints")
+    pixel_values, tiles_per_frame = tile_frames(frames, image_size=input_size, max_num=max_num, use_thumbnail=True)
+    num_patches_list = [tiles_per_frame] * len(frames)
     return pixel_values, num_patches_list
 
 
@@ -265,6 +277,7 @@ class InternVL2(lmms):
 
         self.modality = modality
         self.max_frames_num = max_frames_num
+        self.video_source = VideoSource()
 
     @property
     def config(self):
@@ -343,7 +356,7 @@ class InternVL2(lmms):
                 elif self.modality == "video":
                     assert len(visuals) == 1, f"Only one video is supported, but got {len(visuals)} videos."
                     video_path = visuals[0]
-                    pixel_values, num_patches_list = load_video(video_path, num_segments=self.max_frames_num, max_num=1)
+                    pixel_values, num_patches_list = load_video(video_path, num_segments=self.max_frames_num, max_num=1, video_source=self.video_source)
                     pixel_values = pixel_values.to(torch.bfloat16).cuda()
                     video_prefix = "".join([f"Frame{i+1}: <image>\n" for i in range(len(num_patches_list))])
                     question = video_prefix + contexts
@@ -19,7 +19,7 @@ from lmms_eval import utils
 from lmms_eval.api.instance import Instance
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
-from lmms_eval.models.model_utils.load_video import read_video_pyav
+from lmms_eval.models.model_utils.video_source import VideoSource
 from lmms_eval.utils import stop_sequences_criteria
 
 try:
@@ -79,6 +79,7 @@ class LLaMAVid(lmms):
         self.model_path = snapshot_download(self.pretrained)
         self.model_name = get_model_name_from_path(pretrained)
         self.num_frames = num_frames
+        self.video_source = VideoSource()
         if not os.path.exists("./model_zoo/LAVIS/eva_vit_g.pth") and accelerator.is_main_process:
             eval_logger.info("\n\n Eva Encoder is not found for LLaMA-VID. Download automatically to the folder ./model_zoo/LAVIS")
             cache_path = "model_zoo/LAVIS"
@@ -195,12 +196,7 @@ class LLaMAVid(lmms):
         return self.tokenizer.decode(tokens)
 
     def load_video(self, video_path):
-        vr = VideoReader(video_path, ctx=cpu(0))
-        total_frame_num = len(vr)
-        fps = round(vr.get_avg_fps())
-        frame_idx = [i for i in range(0, len(vr), fps)]
-        spare_frames = vr.get_batch(frame_idx).asnumpy()
-        return spare_frames
+        return self.video_source.sample(video_path, self.num_frames, "one_per_second")
 
     def flatten(self, input):
         new_list = []
@@ -219,7 +215,7 @@ class LLaMAVid(lmms):
             visuals = self.flatten(visuals)
             videos = []
             for visual in visuals:
-                video = read_video_pyav(visual, num_frm=self.num_frames)
+                video = self.video_source.sample(visual, self.num_frames, "uniform_with_last")
                 video = self.image_processor.preprocess(video, return_tensors="pt")["pixel_values"].half().cuda()
                 video = [video]
                 videos += video
@@ -22,7 +22,8 @@ from lmms_eval import utils
 from lmms_eval.api.instance import Instance
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
-from lmms_eval.models.model_utils.load_video import read_video_pyav
+from lmms_eval.models.model_utils.prefetch import prefetch_map
+from lmms_eval.models.model_utils.video_source import DEFAULT_SAMPLING, VideoSource
 
 # Suppress warnings
 warnings.filterwarnings("ignore")
@@ -87,6 +88,8 @@ class Llava_OneVision(lmms):
         mm_spatial_pool_mode: Optional[str] = "bilinear",
         token_strategy: Optional[str] = "single",  # could be "single" or "multiple", "multiple" denotes adding multiple <image> tokens for each frame
         video_decode_backend: str = "decord",
+        prefetch_depth: int = 2,  # number of upcoming batches whose videos are decoded and preprocessed ahead of generation, 0 to disable
+        prefetch_workers: int = 2,
         **kwargs,
     ) -> None:
         super().__init__()
@@ -123,6 +126,10 @@ class Llava_OneVision(lmms):
         self.mm_spatial_pool_stride = mm_spatial_pool_stride
         self.mm_spatial_pool_mode = mm_spatial_pool_mode
         self.video_decode_backend = video_decode_backend
+        self.video_sampling = DEFAULT_SAMPLING.get(video_decode_backend, "uniform")
+        self.video_source = VideoSource(backend=video_decode_backend)
+        self.prefetch_depth = int(prefetch_depth)
+        self.prefetch_workers = int(prefetch_workers)
 
         overwrite_config = {}
         overwrite_config["mm_spatial_pool_stride"] = self.mm_spatial_pool_stride
@@ -300,11 +307,7 @@ class Llava_OneVision(lmms):
                 elif type(visual[0]) == str:
                     image_tensor = []
                     try:
-                        if self.video_decode_backend == "decord":
-                            frames = self.load_video(visual, self.max_frames_num)
-                        elif self.video_decode_backend == "pyav":
-                            frames = read_video_pyav(visual[0], num_frm=self.max_frames_num)
-                        frames = self._image_processor.preprocess(frames, return_tensors="pt")["pixel_values"].half().cuda()
+                        frames = self.load_video_frames(visual).cuda()
                         image_tensor.append(frames)
                     except Exception as e:
                         eval_logger.error(f"Error {e} in loading video")
@@ -377,15 +380,29 @@ class Llava_OneVision(lmms):
         return new_list
 
     def load_video(self, video_path, max_frames_num):
-        if type(video_path) == str:
-            vr = VideoReader(video_path, ctx=cpu(0))
-        else:
-            vr = VideoReader(video_path[0], ctx=cpu(0))
-        total_frame_num = len(vr)
-        uniform_sampled_frames = np.linspace(0, total_frame_num - 1, max_frames_num, dtype=int)
-        frame_idx = uniform_sampled_frames.tolist()
-        spare_frames = vr.get_batch(frame_idx).asnumpy()
-        return spare_frames  # (frames, height, width, channels)
+        return self.video_source.sample(video_path, max_frames_num, "uniform")  # (frames, height, width, channels)
+
+    def load_video_frames(self, visual):
+        frames = self.video_source.sample(visual, self.max_frames_num, self.video_sampling)
+        return self._image_processor.preprocess(frames, return_tensors="pt")["pixel_values"].half()
+
+    def load_chunk_visuals(self, chunk):
+        """Resolve the visuals of a chunk and decode/preprocess its videos into fp16 CPU tensors; runs on a prefetch thread."""
+        batched_contexts, all_gen_kwargs, batched_doc_to_visual, batched_doc_id, batched_task, batched_split = zip(*chunk)
+        task = batched_task[0]
+        split = batched_split[0]
+        batched_visuals = [batched_doc_to_visual[0](self.task_dict[task][split][ids]) for ids in batched_doc_id]  # [B, N]
+        batched_frames = []
+        for visual in batched_visuals:
+            if not visual or type(visual[0]) != str:
+                batched_frames.append(None)
+                continue
+            try:
+                batched_frames.append(self.load_video_frames(visual))
+            except Exception as e:
+                # kept per request, so the generation loop applies the usual fallback for this video only
+                batched_frames.append(e)
+        return batched_visuals, batched_frames
 
     def generate_until(self, requests: List[Instance]) -> List[str]:
         res = []
@@ -408,11 +425,15 @@ class Llava_OneVision(lmms):
         chunks = re_ords.get_batched(n=self.batch_size, batch_fn=None)
         num_iters = len(requests) // self.batch_size if len(requests) % self.batch_size == 0 else len(requests) // self.batch_size + 1
         pbar = tqdm(total=num_iters, disable=(self.rank != 0), desc="Model Responding")
-        for chunk in chunks:
+        # resolve visuals and decode/preprocess videos of the next chunks on worker threads while the GPU generates
+        prefetched = prefetch_map(self.load_chunk_visuals, chunks, depth=self.prefetch_depth, num_workers=self.prefetch_workers)
+        for chunk, loaded, error in prefetched:
+            if error is not None:
+                raise error
             batched_contexts, all_gen_kwargs, batched_doc_to_visual, batched_doc_id, batched_task, batched_split = zip(*chunk)
             task = batched_task[0]
             split = batched_split[0]
-            batched_visuals = [batched_doc_to_visual[0](self.task_dict[task][split][ids]) for ids in batched_doc_id]  # [B, N]
+            batched_visuals, batched_frames = loaded  # [B, N], [B]
             assert len(batched_visuals) == 1
 
             # we assume all gen kwargs in the batch are the same
@@ -423,7 +444,7 @@ class Llava_OneVision(lmms):
 
             question_input = []
 
-            for visual, context in zip(batched_visuals, batched_contexts):
+            for visual, context, prefetched_frames in zip(batched_visuals, batched_contexts, batched_frames):
                 if visual is None or visual == []:  # for text-only tasks.
                     visual = None
                     task_type = "text"
@@ -461,16 +482,12 @@ class Llava_OneVision(lmms):
 
                     elif type(visual[0]) == str:  # For video task
                         image_tensor = []
-                        try:
-                            if self.video_decode_backend == "decord":
-                                frames = self.load_video(visual, self.max_frames_num)
-                            elif self.video_decode_backend == "pyav":
-                                frames = read_video_pyav(visual[0], num_frm=self.max_frames_num)
-                            frames = self._image_processor.preprocess(frames, return_tensors="pt")["pixel_values"].half().cuda()
-                            image_tensor.append(frames)
-                        except Exception as e:
-                            eval_logger.error(f"Error {e} in loading video")
+                        if isinstance(prefetched_frames, Exception):
+                            eval_logger.error(f"Error {prefetched_frames} in loading video")
                             image_tensor = None
+                        else:
+                            frames = prefetched_frames.cuda()
+                            image_tensor.append(frames)
 
                         task_type = "video"
                         placeholder_count = len(frames) if self.token_strategy == "multiple" else 1
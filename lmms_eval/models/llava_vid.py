@@ -1,34 +1,41 @@
-import copy
 import math
+import threading
 from datetime import timedelta
-from typing import List, Optional, Tuple, Union
+from typing import List, Optional, Union
 
-import numpy as np
 import torch
 from accelerate import Accelerator, DistributedType, InitProcessGroupKwargs
 from accelerate.state import AcceleratorState
-from decord import VideoReader, cpu
 from loguru import logger as eval_logger
 from tqdm import tqdm
-from transformers import AutoConfig
+from transformers import AutoConfig, LogitsProcessorList
 
-from lmms_eval.api.instance import Instance
+from lmms_eval import utils
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
-from lmms_eval.models.model_utils.load_video import read_video_pyav
+from lmms_eval.models.model_utils.auto_batch import (
+    TokenBudgetBatcher,
+    is_auto_batch_size,
+)
+from lmms_eval.models.model_utils.feature_cache import (
+    build_feature_cache,
+    checkpoint_hash,
+)
+from lmms_eval.models.model_utils.frame_cache import build_frame_cache
+from lmms_eval.models.model_utils.frame_store import load_frame_store
+from lmms_eval.models.model_utils.load_video import processor_decode_size
+from lmms_eval.models.model_utils.pixel_cache import (
+    build_tensor_cache,
+    image_processor_hash,
+)
+from lmms_eval.models.model_utils.prefetch import prefetch_map
+from lmms_eval.models.model_utils.shm_frame_cache import build_shm_frame_cache
+from lmms_eval.models.model_utils.video_source import DEFAULT_SAMPLING, VideoSource
 
 import sys; sys.path = ["LLaVA-NeXT/"] + sys.path
 try:
-    from llava.constants import (
-        DEFAULT_IM_END_TOKEN,
-        DEFAULT_IM_START_TOKEN,
-        DEFAULT_IMAGE_TOKEN,
-        IGNORE_INDEX,
-        IMAGE_TOKEN_INDEX,
-    )
-    from llava.conversation import SeparatorStyle, conv_templates
+    from llava.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX
     from llava.mm_utils import (
-        KeywordsStoppingCriteria,
         get_model_name_from_path,
         process_images,
         tokenizer_image_token,
@@ -48,9 +55,12 @@ from llava.model.language_model.llava_llama import LlavaConfig
 
 AutoConfig.register("llava_llama", LlavaConfig)
 
+# after the LLaVA imports above, so the mixin resolves llava from the same code base
+from lmms_eval.models.model_utils.llava_video import LlavaVideoMixin
+
 
 @register_model("llavavid")
-class LlavaVid(lmms):
+class LlavaVid(LlavaVideoMixin, lmms):
     """
     LlavaVid Model
     """
@@ -61,6 +71,8 @@ class LlavaVid(lmms):
         truncation: Optional[bool] = True,
         device: Optional[str] = "cuda:0",
         batch_size: Optional[Union[int, str]] = 1,
+        max_batch_size: Optional[int] = None,  # with batch_size=auto, max requests per batch (default 64)
+        batch_token_budget: int = 65536,  # with batch_size=auto, max estimated tokens (visual + prompt) per batch, lowered on out-of-memory
         attn_implementation=(
             "sdpa" if torch.__version__ >= "2.1.2" else "eager"
         ),  # inference implementation for attention, can be "sdpa", "eager", "flash_attention_2". Seems FA2 is not effective during inference: https://discuss.huggingface.co/t/flash-attention-has-no-effect-on-inference/73453/5
@@ -77,6 +89,18 @@ class LlavaVid(lmms):
         mm_pooling_position: str = "after",
         overwrite: bool = True,
         video_decode_backend: str = "pyav",
+        frame_cache_mb: int = 1024,  # per-process budget for decoded frames shared by questions on the same video, 0 to disable
+        prefetch_depth: int = 2,  # number of upcoming requests whose videos are decoded and preprocessed ahead of generation, 0 to disable
+        prefetch_workers: int = 2,
+        shm_frame_cache_mb: int = 0,  # node-wide budget in /dev/shm for frames decoded by any rank on the node, 0 to disable
+        pixel_cache_dir: Optional[str] = None,  # directory for preprocessed fp16 pixel_values (safetensors), reused across runs
+        pixel_cache_mb: int = 0,  # in-memory budget for preprocessed pixel_values, 0 to disable
+        feature_cache_dir: Optional[str] = None,  # directory for vision features (safetensors), reused across runs of the same checkpoint
+        feature_cache_mb: int = 0,  # in-memory budget for vision features shared by questions on the same video, 0 to disable
+        feature_cache_methods: str = "encode_images",  # "+"-separated model methods whose outputs are cached, e.g. encode_images+get_2dPool
+        frame_store: Optional[str] = None,  # directory written by tools/materialize_frames.py, frames are read from it instead of decoding
+        decode_resize: bool = False,  # let the decoder scale frames straight to the image processor's input size
+        decode_resize_tolerance: float = 0.05,  # max mean abs difference of pixel_values vs. native-resolution decoding, checked on the first video
         delay_load: bool = False,
         tie_weights: bool = True,
         **kwargs,
@@ -99,6 +123,9 @@ class LlavaVid(lmms):
         self.pretrained = pretrained
         self.model_name = get_model_name_from_path(pretrained)
         self.video_decode_backend = video_decode_backend
+        self.video_sampling = DEFAULT_SAMPLING.get(video_decode_backend, "uniform_with_last")
+        self.prefetch_depth = int(prefetch_depth)
+        self.prefetch_workers = int(prefetch_workers)
         # self._config = AutoConfig.from_pretrained(self.pretrained)
         self.overwrite = overwrite
         self.mm_resampler_type = mm_resampler_type
@@ -106,6 +133,12 @@ class LlavaVid(lmms):
         self.mm_spatial_pool_out_channels = int(mm_spatial_pool_out_channels)
         self.mm_spatial_pool_mode = mm_spatial_pool_mode
         self.max_frames_num = int(max_frames_num)
+        self.video_source = VideoSource(
+            backend=video_decode_backend,
+            frame_cache=build_frame_cache(frame_cache_mb),
+            frame_store=load_frame_store(frame_store, self.max_frames_num, self.video_sampling),
+            shared_cache=build_shm_frame_cache(shm_frame_cache_mb),
+        )
         self.mm_resampler_location = mm_pooling_position
         self.mm_newline_position = mm_newline_position
         self.delay_load = delay_load
@@ -173,11 +206,37 @@ class LlavaVid(lmms):
             )
 
         self._config = self._model.config
+        self.decode_size = processor_decode_size(self._image_processor) if decode_resize else None
+        if decode_resize and self.decode_size is None:
+            eval_logger.warning(f"decode_resize is not supported for {type(self._image_processor).__name__}, decoding at native resolution")
+        self.decode_resize_tolerance = float(decode_resize_tolerance)
+        self._decode_resize_checked = self.decode_size is None
+        self.pixel_cache = build_tensor_cache(pixel_cache_dir, pixel_cache_mb)
+        self._image_processor_hash = image_processor_hash(self._image_processor)
+        self._numeric_vocab = None  # built on the first numeric_answer request
+        # vision features only depend on the frames and the checkpoint, so every question on a video reuses them
+        self.feature_cache = build_feature_cache(
+            self._model,
+            feature_cache_methods,
+            feature_cache_dir,
+            feature_cache_mb,
+            checkpoint_hash(pretrained, mm_spatial_pool_stride=mm_spatial_pool_stride, mm_spatial_pool_mode=mm_spatial_pool_mode, mm_resampler_type=mm_resampler_type, mm_newline_position=mm_newline_position),
+        )
+        self._decode_resize_lock = threading.Lock()
         self.model.eval()
         if tie_weights:
             self.model.tie_weights()
         self.truncation = truncation
-        self.batch_size_per_gpu = int(batch_size)
+        # batch_size=auto batches requests up to a token budget, see TokenBudgetBatcher
+        self.auto_batch = TokenBudgetBatcher(batch_token_budget, max_batch_size) if is_auto_batch_size(batch_size) else None
+        self.batch_size_per_gpu = self.auto_batch.max_batch_size if self.auto_batch is not None else int(batch_size)
+        # pooled patches of one frame, the unit of the per-request cost estimate
+        num_patches_per_side = getattr(self._model.get_vision_tower(), "num_patches_per_side", 24)
+        self.visual_tokens_per_frame = math.ceil(num_patches_per_side / self.mm_spatial_pool_stride) ** 2
+        if self.batch_size_per_gpu > 1:
+            # batched prompts must end where generation starts; LLaVA re-pads the expanded embeddings by the config's side
+            self._tokenizer.padding_side = "left"
+            self._model.config.tokenizer_padding_side = "left"
         self.conv_template = conv_template
         self.use_cache = use_cache
         self.truncate_context = truncate_context
@@ -251,6 +310,10 @@ class LlavaVid(lmms):
     def batch_size(self):
         return self.batch_size_per_gpu
 
+    @property
+    def batch_sizes(self):
+        return self.auto_batch.batch_sizes if self.auto_batch is not None else {}
+
     @property
     def device(self):
         return self._device
@@ -272,77 +335,9 @@ class LlavaVid(lmms):
             encoding = encoding[-left_truncate_len:]
         return encoding
 
-    def load_video(self, video_path, max_frames_num):
-        vr = VideoReader(video_path, ctx=cpu(0))
-        total_frame_num = len(vr)
-        # fps = round(vr.get_avg_fps())
-        # frame_idx = [i for i in range(0, len(vr), fps)]
-        uniform_sampled_frames = np.linspace(0, total_frame_num - 1, max_frames_num, dtype=int)
-        frame_idx = uniform_sampled_frames.tolist()
-        spare_frames = vr.get_batch(frame_idx).asnumpy()
-        return spare_frames  # (frames, height, width, channels)
-
     def tok_decode(self, tokens):
         return self.tokenizer.decode(tokens)
 
-    def loglikelihood(self, requests: List[Instance]) -> List[Tuple[float, bool]]:
-        res = []
-        pbar = tqdm(total=len(requests), disable=(self.rank != 0), desc="Model Responding")
-
-        for contexts, doc_to_target, doc_to_visual, doc_id, task, split in [reg.args for reg in requests]:
-            # encode, pad, and truncate contexts for this batch
-            if type(doc_to_target) == str:
-                continuation = doc_to_target
-            else:
-                continuation = doc_to_target(self.task_dict[task][split][doc_id])
-            visuals = [doc_to_visual(self.task_dict[task][split][doc_id])]
-            visuals = self.flatten(visuals)
-            videos = []
-            for visual in visuals:
-                video = self.load_video(visual, self.max_frames_num)
-                video = self._image_processor.preprocess(video, return_tensors="pt")["pixel_values"].half().cuda()
-                videos.append(video)
-
-            qs = contexts
-            if self.model.config.mm_use_im_start_end:
-                qs = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + "\n" + qs
-            else:
-                qs = DEFAULT_IMAGE_TOKEN + "\n" + qs
-
-            conv = conv_templates[self.conv_template].copy()
-            conv.append_message(conv.roles[0], qs)
-            conv.append_message(conv.roles[1], None)
-            prompt = conv.get_prompt()
-
-            contxt_id = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).to(self.device)
-
-            conv = conv_templates[self.conv_template].copy()
-            conv.append_message(conv.roles[0], qs)
-            conv.append_message(conv.roles[1], continuation)
-            prompt = conv.get_prompt()
-
-            input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).cuda()
-            attention_masks = input_ids.ne(self.tokenizer.pad_token_id).long().cuda()
-
-            labels = input_ids.clone()
-            # Context part no need to calculate for loss
-            labels[0, : contxt_id.shape[1]] = -100
-
-            with torch.inference_mode():
-                outputs = self.model(input_ids=input_ids, labels=labels, images=videos, modalities="video")
-
-            loss = outputs["loss"]
-            # loss = torch.exp(loss)
-            logits = outputs["logits"]
-            greedy_tokens = logits.argmax(dim=-1)
-            cont_toks = input_ids[:, contxt_id.shape[1] :]  # [1, seq]
-            greedy_tokens = greedy_tokens[:, contxt_id.shape[1] : input_ids.shape[1]]  # [1, seq]
-            max_equal = (greedy_tokens == cont_toks).all()
-            res.append((float(loss.item()), bool(max_equal)))
-            pbar.update(1)
-        pbar.close()
-        return res
-
     def flatten(self, input):
         new_list = []
         for i in input:
@@ -352,49 +347,28 @@ class LlavaVid(lmms):
 
     def generate_until(self, requests) -> List[str]:
         res = []
+        if self.batch_size > 1:
+            return self.generate_until_batched(requests)
         pbar = tqdm(total=len(requests), disable=(self.rank != 0), desc="Model Responding")
 
-        for contexts, gen_kwargs, doc_to_visual, doc_id, task, split in [reg.args for reg in requests]:
+        requests_args = [reg.args for reg in requests]
+        # decode and preprocess the next requests' videos on worker threads while the GPU generates
+        prefetched = prefetch_map(self.load_videos, (self.resolve_visuals(args) for args in requests_args), depth=self.prefetch_depth, num_workers=self.prefetch_workers)
+        for (contexts, gen_kwargs, doc_to_visual, doc_id, task, split), (visuals, videos, error) in zip(requests_args, prefetched):
             # encode, pad, and truncate contexts for this batch
-            visuals = [doc_to_visual(self.task_dict[task][split][doc_id])]
-            if visuals != [None]:
-                visuals = self.flatten(visuals)
-                videos = []
-                try:
-                    for visual in visuals:
-                        if self.video_decode_backend == "decord":
-                            video = self.load_video(visual, self.max_frames_num)
-                        elif self.video_decode_backend == "pyav":
-                            video = read_video_pyav(visual, num_frm=self.max_frames_num)
-                        # video = self.load_video(visual, self.max_frames_num)
-                        video = self._image_processor.preprocess(video, return_tensors="pt")["pixel_values"].half().cuda()
-                        videos.append(video)
-                except Exception as e:
-                    eval_logger.info(f"{e}")
+            if visuals is not None:
+                if error is not None:
+                    eval_logger.info(f"{error}")
                     eval_logger.info(f"Video {visuals} can not load, check the source")
                     video_path = "\n".join(visuals)
                     res.append(f"Video {video_path} can not load, check the source")
                     pbar.update(1)
                     continue
-
-                qs = contexts
-                if self.model.config.mm_use_im_start_end:
-                    qs = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + "\n" + qs
-                else:
-                    qs = DEFAULT_IMAGE_TOKEN * len(videos) + "\n" + qs
+                videos = [video.cuda() for video in videos]
             else:
                 videos = None
-                qs = contexts
-
-            # This is much safer for llama3, as we now have some object type in it
-            if "llama_3" in self.conv_template:
-                conv = copy.deepcopy(conv_templates[self.conv_template])
-            else:
-                conv = conv_templates[self.conv_template].copy()
 
-            conv.append_message(conv.roles[0], qs)
-            conv.append_message(conv.roles[1], None)
-            prompt = conv.get_prompt()
+            prompt, stop_str = self.build_prompt(contexts, len(videos) if videos is not None else 0)
 
             input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).cuda()
             pad_token_ids = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
@@ -402,9 +376,8 @@ class LlavaVid(lmms):
                 pad_token_ids = 0  # lmms-lab/llama3-llava-8b is trained on this pad token id. You may need to customize this for other models.
             attention_masks = input_ids.ne(pad_token_ids).long().cuda()
 
-            stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
-            keywords = [stop_str]
-            stopping_criteria = KeywordsStoppingCriteria(keywords, self.tokenizer, input_ids)
+            # llava's generate runs on inputs_embeds, so the returned ids are only the new tokens
+            stopping_criteria = utils.StopSequenceCriteria([stop_str], self.tokenizer)
 
             cur_prompt = contexts
 
@@ -416,7 +389,16 @@ class LlavaVid(lmms):
                 gen_kwargs["top_p"] = None
             if "num_beams" not in gen_kwargs:
                 gen_kwargs["num_beams"] = 1
-            with torch.inference_mode():
+            options = self.doc_options(task, split, doc_id) if gen_kwargs.get("option_scoring") else None
+            if options:
+                # multiple-choice: one forward pass over the prompt, the answer is the most likely option letter
+                with torch.inference_mode(), self.feature_scope(visuals, videos):
+                    res.append(self.score_options(input_ids, attention_masks, videos, [options])[0])
+                pbar.update(1)
+                continue
+            # open questions are constrained to a single number when numeric_answer is set
+            logits_processor = LogitsProcessorList([self.numeric_logits_processor(stop_str)]) if gen_kwargs.get("numeric_answer") and not self.doc_options(task, split, doc_id) else None
+            with torch.inference_mode(), self.feature_scope(visuals, videos):
                 output_ids = self.model.generate(
                     inputs=input_ids,
                     images=videos,
@@ -429,6 +411,7 @@ class LlavaVid(lmms):
                     top_p=gen_kwargs["top_p"],
                     num_beams=gen_kwargs["num_beams"],
                     max_new_tokens=gen_kwargs["max_new_tokens"],
+                    logits_processor=logits_processor,
                 )
                 # output_ids = model.generate(inputs=input_ids, images=video, attention_mask=attention_masks, modalities="video", do_sample=True, temperature=0.2, use_cache=True, stopping_criteria=[stopping_criteria])
 
@@ -0,0 +1,87 @@
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, TypeVar
+
+import torch
+from loguru import logger as eval_logger
+
+T = TypeVar("T")
+
+DEFAULT_MAX_BATCH_SIZE = 64
+
+
+def is_auto_batch_size(batch_size) -> bool:
+    """True for batch_size="auto". The "auto:N" form of other harnesses (re-detect the size N times) is rejected."""
+    if not isinstance(batch_size, str) or not batch_size.startswith("auto"):
+        return False
+    if batch_size != "auto":
+        raise ValueError(f"batch_size={batch_size} is not supported, use batch_size=auto (batches adapt to the token budget) with --max_batch_size")
+    return True
+
+
+def is_oom(error: BaseException) -> bool:
+    if isinstance(error, getattr(torch.cuda, "OutOfMemoryError", ())):
+        return True
+    return isinstance(error, RuntimeError) and "out of memory" in str(error)
+
+
+class TokenBudgetBatcher:
+    """
+    Dynamic batching for `--batch_size auto`: consecutive requests are batched while their
+    estimated token cost (visual tokens plus prompt tokens) stays within `token_budget`, and at
+    most `max_batch_size` requests go in a batch. A request above the budget on its own still
+    forms a batch of one.
+
+    `run` calls the model on a batch and, on CUDA out-of-memory, halves the batch and retries
+    each half, down to single requests; the budget is lowered to half the cost that failed, so
+    later batches, including ones already formed, start smaller. No request is dropped: the
+    results come back in the batch's order. The sizes of the batches that ran are kept per
+    request type in `batch_sizes`.
+    """
+
+    def __init__(self, token_budget: int, max_batch_size: Optional[int] = None) -> None:
+        self.token_budget = int(token_budget)
+        self.max_batch_size = int(max_batch_size or DEFAULT_MAX_BATCH_SIZE)
+        self.batch_sizes = {}
+
+    def batches(self, items: Iterable[T], cost_fn: Callable[[T], int]) -> Iterator[List[T]]:
+        """Split `items` into consecutive batches; lazy, so budget reductions apply to the batches not yielded yet."""
+        batch, batch_cost = [], 0
+        for item in items:
+            cost = cost_fn(item)
+            if batch and (batch_cost + cost > self.token_budget or len(batch) >= self.max_batch_size):
+                yield batch
+                batch, batch_cost = [], 0
+            batch.append(item)
+            batch_cost += cost
+        if batch:
+            yield batch
+
+    def run(self, batch: Sequence[T], fn: Callable[[Sequence[T]], List], cost_fn: Callable[[T], int], request_type: str = "generate_until") -> List:
+        """
+        Results of `fn` over `batch`, in order. A batch formed (e.g. prefetched) before the budget
+        was lowered is first split again to the current budget.
+        """
+        results = []
+        for part in self.batches(batch, cost_fn):
+            results.extend(self._run(part, fn, cost_fn, request_type))
+        return results
+
+    def _run(self, batch: Sequence[T], fn: Callable[[Sequence[T]], List], cost_fn: Callable[[T], int], request_type: str) -> List:
+        try:
+            results = fn(batch)
+        except Exception as e:
+            if not is_oom(e) or len(batch) == 1:
+                raise
+            results = None
+        if results is None:
+            # retried outside the except block, so the failed attempt's traceback and activations are freed first
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            batch_cost = sum(cost_fn(item) for item in batch)
+            self.token_budget = min(self.token_budget, max(1, batch_cost // 2))
+            eval_logger.warning(f"Out of memory on a batch of {len(batch)} ({batch_cost} tokens), retrying in halves with a token budget of {self.token_budget}")
+            half = len(batch) // 2
+            return self._run(batch[:half], fn, cost_fn, request_type) + self._run(batch[half:], fn, cost_fn, request_type)
+        sizes = self.batch_sizes.setdefault(request_type, [])
+        if len(batch) not in sizes:
+            sizes.append(len(batch))
+        return results
@@ -0,0 +1,108 @@
+import re
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import torch
+from transformers import LogitsProcessor
+
+OPTION_LETTER_PATTERN = re.compile(r"^\s*\(?([A-Za-z])\s*[\.\):]")
+
+
+def option_letters(options: Sequence[str]) -> List[str]:
+    """Letters of multiple-choice options such as "A. chair" or "(B) table"; positional letters for unlabeled options."""
+    letters = []
+    for i, option in enumerate(options):
+        match = OPTION_LETTER_PATTERN.match(str(option))
+        letters.append(match.group(1).upper() if match else chr(ord("A") + i))
+    return letters
+
+
+def option_token_ids(tokenizer, letters: Sequence[str]) -> List[List[int]]:
+    """
+    Candidate first tokens of each letter as the model may emit it right after the assistant turn
+    starts: the bare letter and the letter after a space. A letter's score is the max over them.
+    """
+    token_ids = []
+    for letter in letters:
+        candidates = set()
+        for text in (letter, " " + letter):
+            ids = tokenizer.encode(text, add_special_tokens=False)
+            if ids:
+                candidates.add(ids[0])
+        token_ids.append(sorted(candidates))
+    return token_ids
+
+
+NUMBER_CHARS = set("0123456789.-")
+PARTIAL_NUMBER_PATTERN = re.compile(r"-?\d*\.?\d*")
+COMPLETE_NUMBER_PATTERN = re.compile(r"-?\d+(\.\d+)?")
+
+
+def numeric_vocab(tokenizer) -> Dict[int, str]:
+    """Token id -> text of every token made only of digits, "." and "-", optionally after leading whitespace."""
+    texts = tokenizer.batch_decode([[token_id] for token_id in range(len(tokenizer))])
+    vocab = {}
+    for token_id, text in enumerate(texts):
+        stripped = text.lstrip()
+        if stripped and set(stripped) <= NUMBER_CHARS:
+            vocab[token_id] = text
+    return vocab
+
+
+class NumericLogitsProcessor(LogitsProcessor):
+    """
+    Restrict generation to a single number: only tokens that keep the generated text a prefix of a
+    number (leading whitespace allowed on the first token) are allowed, and the EOS tokens become
+    allowed as soon as the text is a complete number, so the answer ends right after it.
+
+    Which tokens may follow only depends on whether the number has started and whether it already
+    has a ".", so the allowed tokens of these three states are precomputed as masks over the vocab
+    and each step only picks a mask per row. The generated part starts wherever `input_ids` ended
+    on the first call, which covers both `generate` with input ids and with inputs_embeds. `rows`
+    limits the constraint to some rows of the batch, the others are left untouched.
+    """
+
+    # a representative generated text per state: nothing yet, a number without ".", a number with "."
+    STATES = ("", "0", "0.")
+
+    def __init__(self, vocab: Dict[int, str], eos_token_ids: Iterable[int], rows: Optional[Sequence[bool]] = None) -> None:
+        self.vocab = vocab
+        self.eos_token_ids = [token_id for token_id in eos_token_ids if token_id is not None]
+        self.rows = rows
+        self.start = None
+        self._masks = None
+
+    def state_masks(self, vocab_size: int, device) -> torch.BoolTensor:
+        """(len(STATES), vocab_size) masks of the tokens allowed in each state."""
+        if self._masks is None or self._masks.shape[1] != vocab_size or self._masks.device != torch.device(device):
+            masks = torch.zeros((len(self.STATES), vocab_size), dtype=torch.bool)
+            for token_id, piece in self.vocab.items():
+                if token_id < vocab_size:
+                    for state, text in enumerate(self.STATES):
+                        masks[state, token_id] = self._valid(text, piece)
+            self._masks = masks.to(device)
+        return self._masks
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.start is None:
+            self.start = input_ids.shape[1]
+        states, complete = [], []
+        for generated in input_ids[:, self.start :].tolist():
+            text = "".join(self.vocab.get(token_id, "") for token_id in generated)
+            states.append(0 if not text else 2 if "." in text else 1)
+            complete.append(COMPLETE_NUMBER_PATTERN.fullmatch(text.strip()) is not None)
+        allowed = self.state_masks(scores.shape[1], scores.device)[torch.tensor(states, device=scores.device)]
+        eos_token_ids = torch.tensor(self.eos_token_ids, dtype=torch.long, device=scores.device)
+        complete = torch.tensor(complete, device=scores.device)
+        # cannot happen with a sane vocab, but never leave a row without a choice
+        complete |= ~allowed.any(dim=1)
+        allowed[:, eos_token_ids] |= complete.unsqueeze(1)
+        if self.rows is not None:
+            allowed[~torch.tensor(list(self.rows), dtype=torch.bool, device=scores.device)] = True
+        return scores.masked_fill(~allowed, float("-inf"))
+
+    @staticmethod
+    def _valid(text: str, piece: str) -> bool:
+        if text and piece[:1].isspace():
+            return False
+        candidate = (text + piece).lstrip()
+        return bool(candidate) and PARTIAL_NUMBER_PATTERN.fullmatch(candidate) is not None
@@ -0,0 +1,194 @@
+import contextlib
+import functools
+import glob
+import hashlib
+import json
+import os
+from typing import Hashable, Iterable, Optional, Sequence, Tuple
+
+import torch
+from loguru import logger as eval_logger
+
+from lmms_eval.models.model_utils.pixel_cache import TensorCache, build_tensor_cache
+
+CHECKPOINT_FILE_PATTERNS = ("*.safetensors", "*.bin", "*.json")
+
+
+def checkpoint_hash(pretrained: str, **config) -> str:
+    """
+    Hash of a checkpoint and of the load-time options that change its vision features (pooling
+    stride and mode, model base, ...). Local checkpoints are identified by the name, size and mtime
+    of their weight and config files, hub ids by the resolved snapshot when it is in the local cache.
+    """
+    path = os.path.expanduser(pretrained)
+    if not os.path.isdir(path):
+        try:
+            from huggingface_hub import snapshot_download
+
+            path = snapshot_download(pretrained, local_files_only=True)
+        except Exception:
+            path = None
+    files = []
+    if path is not None:
+        for pattern in CHECKPOINT_FILE_PATTERNS:
+            for file in sorted(glob.glob(os.path.join(path, pattern))):
+                stat = os.stat(file)
+                files.append((os.path.basename(file), stat.st_size, int(stat.st_mtime)))
+    payload = {"pretrained": pretrained, "snapshot": os.path.basename(path) if path else None, "files": files, "config": config}
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+class VisionFeatureCache:
+    """
+    Cache of the outputs of a model's vision methods (vision tower + projector, spatial pooling,
+    the 3D branch of VLM-3R, ...), which depend only on the video frames and the checkpoint.
+
+    `wrap` replaces the named methods on the model instance. Calls made inside a `scope(key)` are
+    looked up by (checkpoint hash, scope key, method, call index, input shape), so the n-th call of
+    a method while handling a video always maps to the same entry; calls outside a scope, or with
+    a `None` key, run the original method untouched. Entries live on the CPU (in memory and
+    optionally on disk, see `TensorCache`) and are moved back to the device of the first tensor
+    argument on a hit.
+
+    A batch of videos is scoped with `scope(keys, lengths)`, one key and frame count per video, so
+    each video is cached on its own whatever batch it comes in. A call on the frames of the whole
+    batch concatenated along dim 0 (LLaVA encodes all videos at once) is split per video: only
+    the videos not cached yet, each once even if repeated in the batch, go through the method. A
+    call on the frames of one video (e.g. per-video pooling) is matched to the next video of the
+    batch with that frame count. Other calls are keyed on the whole batch. Per-video caching thus
+    assumes the method treats frames independently, as vision towers, projectors and pooling do;
+    a method found to return anything else is keyed on the whole batch from then on.
+    """
+
+    def __init__(self, cache: TensorCache, checkpoint: str = "") -> None:
+        self.cache = cache
+        self.checkpoint = checkpoint
+        self._scope_key: Optional[Hashable] = None
+        self._lengths: Optional[Tuple[int, ...]] = None
+        self._calls = {}
+        self._unsplittable = set()
+
+    @property
+    def hits(self) -> int:
+        return self.cache.hits
+
+    @property
+    def misses(self) -> int:
+        return self.cache.misses
+
+    def wrap(self, model, method_names: Iterable[str]) -> None:
+        for name in method_names:
+            method = getattr(model, name, None)
+            if method is None:
+                eval_logger.warning(f"Feature cache: {type(model).__name__} has no method {name}, it will not be cached")
+                continue
+            setattr(model, name, self._cached(name, method))
+
+    @contextlib.contextmanager
+    def scope(self, key: Optional[Hashable], lengths: Optional[Sequence[int]] = None):
+        if lengths is not None and (key is None or len(key) != len(lengths)):
+            raise ValueError(f"Feature cache: scope got {len(lengths)} frame counts for keys {key}")
+        self._scope_key, self._lengths, self._calls = key, None if lengths is None else tuple(lengths), {}
+        try:
+            yield self
+        finally:
+            self._scope_key, self._lengths, self._calls = None, None, {}
+
+    def _next_call(self, counter: Hashable) -> int:
+        call_index = self._calls.get(counter, 0)
+        self._calls[counter] = call_index + 1
+        return call_index
+
+    def _cached(self, name: str, method):
+        def output_to_cpu(output):
+            if not torch.is_tensor(output):
+                raise TypeError(f"Feature cache: {name} returned {type(output).__name__}, only tensor outputs can be cached")
+            return output.detach().to("cpu")
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if self._scope_key is None:
+                return method(*args, **kwargs)
+            tensors = [arg for arg in list(args) + list(kwargs.values()) if torch.is_tensor(arg)]
+            leading = {tensor.shape[0] if tensor.dim() else None for tensor in tensors}
+            if self._lengths is not None and name not in self._unsplittable and leading == {sum(self._lengths)}:
+                return self._call_per_video(name, method, args, kwargs, output_to_cpu)
+            if self._lengths is not None and len(leading) == 1:
+                position = self._calls.get((name, "video"), 0)
+                if position < len(self._lengths) and leading == {self._lengths[position]}:
+                    self._calls[(name, "video")] = position + 1
+                    key = (self.checkpoint, self._scope_key[position], name, self._next_call((name, position)), tuple(tuple(tensor.shape) for tensor in tensors))
+                    return self._lookup(key, lambda: method(*args, **kwargs), tensors, output_to_cpu)
+            shapes = tuple(tuple(tensor.shape) for tensor in tensors)
+            key = (self.checkpoint, self._scope_key, name, self._next_call(name), shapes)
+            return self._lookup(key, lambda: method(*args, **kwargs), tensors, output_to_cpu)
+
+        return wrapper
+
+    def _lookup(self, key, compute, tensors, output_to_cpu):
+        computed = []
+
+        def load():
+            computed.append(compute())
+            return output_to_cpu(computed[0])
+
+        output = self.cache.get_or_load(key, load)
+        if computed:
+            return computed[0]
+        device = tensors[0].device if tensors else output.device
+        return output.to(device, non_blocking=True)
+
+    def _call_per_video(self, name, method, args, kwargs, output_to_cpu):
+        """A call on the concatenated frames of every video in the scope, cached per video."""
+        bounds = [0]
+        for length in self._lengths:
+            bounds.append(bounds[-1] + length)
+        slices = [slice(start, end) for start, end in zip(bounds, bounds[1:])]
+        tensors = [arg for arg in list(args) + list(kwargs.values()) if torch.is_tensor(arg)]
+        keys = []
+        for position, (video_key, rows) in enumerate(zip(self._scope_key, slices)):
+            shapes = tuple(tuple(tensor[rows].shape) for tensor in tensors)
+            keys.append((self.checkpoint, video_key, name, self._next_call((name, position)), shapes))
+
+        outputs, missing = {}, {}
+        for key, rows in zip(keys, slices):
+            if key in outputs or key in missing:
+                continue
+            output = self.cache.get(key)
+            if output is None:
+                missing[key] = rows
+            else:
+                outputs[key] = output.to(tensors[0].device, non_blocking=True)
+        if missing:
+            # run the method once on the frames of the videos that were not cached
+            select = lambda arg: torch.cat([arg[rows] for rows in missing.values()]) if torch.is_tensor(arg) else arg
+            computed = method(*[select(arg) for arg in args], **{k: select(v) for k, v in kwargs.items()})
+            lengths = [rows.stop - rows.start for rows in missing.values()]
+            if not torch.is_tensor(computed) or computed.dim() == 0 or computed.shape[0] != sum(lengths):
+                # from now on keyed on the whole batch, like calls that do not split per video
+                self._unsplittable.add(name)
+                eval_logger.warning(f"Feature cache: {name} does not return one output per frame, it is cached per batch of videos")
+                shapes = tuple(tuple(tensor.shape) for tensor in tensors)
+                key = (self.checkpoint, self._scope_key, name, self._next_call(name), shapes)
+                computed_all = len(missing) == len(keys)
+                return self._lookup(key, lambda: computed if computed_all else method(*args, **kwargs), tensors, output_to_cpu)
+            for key, output in zip(missing, computed.split(lengths)):
+                # a copy, so a CPU entry does not keep the whole batch's output alive
+                self.cache.put(key, output_to_cpu(output).clone() if output.device.type == "cpu" else output_to_cpu(output))
+                outputs[key] = output
+        if len(keys) == 1:
+            return outputs[keys[0]]
+        return torch.cat([outputs[key] for key in keys])
+
+
+def build_feature_cache(model, method_names: str, feature_cache_dir: Optional[str], feature_cache_mb, checkpoint: str) -> Optional[VisionFeatureCache]:
+    """
+    Wrap the `method_names` of `model` from the `feature_cache_*` model args; disabled when neither a
+    directory nor a budget is set. Names are separated by "+", since model args are comma separated.
+    """
+    cache = build_tensor_cache(feature_cache_dir, feature_cache_mb)
+    if cache is None:
+        return None
+    feature_cache = VisionFeatureCache(cache, checkpoint=checkpoint)
+    feature_cache.wrap(model, [name.strip() for name in method_names.split("+") if name.strip()])
+    return feature_cache
@@ -0,0 +1,94 @@
+import collections
+import os
+import threading
+from typing import Any, Hashable, Optional, Tuple
+
+import numpy as np
+
+
+def make_frame_key(video_path: str, sampling: Hashable, backend: str) -> Tuple:
+    """
+    Build the cache key for a decoded clip.
+
+    The key binds the file identity (resolved path, mtime and size) to the sampling
+    description and the decode backend, so a re-encoded or replaced video never hits
+    a stale entry. `sampling` is either the explicit frame indices or a hashable
+    description from which they are derived deterministically (e.g. ("uniform", 32)).
+    """
+    stat = os.stat(video_path)
+    if isinstance(sampling, np.ndarray):
+        sampling = tuple(sampling.tolist())
+    elif isinstance(sampling, list):
+        sampling = tuple(sampling)
+    return (os.path.realpath(video_path), stat.st_mtime_ns, stat.st_size, sampling, backend)
+
+
+class FrameCache:
+    """
+    In-process LRU cache of decoded uint8 frame arrays, bounded by a byte budget.
+
+    Entries are stored read-only so a caller cannot corrupt frames shared with later
+    questions about the same video. An array larger than the whole budget is never
+    cached.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = int(max_bytes)
+        self._entries: "collections.OrderedDict[Hashable, np.ndarray]" = collections.OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            frames = self._entries.get(key)
+            if frames is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return frames
+
+    def put(self, key: Hashable, frames: np.ndarray) -> np.ndarray:
+        if frames.nbytes > self.max_bytes:
+            return frames
+        frames.setflags(write=False)
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key).nbytes
+            self._entries[key] = frames
+            self._nbytes += frames.nbytes
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+        return frames
+
+    def get_or_load(self, key: Hashable, load_fn: Any) -> np.ndarray:
+        frames = self.get(key)
+        if frames is None:
+            frames = self.put(key, np.ascontiguousarray(load_fn()))
+        return frames
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+
+def build_frame_cache(frame_cache_mb) -> Optional[FrameCache]:
+    """Create a FrameCache from a `frame_cache_mb` model arg; 0 or None disables caching."""
+    frame_cache_mb = int(frame_cache_mb or 0)
+    if frame_cache_mb <= 0:
+        return None
+    return FrameCache(max_bytes=frame_cache_mb * 1024 * 1024)
@@ -0,0 +1,91 @@
+import base64
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Hashable, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from lmms_eval.models.model_utils.frame_cache import make_frame_key
+
+MIME_TYPES = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+
+
+class FrameEncoder:
+    """
+    Base64 image encoder shared by the API models.
+
+    Frames of a video are encoded on a thread pool (PIL releases the GIL while compressing), and
+    the payloads of a video are memoized by (video file, sampling, format, quality) with LRU
+    eviction bounded by the total payload size, so further questions on the same video skip both
+    decoding and encoding. `mime_type` always matches the encoded bytes.
+    """
+
+    def __init__(self, image_format: str = "PNG", quality: int = 90, num_workers: int = 4, memo_mb: int = 256) -> None:
+        image_format = image_format.upper().replace("JPG", "JPEG")
+        if image_format not in MIME_TYPES:
+            raise ValueError(f"Unsupported frame format {image_format}, expected one of {list(MIME_TYPES)}")
+        self.image_format = image_format
+        self.quality = int(quality)
+        self.num_workers = int(num_workers)
+        self.memo_bytes = int(memo_mb) * 1024 * 1024
+        self._memo: "collections.OrderedDict[Hashable, List[str]]" = collections.OrderedDict()
+        self._memo_size = 0
+        self._lock = threading.Lock()
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def mime_type(self) -> str:
+        return MIME_TYPES[self.image_format]
+
+    def data_url(self, base64_str: str) -> str:
+        return f"data:{self.mime_type};base64,{base64_str}"
+
+    def encode_image(self, image: Image.Image) -> str:
+        if self.image_format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        output_buffer = BytesIO()
+        if self.image_format == "PNG":
+            image.save(output_buffer, format="PNG")
+        else:
+            image.save(output_buffer, format=self.image_format, quality=self.quality)
+        return base64.b64encode(output_buffer.getvalue()).decode("utf-8")
+
+    def encode_frames(self, frames: np.ndarray) -> List[str]:
+        images = [Image.fromarray(frame) for frame in frames]
+        if self.num_workers <= 1 or len(images) <= 1:
+            return [self.encode_image(image) for image in images]
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="lmms_eval_encode")
+        return list(self._pool.map(self.encode_image, images))
+
+    def encode_video(self, video_source, video_path: str, num_frames: int, sampling: str = "uniform") -> List[str]:
+        """Sample `num_frames` frames of `video_path` through `video_source` and return their base64 payloads."""
+        key = (make_frame_key(video_path, (sampling, num_frames), video_source.backend), self.image_format, self.quality)
+        with self._lock:
+            payloads = self._memo.get(key)
+            if payloads is not None:
+                self._memo.move_to_end(key)
+                return payloads
+        payloads = self.encode_frames(video_source.sample(video_path, num_frames, sampling))
+        self._remember(key, payloads)
+        return payloads
+
+    def _remember(self, key: Hashable, payloads: List[str]) -> None:
+        size = sum(len(payload) for payload in payloads)
+        if size > self.memo_bytes:
+            return
+        with self._lock:
+            if key in self._memo:
+                return
+            self._memo[key] = payloads
+            self._memo_size += size
+            while self._memo_size > self.memo_bytes:
+                _, evicted = self._memo.popitem(last=False)
+                self._memo_size -= sum(len(payload) for payload in evicted)
@@ -0,0 +1,152 @@
+import json
+import os
+import tempfile
+import threading
+from typing import Dict, Optional
+
+import numpy as np
+from loguru import logger as eval_logger
+
+FRAME_STORE_VERSION = 1
+INDEX_NAME = "index.json"
+SHARD_TEMPLATE = "frames-{:05d}.bin"
+
+# Sampling policies a store can be materialized with, matching the decode paths of the models:
+# "uniform" is np.linspace over all frames (decord load_video), "uniform_with_last" additionally
+# appends the last frame when linspace misses it (read_video_pyav).
+SAMPLING_POLICIES = ("uniform", "uniform_with_last")
+
+
+def frame_store_key(video_path: str, root: str) -> str:
+    """Videos are indexed by their path relative to the dataset cache dir, so a store survives moving HF_HOME."""
+    return os.path.relpath(os.path.realpath(video_path), os.path.realpath(root))
+
+
+class FrameStore:
+    """
+    Read-only view of frames materialized by `tools/materialize_frames.py`.
+
+    The store is a directory of raw uint8 shards plus an `index.json` mapping each video to
+    (shard, byte offset, shape). Shards are memory-mapped once and `get` returns a zero-copy
+    (T, H, W, 3) view, so no MP4 is decoded at evaluation time.
+    """
+
+    def __init__(self, store_dir: str) -> None:
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_NAME), "r") as f:
+            index = json.load(f)
+        if index.get("version") != FRAME_STORE_VERSION:
+            raise ValueError(f"Unsupported frame store version {index.get('version')} in {store_dir}")
+        self.root = index["root"]
+        self.sampling = index["sampling"]
+        self.max_frames_num = int(index["max_frames_num"])
+        self.entries: Dict[str, dict] = index["entries"]
+        self._shards: Dict[str, np.memmap] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def matches(self, max_frames_num: int, sampling: str) -> bool:
+        return self.max_frames_num == int(max_frames_num) and self.sampling == sampling
+
+    def _shard(self, name: str) -> np.memmap:
+        with self._lock:
+            shard = self._shards.get(name)
+            if shard is None:
+                shard = np.memmap(os.path.join(self.store_dir, name), dtype=np.uint8, mode="r")
+                self._shards[name] = shard
+            return shard
+
+    def get(self, video_path: str) -> Optional[np.ndarray]:
+        entry = self.entries.get(frame_store_key(video_path, self.root))
+        if entry is None:
+            return None
+        shape = tuple(entry["shape"])
+        start = entry["offset"]
+        return self._shard(entry["shard"])[start : start + int(np.prod(shape))].reshape(shape)
+
+
+class FrameStoreWriter:
+    """
+    Append decoded clips to size-bounded shards and write the index on `close`.
+
+    Opening an existing store resumes it: videos already indexed are reported by `__contains__`
+    and new frames go to fresh shards, so an interrupted materialization can be restarted.
+    """
+
+    def __init__(self, store_dir: str, root: str, max_frames_num: int, sampling: str, shard_bytes: int = 4 * 1024**3) -> None:
+        if sampling not in SAMPLING_POLICIES:
+            raise ValueError(f"Unknown sampling policy {sampling}, expected one of {SAMPLING_POLICIES}")
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.root = root
+        self.max_frames_num = int(max_frames_num)
+        self.sampling = sampling
+        self.shard_bytes = int(shard_bytes)
+        self.entries: Dict[str, dict] = {}
+
+        index_path = os.path.join(store_dir, INDEX_NAME)
+        if os.path.exists(index_path):
+            existing = FrameStore(store_dir)
+            if not existing.matches(max_frames_num, sampling):
+                raise ValueError(f"{store_dir} holds {existing.sampling} frames with max_frames_num={existing.max_frames_num}, refusing to mix in {sampling}/{max_frames_num}")
+            self.entries = existing.entries
+        used_shards = {entry["shard"] for entry in self.entries.values()}
+        self._shard_id = len(used_shards)
+        while os.path.exists(os.path.join(store_dir, SHARD_TEMPLATE.format(self._shard_id))):
+            self._shard_id += 1
+        self._file = None
+        self._offset = 0
+
+    def __contains__(self, video_path: str) -> bool:
+        return frame_store_key(video_path, self.root) in self.entries
+
+    def add(self, video_path: str, frames: np.ndarray) -> None:
+        frames = np.ascontiguousarray(frames, dtype=np.uint8)
+        if self._file is None or (self._offset > 0 and self._offset + frames.nbytes > self.shard_bytes):
+            self._next_shard()
+        self._file.write(frames.tobytes())
+        self.entries[frame_store_key(video_path, self.root)] = {
+            "shard": SHARD_TEMPLATE.format(self._shard_id),
+            "offset": self._offset,
+            "shape": list(frames.shape),
+        }
+        self._offset += frames.nbytes
+
+    def _next_shard(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._shard_id += 1
+        self._file = open(os.path.join(self.store_dir, SHARD_TEMPLATE.format(self._shard_id)), "wb")
+        self._offset = 0
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        index = {
+            "version": FRAME_STORE_VERSION,
+            "root": self.root,
+            "sampling": self.sampling,
+            "max_frames_num": self.max_frames_num,
+            "entries": self.entries,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.store_dir, prefix=".index-", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        # mkstemp creates the file 0600, a store is usually shared with other users' runs
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, os.path.join(self.store_dir, INDEX_NAME))
+
+
+def load_frame_store(store_dir: Optional[str], max_frames_num: int, sampling: str) -> Optional[FrameStore]:
+    """Open the store passed as the `frame_store=` model arg, ignoring it when it was materialized with other sampling."""
+    if not store_dir:
+        return None
+    store = FrameStore(os.path.expanduser(store_dir))
+    if not store.matches(max_frames_num, sampling):
+        eval_logger.warning(f"Frame store {store_dir} holds {store.sampling} frames with max_frames_num={store.max_frames_num}, " f"but the model samples {sampling} with max_frames_num={max_frames_num}; videos will be decoded instead")
+        return None
+    eval_logger.info(f"Reading frames of {len(store)} videos from frame store {store_dir}")
+    return store
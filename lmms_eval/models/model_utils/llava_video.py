@@ -0,0 +1,395 @@
+import collections
+import contextlib
+import copy
+import functools
+from typing import List, Tuple
+
+import torch
+from loguru import logger as eval_logger
+from tqdm import tqdm
+from transformers import LogitsProcessorList
+
+from lmms_eval import utils
+from lmms_eval.api.instance import Instance
+from lmms_eval.models.model_utils.constrained import (
+    NumericLogitsProcessor,
+    numeric_vocab,
+    option_letters,
+    option_token_ids,
+)
+from lmms_eval.models.model_utils.frame_cache import make_frame_key
+from lmms_eval.models.model_utils.load_video import check_decode_resize
+from lmms_eval.models.model_utils.prefetch import prefetch_map
+from lmms_eval.models.model_utils.prefix_cache import repeat_past_key_values
+from lmms_eval.models.model_utils.video_source import VideoSource
+
+# Resolved from the LLaVA code base the importing model put on sys.path (LLaVA-NeXT, VLM-3R, ...)
+try:
+    from llava.constants import (
+        DEFAULT_IM_END_TOKEN,
+        DEFAULT_IM_START_TOKEN,
+        DEFAULT_IMAGE_TOKEN,
+        IMAGE_TOKEN_INDEX,
+    )
+    from llava.conversation import SeparatorStyle, conv_templates
+    from llava.mm_utils import tokenizer_image_token
+except ImportError:
+    eval_logger.debug("LLaVA is not installed. Please install LLaVA-NeXT to use the LLaVA video models.")
+
+
+class LlavaVideoMixin:
+    """
+    Video decoding, caching, prompting, scoring and batched generation shared by the LLaVA video
+    models (LlavaVid, Vlm3r). The model sets up, in its __init__: `video_source`, `video_sampling`,
+    `video_decode_backend`, `max_frames_num`, `decode_size` (with `decode_resize_tolerance`,
+    `_decode_resize_checked` and `_decode_resize_lock`), `pixel_cache`, `_image_processor_hash`,
+    `feature_cache`, `_numeric_vocab`, `auto_batch`, `visual_tokens_per_frame`, `prefetch_depth`,
+    `prefetch_workers` and `conv_template`, next to the usual lmms properties.
+
+    Generation samples frames with `video_sampling` through `video_source`. Loglikelihood keeps
+    the decoding the models scored with before `VideoSource`: `max_frames_num` frames sampled
+    uniformly by decord at native resolution, whatever `video_decode_backend` is.
+    """
+
+    SCORING_BACKEND = "decord"
+    SCORING_SAMPLING = "uniform"
+
+    @property
+    def scoring_source(self):
+        """`VideoSource` of loglikelihood, sharing the frame caches and frame store of `video_source`."""
+        if getattr(self, "_scoring_source", None) is None:
+            source = self.video_source
+            self._scoring_source = VideoSource(backend=self.SCORING_BACKEND, frame_cache=source.frame_cache, frame_store=source.frame_store, shared_cache=source.shared_cache)
+        return self._scoring_source
+
+    def decode_video(self, video_path, decode_size=None):
+        return self.video_source.sample(video_path, self.max_frames_num, self.video_sampling, decode_size)
+
+    def verify_decode_resize(self, video_path):
+        """Once per run, make sure decoder-side downscaling keeps pixel_values within tolerance of native decoding."""
+        with self._decode_resize_lock:
+            if self._decode_resize_checked or self.decode_size is None:
+                return
+            diff, ok = check_decode_resize(self.decode_video(video_path), self.decode_video(video_path, self.decode_size), self._image_processor, self.decode_resize_tolerance)
+            if ok:
+                eval_logger.info(f"Decoding frames at {self.decode_size}, mean abs pixel_values difference to native decoding: {diff:.4f}")
+            else:
+                eval_logger.warning(f"Decoder-side resize differs from native decoding by {diff:.4f} > {self.decode_resize_tolerance}, decoding at native resolution")
+                self.decode_size = None
+            self._decode_resize_checked = True
+
+    def loglikelihood(self, requests: List[Instance]) -> List[Tuple[float, bool]]:
+        res = [None] * len(requests)
+        pbar = tqdm(total=len(requests), disable=(self.rank != 0), desc="Model Responding")
+
+        # the choices of a multiple-choice doc share their context and video: group them so both are encoded once
+        groups = collections.defaultdict(list)
+        for i, (contexts, doc_to_target, doc_to_visual, doc_id, task, split) in enumerate([reg.args for reg in requests]):
+            if type(doc_to_target) == str:
+                continuation = doc_to_target
+            else:
+                continuation = doc_to_target(self.task_dict[task][split][doc_id])
+            groups[(task, split, doc_id, contexts)].append((i, continuation))
+        groups_args = [requests[group[0][0]].args for group in groups.values()]
+
+        load_videos = functools.partial(self.load_videos, scoring=True)
+        prefetched = prefetch_map(load_videos, (self.resolve_visuals(args) for args in groups_args), depth=self.prefetch_depth, num_workers=self.prefetch_workers)
+        for (contexts, *_), group, (visuals, videos, error) in zip(groups_args, groups.values(), prefetched):
+            if error is not None:
+                raise error
+            videos = [video.cuda() for video in videos] if videos is not None else None
+            with torch.inference_mode(), self.feature_scope(visuals, videos, scoring=True):
+                scores = self.score_continuations(contexts, videos, [continuation for _, continuation in group])
+            for (i, _), score in zip(group, scores):
+                res[i] = score
+            pbar.update(len(group))
+        pbar.close()
+        return res
+
+    def resolve_visuals(self, request_args):
+        contexts, gen_kwargs, doc_to_visual, doc_id, task, split = request_args
+        visuals = [doc_to_visual(self.task_dict[task][split][doc_id])]
+        if visuals == [None]:
+            return None
+        return self.flatten(visuals)
+
+    def preprocess_video(self, visual, scoring=False):
+        """Read one video from the frame store, or decode it, and preprocess it into an fp16 CPU tensor."""
+        if scoring:
+            video = self.scoring_source.sample(visual, self.max_frames_num, self.SCORING_SAMPLING)
+            return self._image_processor.preprocess(video, return_tensors="pt")["pixel_values"].half()
+        video = self.video_source.stored(visual, self.max_frames_num, self.video_sampling)
+        if video is None:
+            if not self._decode_resize_checked:
+                self.verify_decode_resize(visual)
+            video = self.decode_video(visual, self.decode_size)
+        return self._image_processor.preprocess(video, return_tensors="pt")["pixel_values"].half()
+
+    def pixel_cache_key(self, visual, scoring=False):
+        if scoring:
+            return make_frame_key(visual, (self.SCORING_SAMPLING, self.max_frames_num, None), self.SCORING_BACKEND), self._image_processor_hash
+        stored = self.video_source.stored(visual, self.max_frames_num, self.video_sampling) is not None
+        if not stored and not self._decode_resize_checked:
+            # settles self.decode_size, which is part of the key
+            self.verify_decode_resize(visual)
+        decode_size = None if stored else self.decode_size
+        return make_frame_key(visual, (self.video_sampling, self.max_frames_num, decode_size), self.video_decode_backend), self._image_processor_hash
+
+    def load_videos(self, visuals, scoring=False):
+        """Decode and preprocess the videos of one request into fp16 CPU tensors; safe to run on a prefetch thread."""
+        if visuals is None:
+            return None
+        videos = []
+        for visual in visuals:
+            if self.pixel_cache is None:
+                video = self.preprocess_video(visual, scoring)
+            else:
+                video = self.pixel_cache.get_or_load(self.pixel_cache_key(visual, scoring), lambda: self.preprocess_video(visual, scoring))
+            videos.append(video)
+        return videos
+
+    def feature_scope(self, visuals, videos, scoring=False):
+        """Context in which the cached vision methods look up the features of `visuals`, cached per video (see `VisionFeatureCache`)."""
+        if self.feature_cache is None or visuals is None:
+            return contextlib.nullcontext()
+        return self.feature_cache.scope(tuple(self.pixel_cache_key(visual, scoring) for visual in visuals), [video.shape[0] for video in videos])
+
+    def build_prompt(self, contexts, num_videos, continuation=None):
+        """Return the conversation prompt of one request, with the assistant reply `continuation` if given, and its stop string."""
+        qs = contexts
+        if num_videos:
+            if self.model.config.mm_use_im_start_end:
+                qs = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + "\n" + qs
+            else:
+                qs = DEFAULT_IMAGE_TOKEN * num_videos + "\n" + qs
+
+        # This is much safer for llama3, as we now have some object type in it
+        if "llama_3" in self.conv_template:
+            conv = copy.deepcopy(conv_templates[self.conv_template])
+        else:
+            conv = conv_templates[self.conv_template].copy()
+
+        conv.append_message(conv.roles[0], qs)
+        conv.append_message(conv.roles[1], continuation)
+        stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
+        return conv.get_prompt(), stop_str
+
+    def encode_context(self, context_ids, videos):
+        """Run a context with its videos through the language model; returns its KV cache, length and next-token logits."""
+        if videos is not None:
+            (_, position_ids, attention_mask, _, inputs_embeds, _) = self.model.prepare_inputs_labels_for_multimodal(context_ids, None, None, None, None, videos, modalities=["video" for _ in videos])
+            outputs = self.model.get_model()(inputs_embeds=inputs_embeds, attention_mask=attention_mask, position_ids=position_ids, use_cache=True)
+        else:
+            outputs = self.model.get_model()(input_ids=context_ids, use_cache=True)
+        hidden_states = outputs[0]
+        return outputs.past_key_values, hidden_states.shape[1], self.model.lm_head(hidden_states[:, -1])
+
+    def score_continuations(self, contexts, videos, continuations):
+        """
+        `(loss, greedy)` of each continuation of one context: the mean negative log-likelihood of
+        its tokens (the continuation and the separator closing the assistant turn) and whether
+        greedy decoding reproduces them. The context is encoded once and all continuations are
+        scored in one batched forward pass on top of its KV cache.
+        """
+        num_videos = len(videos) if videos is not None else 0
+        context_prompt, _ = self.build_prompt(contexts, num_videos)
+        context_ids = tokenizer_image_token(context_prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).to(self.device)
+        continuations_ids = []
+        for continuation in continuations:
+            prompt, _ = self.build_prompt(contexts, num_videos, continuation)
+            continuations_ids.append(tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX)[context_ids.shape[1] :])
+
+        past_key_values, context_length, next_token_logits = self.encode_context(context_ids, videos)
+
+        lengths = [len(ids) for ids in continuations_ids]
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        input_ids = torch.full((len(continuations_ids), max(lengths)), pad_token_id, dtype=torch.long, device=self.device)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, ids in enumerate(continuations_ids):
+            input_ids[row, : len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, : len(ids)] = 1
+        # right padding: the continuations start right after the shared context, padding only trails
+        attention_mask = torch.cat([attention_mask.new_ones(len(continuations_ids), context_length), attention_mask], dim=1)
+        outputs = self.model.get_model()(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=repeat_past_key_values(past_key_values, len(continuations_ids)),
+            use_cache=True,
+        )
+        # token t of a continuation is predicted by the context's last position for t = 0, by continuation position t - 1 after
+        logits = torch.cat([next_token_logits.expand(len(continuations_ids), -1).unsqueeze(1), self.model.lm_head(outputs[0][:, :-1])], dim=1)
+        logprobs = torch.log_softmax(logits.float(), dim=-1)
+
+        scores = []
+        for row, length in enumerate(lengths):
+            targets = input_ids[row, :length]
+            token_logprobs = logprobs[row, :length].gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+            greedy = (logprobs[row, :length].argmax(dim=-1) == targets).all()
+            scores.append((float(-token_logprobs.mean().item()), bool(greedy)))
+        return scores
+
+    def load_chunk(self, chunk):
+        """Resolve, decode and preprocess the videos of a chunk of requests; errors are kept per request."""
+        loaded = []
+        for request_args in chunk:
+            visuals = self.resolve_visuals(request_args)
+            try:
+                loaded.append((visuals, self.load_videos(visuals), None))
+            except Exception as e:
+                loaded.append((visuals, None, e))
+        return loaded
+
+    def doc_options(self, task, split, doc_id):
+        """Multiple-choice options of a doc, None for open questions."""
+        return self.task_dict[task][split][doc_id].get("options") or None
+
+    def collate_prompts(self, prompts):
+        """Tokenize and left-pad a batch of prompts; returns input_ids, attention_masks and the pad token id."""
+        input_ids_list = [tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt") for prompt in prompts]
+        pad_token_ids = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        if "llama_3" in self.conv_template:
+            pad_token_ids = 0  # lmms-lab/llama3-llava-8b is trained on this pad token id. You may need to customize this for other models.
+        input_ids = self.pad_sequence(input_ids_list, batch_first=True, padding_value=pad_token_ids).cuda()
+        # built from the lengths, the pad id may also occur inside the prompts
+        attention_masks = self.pad_sequence([torch.ones_like(ids) for ids in input_ids_list], batch_first=True, padding_value=0).cuda()
+        return input_ids, attention_masks, pad_token_ids
+
+    def score_options(self, input_ids, attention_masks, videos, options_list):
+        """
+        Answer multiple-choice prompts with a single forward pass: the next-token logits after each
+        prompt, restricted to the tokens of its option letters, pick the letter.
+        """
+        (_, position_ids, attention_mask, _, inputs_embeds, _) = self.model.prepare_inputs_labels_for_multimodal(input_ids, None, attention_masks, None, None, videos, modalities=["video" for _ in videos] if videos else None)
+        if inputs_embeds is None:
+            inputs_embeds = self.model.get_model().embed_tokens(input_ids)
+        hidden_states = self.model.get_model()(inputs_embeds=inputs_embeds, attention_mask=attention_mask, position_ids=position_ids)[0]
+        # prompts are left-padded, so the last position is the next token of every row; only it goes through the LM head
+        logits = self.model.lm_head(hidden_states[:, -1]).float()
+        answers = []
+        for row, options in zip(logits, options_list):
+            letters = option_letters(options)
+            scores = torch.stack([row[token_ids].max() for token_ids in option_token_ids(self.tokenizer, letters)])
+            probs = torch.softmax(scores, dim=0).tolist()
+            eval_logger.debug(f"Option probabilities: {dict(zip(letters, [round(p, 4) for p in probs]))}")
+            answers.append(letters[int(scores.argmax())])
+        return answers
+
+    def numeric_logits_processor(self, stop_str, rows=None):
+        """
+        Logits processor restricting the answer to a single number, see the `numeric_answer` gen_kwargs
+        flag. The number may end with EOS or with the conversation's stop token (`<|im_end|>`, ...).
+        """
+        if self._numeric_vocab is None:
+            self._numeric_vocab = numeric_vocab(self.tokenizer)
+        eos_token_ids = self.model.generation_config.eos_token_id
+        eos_token_ids = list(eos_token_ids) if isinstance(eos_token_ids, (list, tuple)) else [eos_token_ids]
+        # a stop string spread over several tokens cannot be allowed token by token, EOS ends those answers
+        stop_token_ids = list(utils.stop_sequence_token_ids(self.tokenizer, stop_str) or ()) if stop_str else []
+        return NumericLogitsProcessor(self._numeric_vocab, eos_token_ids + [self.eot_token_id] + stop_token_ids, rows=rows)
+
+    def generate_until_batched(self, requests) -> List[str]:
+        res = []
+
+        def _collate(x):
+            # questions on the same video stay next to each other, longest prompt first within a video
+            visuals = self.resolve_visuals(x)
+            return tuple(visuals) if visuals is not None else (), -len(self.tok_encode(x[0]))
+
+        # we group requests by their generation_kwargs,
+        # so that we don't try to execute e.g. greedy sampling and temp=0.8 sampling
+        # in the same batch.
+        re_ords = utils.Collator([reg.args for reg in requests], _collate, grouping=True)
+        if self.auto_batch is not None:
+            # consecutive requests of a gen_kwargs group up to the token budget
+            chunks = (chunk for group in re_ords.get_batched(n=0, batch_fn=None) for chunk in self.auto_batch.batches(group, self.request_cost))
+        else:
+            chunks = re_ords.get_batched(n=self.batch_size, batch_fn=None)
+        pbar = tqdm(total=len(requests), disable=(self.rank != 0), desc="Model Responding")
+        # decode and preprocess the next chunks' videos on worker threads while the GPU generates
+        prefetched = prefetch_map(self.load_chunk, chunks, depth=self.prefetch_depth, num_workers=self.prefetch_workers)
+        for chunk, loaded, error in prefetched:
+            if error is not None:
+                raise error
+            if self.auto_batch is not None:
+                # on out-of-memory the chunk is answered in halves
+                outputs = self.auto_batch.run(list(zip(chunk, loaded)), lambda batch: self.answer_chunk(*map(list, zip(*batch))), lambda entry: self.request_cost(entry[0]))
+            else:
+                outputs = self.answer_chunk(chunk, loaded)
+            res.extend(outputs)
+            pbar.update(len(chunk))
+        # reorder this group of results back to original unsorted form
+        res = re_ords.get_original(res)
+        pbar.close()
+        return res
+
+    def request_cost(self, request_args):
+        """Estimated tokens of a request for batch_size=auto: the pooled visual tokens of its frames plus the prompt."""
+        visuals = self.resolve_visuals(request_args)
+        num_videos = len(visuals) if visuals is not None else 0
+        return num_videos * self.max_frames_num * self.visual_tokens_per_frame + len(self.tok_encode(request_args[0]))
+
+    def answer_chunk(self, chunk, loaded):
+        """Answer a chunk of requests sharing their gen_kwargs, given their videos from `load_chunk`."""
+        # we assume all gen kwargs in the batch are the same
+        # this is safe to assume because the `grouper` object ensures it.
+        gen_kwargs = dict(chunk[0][1])
+        if "max_new_tokens" not in gen_kwargs:
+            gen_kwargs["max_new_tokens"] = 1024
+        if "temperature" not in gen_kwargs:
+            gen_kwargs["temperature"] = 0
+        if "top_p" not in gen_kwargs:
+            gen_kwargs["top_p"] = None
+        if "num_beams" not in gen_kwargs:
+            gen_kwargs["num_beams"] = 1
+        outputs = [None] * len(chunk)
+        # the stop string depends only on the conversation template
+        _, stop_str = self.build_prompt("", 0)
+        # multiple-choice requests are scored in one forward pass when option_scoring is set, the rest are generated
+        scored, generated = [], []
+        for i, ((contexts, _, _, doc_id, task, split), (visuals, videos, error)) in enumerate(zip(chunk, loaded)):
+            if visuals is not None and error is not None:
+                eval_logger.info(f"{error}")
+                eval_logger.info(f"Video {visuals} can not load, check the source")
+                video_path = "\n".join(visuals)
+                outputs[i] = f"Video {video_path} can not load, check the source"
+                continue
+            prompt, _ = self.build_prompt(contexts, len(videos) if videos is not None else 0)
+            options = self.doc_options(task, split, doc_id)
+            (scored if options and gen_kwargs.get("option_scoring") else generated).append((i, prompt, visuals or [], [video.cuda() for video in videos or []], options))
+
+        if scored:
+            input_ids, attention_masks, _ = self.collate_prompts([entry[1] for entry in scored])
+            batch_visuals = [visual for entry in scored for visual in entry[2]]
+            batch_videos = [video for entry in scored for video in entry[3]]
+            with torch.inference_mode(), self.feature_scope(batch_visuals or None, batch_videos):
+                answers = self.score_options(input_ids, attention_masks, batch_videos or None, [entry[4] for entry in scored])
+            for (i, *_), answer in zip(scored, answers):
+                outputs[i] = answer
+
+        if generated:
+            input_ids, attention_masks, pad_token_ids = self.collate_prompts([entry[1] for entry in generated])
+            batch_visuals = [visual for entry in generated for visual in entry[2]]
+            batch_videos = [video for entry in generated for video in entry[3]]
+            stopping_criteria = utils.StopSequenceCriteria([stop_str], self.tokenizer, batch_size=input_ids.shape[0])
+            # open (non multiple-choice) questions are constrained to a single number when numeric_answer is set
+            logits_processor = LogitsProcessorList([self.numeric_logits_processor(stop_str, rows=[not entry[4] for entry in generated])]) if gen_kwargs.get("numeric_answer") else None
+            with torch.inference_mode(), self.feature_scope(batch_visuals or None, batch_videos):
+                output_ids = self.model.generate(
+                    inputs=input_ids,
+                    images=batch_videos or None,
+                    attention_mask=attention_masks,
+                    modalities=["video" for _ in batch_videos] if batch_videos else None,
+                    use_cache=self.use_cache,
+                    pad_token_id=pad_token_ids,
+                    stopping_criteria=[stopping_criteria],
+                    do_sample=True if gen_kwargs["temperature"] > 0 else False,
+                    temperature=gen_kwargs["temperature"],
+                    top_p=gen_kwargs["top_p"],
+                    num_beams=gen_kwargs["num_beams"],
+                    max_new_tokens=gen_kwargs["max_new_tokens"],
+                    logits_processor=logits_processor,
+                )
+            for (i, *_), text in zip(generated, self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)):
+                outputs[i] = text.strip()
+
+        return outputs
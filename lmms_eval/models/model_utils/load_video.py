@@ -1,6 +1,15 @@
+import bisect
+
 import av
 import numpy as np
-from av.codec.context import CodecContext
+
+# Without a keyframe table, gaps (in frames) shorter than this are decoded forward instead of
+# seeking, since a seek restarts decoding at the previous keyframe and typical GOPs are a few dozen frames long
+SEEK_MIN_GAP = 32
+
+
+class SeekUnreliableError(RuntimeError):
+    pass
 
 
 # This one is faster
@@ -8,64 +17,160 @@ def record_video_length_stream(container, indices):
     frames = []
     start_index = indices[0]
     end_index = indices[-1]
+    wanted = set(int(i) for i in indices)
     for i, frame in enumerate(container.decode(video=0)):
         if i > end_index:
             break
-        if i >= start_index and i in indices:
+        if i >= start_index and i in wanted:
             frames.append(frame)
     return frames
 
 
-# This one works for all types of video
-def record_video_length_packet(container):
+# This one is the fastest for sparse sampling of long videos, but needs a constant frame rate
+def record_video_length_seek(container, indices, keyframe_pts=None):
+    """
+    Decode the frames at `indices` by seeking to the keyframe before each target and decoding
+    forward to it, instead of decoding every frame from the start. With the sorted `keyframe_pts`
+    of the stream (see video_probe), a seek is only issued when a keyframe lies between the last
+    decoded frame and the next target.
+
+    Frame index i is mapped to the presentation timestamp start_time + i / fps, which only holds
+    for constant-frame-rate streams with reliable timestamps; SeekUnreliableError is raised
+    whenever that assumption is violated so the caller can fall back to sequential decoding.
+    Returns the same frames as `record_video_length_stream`.
+    """
+    stream = container.streams.video[0]
+    if not stream.frames or not stream.average_rate or not stream.time_base or not stream.duration:
+        raise SeekUnreliableError("stream lacks frame count, rate or duration")
+    frame_pts = 1 / (stream.average_rate * stream.time_base)  # pts ticks per frame, as a Fraction
+    # a variable-frame-rate stream shows up as a duration that disagrees with frames / fps
+    if abs(stream.duration / frame_pts - stream.frames) > 2:
+        raise SeekUnreliableError("stream duration does not match a constant frame rate")
+    start_pts = stream.start_time or 0
+
     frames = []
-    # https://github.com/PyAV-Org/PyAV/issues/1269
-    # https://www.cnblogs.com/beyond-tester/p/17641872.html
-    # context = CodecContext.create("libvpx-vp9", "r")
-    for packet in container.demux(video=0):
-        for frame in packet.decode():
-            frames.append(frame)
+    decoder = None
+    last_index = None
+    for index in sorted(set(int(i) for i in indices)):
+        target_pts = start_pts + index * frame_pts
+        if decoder is None:
+            should_seek = True
+        elif keyframe_pts is not None:
+            last_pts = start_pts + last_index * frame_pts
+            should_seek = bisect.bisect_right(keyframe_pts, target_pts) > bisect.bisect_right(keyframe_pts, last_pts)
+        else:
+            should_seek = index - last_index > SEEK_MIN_GAP
+        if should_seek:
+            container.seek(int(target_pts), stream=stream, backward=True, any_frame=False)
+            decoder = container.decode(stream)
+        for frame in decoder:
+            if frame.pts is None:
+                raise SeekUnreliableError("decoded frame has no pts")
+            if frame.pts > target_pts + frame_pts / 2:
+                raise SeekUnreliableError(f"seek overshot frame {index}")
+            if frame.pts >= target_pts - frame_pts / 2:
+                frames.append(frame)
+                break
+        else:
+            raise SeekUnreliableError(f"stream ended before frame {index}")
+        last_index = index
     return frames
 
 
-def read_video_pyav(video_path, num_frm=8):
-    container = av.open(video_path)
-
-    if "webm" not in video_path and "mkv" not in video_path:
-        # For mp4, we try loading with stream first
-        try:
-            container = av.open(video_path)
-            total_frames = container.streams.video[0].frames
-            sampled_frm = min(total_frames, num_frm)
-            indices = np.linspace(0, total_frames - 1, sampled_frm, dtype=int)
-
-            # Append the last frame index if not already included
-            if total_frames - 1 not in indices:
-                indices = np.append(indices, total_frames - 1)
-
-            frames = record_video_length_stream(container, indices)
-        except:
-            container = av.open(video_path)
-            frames = record_video_length_packet(container)
-            total_frames = len(frames)
-            sampled_frm = min(total_frames, num_frm)
-            indices = np.linspace(0, total_frames - 1, sampled_frm, dtype=int)
-
-            # Append the last frame index if not already included
-            if total_frames - 1 not in indices:
-                indices = np.append(indices, total_frames - 1)
-
-            frames = [frames[i] for i in indices]
-    else:
-        container = av.open(video_path)
-        frames = record_video_length_packet(container)
-        total_frames = len(frames)
-        sampled_frm = min(total_frames, num_frm)
-        indices = np.linspace(0, total_frames - 1, sampled_frm, dtype=int)
-
-        # Append the last frame index if not already included
-        if total_frames - 1 not in indices:
-            indices = np.append(indices, total_frames - 1)
-
-        frames = [frames[i] for i in indices]
-    return np.stack([x.to_ndarray(format="rgb24") for x in frames])
+# Frame counting for containers without a usable frame count, in two passes that never hold more
+# than the sampled frames: count first, then decode with `record_video_length_stream`.
+# https://github.com/PyAV-Org/PyAV/issues/1269
+# https://www.cnblogs.com/beyond-tester/p/17641872.html
+# context = CodecContext.create("libvpx-vp9", "r")
+def count_video_packets(container):
+    """Count the frames of the first video stream by demuxing only, without decoding."""
+    num_frames = 0
+    for packet in container.demux(video=0):
+        # the demuxer yields an empty packet at the end of the stream to flush the decoder
+        if packet.size > 0:
+            num_frames += 1
+    return num_frames
+
+
+def count_decoded_frames(container):
+    """Count the frames the decoder actually yields, discarding each one right away."""
+    num_frames = 0
+    for _ in container.decode(video=0):
+        num_frames += 1
+    return num_frames
+
+
+def processor_decode_size(image_processor):
+    """
+    Describe the resize an HF image processor applies first, so the decoder can scale frames there
+    directly. Returns ("fixed", height, width) for processors that squash to a fixed size (SigLIP),
+    ("shortest_edge", size) for aspect-preserving ones (CLIP), or None when it cannot be mirrored.
+    """
+    if not getattr(image_processor, "do_resize", True):
+        return None
+    size = getattr(image_processor, "size", None)
+    if isinstance(size, int):
+        return ("fixed", size, size)
+    if not isinstance(size, dict):
+        return None
+    if "height" in size and "width" in size:
+        return ("fixed", int(size["height"]), int(size["width"]))
+    if "shortest_edge" in size and "longest_edge" not in size:
+        return ("shortest_edge", int(size["shortest_edge"]))
+    return None
+
+
+def resolve_decode_size(decode_size, height, width):
+    """Return the (width, height) to decode a height x width video at, following the processor's resize rule."""
+    if decode_size[0] == "fixed":
+        return decode_size[2], decode_size[1]
+    # same rounding as transformers' get_resize_output_image_size(default_to_square=False)
+    short, long = (width, height) if width <= height else (height, width)
+    new_short, new_long = decode_size[1], int(decode_size[1] * long / short)
+    return (new_short, new_long) if width <= height else (new_long, new_short)
+
+
+def frames_to_ndarray(frames, decode_size=None):
+    if decode_size is None:
+        return np.stack([x.to_ndarray(format="rgb24") for x in frames])
+    width, height = resolve_decode_size(decode_size, frames[0].height, frames[0].width)
+    # let swscale convert and downscale in one pass instead of materializing full-resolution RGB frames
+    return np.stack([x.to_ndarray(format="rgb24", width=width, height=height, interpolation="BICUBIC") for x in frames])
+
+
+def sample_uniform_with_last(total_frames, num_frm):
+    sampled_frm = min(total_frames, num_frm)
+    indices = np.linspace(0, total_frames - 1, sampled_frm, dtype=int)
+
+    # Append the last frame index if not already included
+    if total_frames - 1 not in indices:
+        indices = np.append(indices, total_frames - 1)
+    return indices
+
+
+def read_video_pyav(video_path, num_frm=8, frame_cache=None, decode_size=None):
+    """Sample `num_frm` frames plus the last one with PyAV; kept for models not constructing their own VideoSource."""
+    # imported here because video_source builds its backends on the decode helpers of this module
+    from lmms_eval.models.model_utils.video_source import VideoSource
+
+    return VideoSource("pyav", frame_cache=frame_cache, fallback=False).sample(video_path, num_frm, "uniform_with_last", decode_size)
+
+
+def read_video_decord(video_path, num_frm=8, decode_size=None):
+    """Uniformly sample `num_frm` frames with decord, as the LLaVA-family `load_video` methods do."""
+    from lmms_eval.models.model_utils.video_source import VideoSource
+
+    return VideoSource("decord", fallback=False).sample(video_path, num_frm, "uniform", decode_size)
+
+
+def check_decode_resize(frames, resized_frames, image_processor, tolerance):
+    """
+    Compare the processor output of natively decoded frames against decoder-downscaled ones.
+    Returns the mean absolute difference (in normalized pixel units) and whether it is within `tolerance`.
+    """
+    reference = image_processor.preprocess(frames, return_tensors="np")["pixel_values"]
+    candidate = image_processor.preprocess(resized_frames, return_tensors="np")["pixel_values"]
+    if reference.shape != candidate.shape:
+        return float("inf"), False
+    diff = float(np.abs(reference.astype(np.float32) - candidate.astype(np.float32)).mean())
+    return diff, diff <= tolerance
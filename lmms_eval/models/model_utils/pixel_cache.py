@@ -0,0 +1,132 @@
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Callable, Hashable, Optional
+
+import torch
+from loguru import logger as eval_logger
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+TENSOR_NAME = "tensor"
+
+
+def image_processor_hash(image_processor) -> str:
+    """Hash of everything that affects the processor output (size, crop, mean/std, resample, ...)."""
+    config = image_processor.to_dict() if hasattr(image_processor, "to_dict") else vars(image_processor)
+    config = {"class": type(image_processor).__name__, **config}
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+class TensorCache:
+    """
+    Cache of per-video tensors (preprocessed pixel_values, vision features), in memory (LRU
+    bounded by a byte budget) and optionally on disk as one safetensors file per entry, so
+    repeated questions on a video and repeated runs skip recomputing them.
+
+    Keys should bind the video file identity, the sampling and whatever else produced the tensor,
+    e.g. the image processor config (see `make_frame_key` and `image_processor_hash`). Disk
+    entries record their key and are ignored when it does not match, so a hash collision can
+    never return the wrong video.
+    """
+
+    def __init__(self, max_bytes: int = 0, cache_dir: Optional[str] = None) -> None:
+        self.max_bytes = int(max_bytes)
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._entries: "collections.OrderedDict[Hashable, torch.Tensor]" = collections.OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _disk_path(self, key: Hashable) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".safetensors")
+
+    def _get_memory(self, key: Hashable) -> Optional[torch.Tensor]:
+        with self._lock:
+            tensor = self._entries.get(key)
+            if tensor is not None:
+                self._entries.move_to_end(key)
+            return tensor
+
+    def _put_memory(self, key: Hashable, tensor: torch.Tensor) -> None:
+        nbytes = tensor.element_size() * tensor.nelement()
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                old = self._entries.pop(key)
+                self._nbytes -= old.element_size() * old.nelement()
+            self._entries[key] = tensor
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.element_size() * evicted.nelement()
+
+    def _get_disk(self, key: Hashable) -> Optional[torch.Tensor]:
+        if self.cache_dir is None:
+            return None
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with safe_open(path, framework="pt") as f:
+                if f.metadata().get("key") != repr(key):
+                    return None
+                return f.get_tensor(TENSOR_NAME)
+        except Exception as e:
+            eval_logger.debug(f"Ignoring unreadable tensor cache entry {path}: {e}")
+            return None
+
+    def _put_disk(self, key: Hashable, tensor: torch.Tensor) -> None:
+        if self.cache_dir is None:
+            return
+        path = self._disk_path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tensor-", suffix=".tmp")
+        os.close(fd)
+        try:
+            save_file({TENSOR_NAME: tensor.contiguous()}, tmp_path, metadata={"key": repr(key)})
+            # mkstemp creates the file 0600, a cache directory may be shared with other users' runs
+            os.chmod(tmp_path, 0o644)
+            # write then rename so concurrent ranks never read a half-written entry
+            os.replace(tmp_path, path)
+        except OSError as e:
+            eval_logger.debug(f"Could not write tensor cache entry {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def get(self, key: Hashable) -> Optional[torch.Tensor]:
+        tensor = self._get_memory(key)
+        if tensor is None:
+            tensor = self._get_disk(key)
+            if tensor is not None:
+                self._put_memory(key, tensor)
+        if tensor is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return tensor
+
+    def put(self, key: Hashable, tensor: torch.Tensor) -> None:
+        self._put_memory(key, tensor)
+        self._put_disk(key, tensor)
+
+    def get_or_load(self, key: Hashable, load_fn: Callable[[], torch.Tensor]) -> torch.Tensor:
+        tensor = self.get(key)
+        if tensor is None:
+            tensor = load_fn()
+            self.put(key, tensor)
+        return tensor
+
+
+def build_tensor_cache(cache_dir: Optional[str], cache_mb) -> Optional[TensorCache]:
+    """Create a TensorCache from a `*_cache_dir` / `*_cache_mb` pair of model args; disabled when neither is set."""
+    cache_mb = int(cache_mb or 0)
+    if not cache_dir and cache_mb <= 0:
+        return None
+    return TensorCache(max_bytes=cache_mb * 1024 * 1024, cache_dir=os.path.expanduser(cache_dir) if cache_dir else None)
@@ -0,0 +1,47 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+
+def prefetch_map(fn: Callable, items: Iterable, depth: int = 2, num_workers: int = 1) -> Iterator[Tuple[Any, Any, Optional[Exception]]]:
+    """
+    Apply `fn` to `items` on a thread pool while the consumer works on earlier results, and yield
+    `(item, result, error)` in input order.
+
+    At most `depth` items are in flight ahead of the consumer, which bounds the memory held by
+    decoded and preprocessed visuals. An exception raised by `fn` is returned as `error` for that
+    item only, so one broken video does not abort the stream. `items` is consumed lazily on the
+    caller's thread. With `depth <= 0` everything runs inline.
+
+    Threads (not processes) are used because decord, PyAV and the numpy-heavy image processors
+    release the GIL for most of their work, and the results can be handed over without pickling.
+    """
+    if depth <= 0:
+        for item in items:
+            try:
+                yield item, fn(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    iterator = iter(items)
+    with ThreadPoolExecutor(max_workers=max(1, num_workers), thread_name_prefix="lmms_eval_prefetch") as pool:
+        pending = collections.deque()
+        for item in iterator:
+            pending.append((item, pool.submit(fn, item)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            item, future = pending.popleft()
+            # keep the pipeline full before blocking on the oldest item
+            for next_item in iterator:
+                pending.append((next_item, pool.submit(fn, next_item)))
+                break
+            try:
+                result, error = future.result(), None
+            except Exception as e:
+                result, error = None, e
+            # hold no reference to a result the consumer is done with while the next items are built
+            del future
+            yield item, result, error
+            del result
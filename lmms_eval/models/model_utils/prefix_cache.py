@@ -0,0 +1,88 @@
+import collections
+import copy
+from dataclasses import dataclass
+from typing import Any, Hashable, List, Optional, Sequence
+
+
+@dataclass
+class PrefixEntry:
+    past_key_values: Any
+    length: int  # cached sequence length, i.e. prefix tokens with the visual tokens expanded
+
+
+def longest_common_prefix(sequences: Sequence[Sequence[int]]) -> List[int]:
+    prefix = list(sequences[0])
+    for sequence in sequences[1:]:
+        n = 0
+        for a, b in zip(prefix, sequence):
+            if a != b:
+                break
+            n += 1
+        del prefix[n:]
+    return prefix
+
+
+class PrefixKVCache:
+    """
+    LRU of the `past_key_values` of prompt prefixes (system prompt, video tokens, shared pre_prompt),
+    so questions on the same video only prefill their own suffix.
+
+    Entries are forked for each question and rewound afterwards: legacy tuple caches are never
+    modified in place, `DynamicCache`-like objects are cropped back to the prefix length, and any
+    other cache type is deep-copied.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = int(max_entries)
+        self._entries: "collections.OrderedDict[Hashable, PrefixEntry]" = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[PrefixEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Hashable, entry: PrefixEntry) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def fork(entry: PrefixEntry):
+        past_key_values = entry.past_key_values
+        if isinstance(past_key_values, tuple) or hasattr(past_key_values, "crop"):
+            return past_key_values
+        return copy.deepcopy(past_key_values)
+
+    @staticmethod
+    def release(entry: PrefixEntry) -> None:
+        if hasattr(entry.past_key_values, "crop"):
+            entry.past_key_values.crop(entry.length)
+
+
+def repeat_past_key_values(past_key_values, n: int):
+    """
+    `past_key_values` of a single sequence repeated over a batch of `n`, e.g. one context shared by
+    several continuations. Legacy tuple caches are expanded as views, `DynamicCache`-like objects
+    are repeated in place.
+    """
+    if isinstance(past_key_values, tuple):
+        return tuple(tuple(tensor.expand(n, *tensor.shape[1:]) for tensor in layer) for layer in past_key_values)
+    if hasattr(past_key_values, "batch_repeat_interleave"):
+        past_key_values.batch_repeat_interleave(n)
+        return past_key_values
+    return type(past_key_values).from_legacy_cache(repeat_past_key_values(past_key_values.to_legacy_cache(), n))
+
+
+def build_prefix_cache(prefix_cache_size) -> Optional[PrefixKVCache]:
+    """Create a PrefixKVCache from a `prefix_cache_size` model arg; 0 or None disables it."""
+    prefix_cache_size = int(prefix_cache_size or 0)
+    if prefix_cache_size <= 0:
+        return None
+    return PrefixKVCache(prefix_cache_size)
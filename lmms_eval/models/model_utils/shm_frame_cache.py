@@ -0,0 +1,244 @@
+import fcntl
+import glob
+import hashlib
+import os
+import tempfile
+import weakref
+from typing import Callable, Hashable, Optional
+
+import numpy as np
+from loguru import logger as eval_logger
+
+DEFAULT_SHM_DIR = "/dev/shm"
+DATA_SUFFIX = ".npy"
+LOCK_SUFFIX = ".lock"
+TMP_PREFIX = ".tmp-"
+# every process using a cache directory holds a shared flock on this file
+RANKS_FILE = ".ranks"
+HEADER_READERS = {(1, 0): np.lib.format.read_array_header_1_0, (2, 0): np.lib.format.read_array_header_2_0}
+
+
+def _key_name(key: Hashable) -> str:
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _register(cache_dir: str) -> int:
+    """Join the processes using `cache_dir`; the returned descriptor holds a shared flock on its ranks file."""
+    path = os.path.join(cache_dir, RANKS_FILE)
+    while True:
+        os.makedirs(cache_dir, exist_ok=True)
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o600)
+        except FileNotFoundError:
+            continue
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        # the last process of a previous run removed the directory meanwhile
+        os.close(fd)
+
+
+def _unregister(fd: int, cache_dir: str) -> None:
+    """Leave `cache_dir`; the last process to leave removes the cache."""
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return
+    try:
+        names = [name for name in os.listdir(cache_dir) if name.endswith((DATA_SUFFIX, LOCK_SUFFIX)) or name.startswith(TMP_PREFIX)]
+        # the ranks file goes last: a process joining meanwhile waits on its lock, then starts over
+        for name in names + [RANKS_FILE]:
+            try:
+                os.unlink(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                pass
+        os.rmdir(cache_dir)
+    except OSError as e:
+        eval_logger.debug(f"Could not remove shared frame cache {cache_dir}: {e}")
+    finally:
+        os.close(fd)
+
+
+class SharedFrameCache:
+    """
+    Node-wide cache of decoded frames in shared memory, shared by every rank on the node.
+
+    Each entry is an .npy file under `/dev/shm`. The first rank to ask for a key decodes it while
+    holding an exclusive flock on the key's lock file; ranks asking for the same key meanwhile block
+    on that lock and then read the finished file instead of decoding it themselves. Files appear
+    through an atomic rename, so a rank that dies while writing leaves no visible entry.
+
+    Readers map an entry read-only, so all ranks share one copy of the frames. A mapping holds a
+    shared flock on its entry until it is garbage collected, and eviction only removes entries it
+    can lock exclusively: entries some rank still maps are skipped, and an entry that does not fit
+    next to them is not written. The kernel drops the locks of a crashed rank, so its pins go with
+    it. Eviction also removes the lock files no rank holds and the temporary files of crashed ranks.
+
+    Every process using the directory holds a shared flock on its ranks file; the last one to close
+    its cache (or exit) removes the directory, so decoded frames do not outlive the run.
+    """
+
+    def __init__(self, max_bytes: int, cache_dir: Optional[str] = None) -> None:
+        self.max_bytes = int(max_bytes)
+        if cache_dir is None:
+            cache_dir = os.path.join(DEFAULT_SHM_DIR, f"lmms_eval_frames_{os.getuid()}")
+        self.cache_dir = cache_dir
+        self._finalizer = weakref.finalize(self, _unregister, _register(cache_dir), cache_dir)
+        self.hits = 0
+        self.misses = 0
+
+    def close(self) -> None:
+        """Stop using the cache; removes it when no other process uses it anymore."""
+        self._finalizer()
+
+    def _path(self, name: str, suffix: str) -> str:
+        return os.path.join(self.cache_dir, name + suffix)
+
+    def _read(self, path: str) -> Optional[np.ndarray]:
+        """Map an entry read-only, pinned for as long as the mapping lives; None when it does not exist (or was evicted meanwhile)."""
+        try:
+            with open(path, "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                if os.fstat(f.fileno()).st_ino != os.stat(path).st_ino:
+                    # evicted, and maybe written again, while we waited for the lock
+                    return None
+                version = np.lib.format.read_magic(f)
+                shape, fortran_order, dtype = HEADER_READERS[version](f)
+                # the mapping keeps a duplicate of the descriptor, and with it the shared lock, until it is collected
+                frames = np.memmap(f, dtype=dtype, mode="r", shape=shape, order="F" if fortran_order else "C", offset=f.tell())
+            # touch for LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return frames
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        frames = self._read(self._path(_key_name(key), DATA_SUFFIX))
+        if frames is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return frames
+
+    def get_or_load(self, key: Hashable, load_fn: Callable[[], np.ndarray]) -> np.ndarray:
+        name = _key_name(key)
+        data_path = self._path(name, DATA_SUFFIX)
+        frames = self._read(data_path)
+        if frames is not None:
+            self.hits += 1
+            return frames
+
+        with open(self._path(name, LOCK_SUFFIX), "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # another rank may have decoded it while we waited for the lock
+            frames = self._read(data_path)
+            if frames is not None:
+                self.hits += 1
+                return frames
+            self.misses += 1
+            frames = np.ascontiguousarray(load_fn())
+            if frames.nbytes > self.max_bytes or not self.evict(frames.nbytes):
+                # does not fit next to the entries other ranks have mapped
+                return frames
+            try:
+                self._write(data_path, frames)
+            except OSError as e:
+                # /dev/shm is full or not writable, the caller still gets its frames
+                eval_logger.debug(f"Could not write shared frame cache entry {data_path}: {e}")
+                return frames
+        shared = self._read(data_path)
+        return shared if shared is not None else frames
+
+    def _write(self, data_path: str, frames: np.ndarray) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=f"{TMP_PREFIX}{os.getpid()}-", suffix=DATA_SUFFIX)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, frames)
+            os.replace(tmp_path, data_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def nbytes(self) -> int:
+        total = 0
+        for path in glob.glob(os.path.join(self.cache_dir, "*" + DATA_SUFFIX)):
+            try:
+                total += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return total
+
+    def evict(self, incoming_bytes: int = 0) -> bool:
+        """Remove least recently used unmapped entries until `incoming_bytes` fit in the budget; False when they do not."""
+        self._remove_orphans()
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*" + DATA_SUFFIX)):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        used = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if used + incoming_bytes <= self.max_bytes:
+                break
+            if self._unlink_unlocked(path):
+                used -= size
+                self._unlink_unlocked(path[: -len(DATA_SUFFIX)] + LOCK_SUFFIX)
+        return used + incoming_bytes <= self.max_bytes
+
+    def _unlink_unlocked(self, path: str) -> bool:
+        """Unlink an entry no rank maps, or a lock file no rank decodes under; False when it is in use."""
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return True
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.unlink(path)
+        except BlockingIOError:
+            return False
+        except FileNotFoundError:
+            pass
+        finally:
+            os.close(fd)
+        return True
+
+    def _remove_orphans(self) -> None:
+        for path in glob.glob(os.path.join(self.cache_dir, TMP_PREFIX + "*")):
+            try:
+                pid = int(os.path.basename(path)[len(TMP_PREFIX) :].split("-", 1)[0])
+            except ValueError:
+                continue
+            if not _pid_alive(pid):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+        # locks left by entries that were too large or failed to write
+        for path in glob.glob(os.path.join(self.cache_dir, "*" + LOCK_SUFFIX)):
+            if not os.path.exists(path[: -len(LOCK_SUFFIX)] + DATA_SUFFIX):
+                self._unlink_unlocked(path)
+
+
+def build_shm_frame_cache(shm_frame_cache_mb, cache_dir: Optional[str] = None) -> Optional[SharedFrameCache]:
+    """Create a SharedFrameCache from a `shm_frame_cache_mb` model arg; 0 or None disables it."""
+    shm_frame_cache_mb = int(shm_frame_cache_mb or 0)
+    if shm_frame_cache_mb <= 0:
+        return None
+    return SharedFrameCache(max_bytes=shm_frame_cache_mb * 1024 * 1024, cache_dir=cache_dir)
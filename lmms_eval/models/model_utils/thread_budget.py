@@ -0,0 +1,90 @@
+import os
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from loguru import logger as eval_logger
+
+from lmms_eval.models.model_utils.video_source import set_default_decode_threads
+
+
+@dataclass
+class ThreadBudget:
+    cpus: int  # CPUs this process may run on
+    local_world_size: int  # ranks sharing those CPUs
+    threads_per_rank: int
+    decode_threads: int  # decord / PyAV threads per decoder
+    torch_threads: int  # torch intra-op threads
+    tokenizer_threads: int  # HF tokenizers (rayon) threads
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def available_cpus() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def local_world_size(num_processes: Optional[int] = None) -> int:
+    """
+    Number of ranks on this node. torchrun (used by `accelerate launch`) exports LOCAL_WORLD_SIZE;
+    without it every rank of `num_processes` (accelerator.num_processes, i.e. WORLD_SIZE) is assumed local.
+    """
+    if os.getenv("LOCAL_WORLD_SIZE"):
+        return max(1, int(os.environ["LOCAL_WORLD_SIZE"]))
+    if num_processes is None:
+        num_processes = int(os.getenv("WORLD_SIZE", "1"))
+    return max(1, int(num_processes))
+
+
+def compute_thread_budget(num_processes: Optional[int] = None, threads_per_rank: Optional[int] = None) -> ThreadBudget:
+    """
+    Split the CPUs of the node evenly between the local ranks.
+
+    Within a rank, half the threads go to video decoding, which runs on the prefetch threads while
+    the main thread preprocesses and tokenizes, and the rest to torch. Tokenizers get a single
+    thread as soon as several ranks share the node, since their work per request is tiny.
+    """
+    cpus = available_cpus()
+    local_ranks = local_world_size(num_processes)
+    if threads_per_rank is None:
+        threads_per_rank = max(1, cpus // local_ranks)
+    decode_threads = max(1, threads_per_rank // 2)
+    return ThreadBudget(
+        cpus=cpus,
+        local_world_size=local_ranks,
+        threads_per_rank=threads_per_rank,
+        decode_threads=decode_threads,
+        torch_threads=max(1, threads_per_rank - decode_threads),
+        tokenizer_threads=1 if local_ranks > 1 else threads_per_rank,
+    )
+
+
+def apply_thread_budget(budget: ThreadBudget) -> ThreadBudget:
+    """
+    Apply the budget to torch, the tokenizers and every VideoSource decoder of this process.
+
+    Must run before the model and its tokenizer are loaded: OpenMP/MKL and rayon read their
+    environment variables when their thread pools start. Variables already set by the user win.
+    """
+    import torch
+
+    for name, value in (
+        ("OMP_NUM_THREADS", budget.torch_threads),
+        ("MKL_NUM_THREADS", budget.torch_threads),
+        ("RAYON_NUM_THREADS", budget.tokenizer_threads),
+    ):
+        os.environ.setdefault(name, str(value))
+    if budget.tokenizer_threads == 1:
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+    torch.set_num_threads(budget.torch_threads)
+    try:
+        torch.set_num_interop_threads(max(1, min(budget.torch_threads, 4)))
+    except RuntimeError:
+        # only allowed before the first parallel op ran in this process
+        pass
+    set_default_decode_threads(budget.decode_threads)
+    eval_logger.info(f"Thread budget per rank: {budget.to_dict()}")
+    return budget
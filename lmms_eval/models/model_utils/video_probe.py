@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Dict, Optional
+
+import av
+from loguru import logger as eval_logger
+
+# Bump when the record layout changes so stale records are re-probed
+PROBE_VERSION = 2
+# One JSON record per video, named by the hash of its real path; dataset directories are often read-only or shared
+PROBE_INDEX_DIR = os.path.join(os.path.expanduser(os.getenv("HF_HOME", "~/.cache/huggingface/")), "lmms_eval", "probe")
+
+_memory_index: Dict[str, dict] = {}
+_memory_lock = threading.Lock()
+
+
+def probe_video(video_path: str) -> dict:
+    """
+    Demux (without decoding) the first video stream once and collect everything needed to
+    compute sampling indices and plan seeks: frame count, fps, duration, keyframe pts and codec.
+    """
+    container = av.open(video_path)
+    try:
+        stream = container.streams.video[0]
+        num_packets = 0
+        keyframe_pts = []
+        last_pts = None
+        last_duration = 0
+        for packet in container.demux(stream):
+            # the demuxer yields an empty packet at the end of the stream to flush the decoder
+            if packet.size == 0:
+                continue
+            num_packets += 1
+            if packet.pts is not None:
+                if packet.is_keyframe:
+                    keyframe_pts.append(int(packet.pts))
+                if last_pts is None or packet.pts > last_pts:
+                    last_pts = int(packet.pts)
+                    last_duration = int(packet.duration or 0)
+
+        time_base = stream.time_base
+        start_time = int(stream.start_time or 0)
+        if stream.duration:
+            duration = float(stream.duration * time_base)
+        elif last_pts is not None:
+            duration = float((last_pts - start_time + last_duration) * time_base)
+        else:
+            duration = float(container.duration / av.time_base) if container.duration else 0.0
+
+        # the container's frame count, as the baseline read it; the packet count when the header has none
+        num_frames = int(stream.frames or 0) or num_packets
+        if stream.average_rate:
+            fps = float(stream.average_rate)
+        else:
+            fps = num_frames / duration if duration > 0 else 0.0
+
+        return {
+            "version": PROBE_VERSION,
+            "frames": num_frames,
+            "packets": num_packets,
+            "fps": fps,
+            "duration": duration,
+            "start_time": start_time,
+            "time_base": [time_base.numerator, time_base.denominator] if time_base else None,
+            "keyframe_pts": sorted(keyframe_pts),
+            "codec": stream.codec_context.name,
+            "width": stream.codec_context.width,
+            "height": stream.codec_context.height,
+        }
+    finally:
+        container.close()
+
+
+def _index_path(video_path: str) -> str:
+    real_path = os.path.realpath(video_path)
+    return os.path.join(PROBE_INDEX_DIR, hashlib.sha1(real_path.encode("utf-8")).hexdigest() + ".json")
+
+
+def _read_index(path: str, video_path: str, stat: os.stat_result) -> Optional[dict]:
+    try:
+        with open(path, "r") as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if record.get("version") != PROBE_VERSION or record.get("path") != os.path.realpath(video_path):
+        return None
+    if record.get("mtime_ns") != stat.st_mtime_ns or record.get("size") != stat.st_size:
+        return None
+    return record
+
+
+def _write_index(record: dict, path: str) -> None:
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename so concurrent ranks never read a half-written record
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".probe-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(record, f, separators=(",", ":"))
+            # mkstemp creates the file 0600, the index is shared with other users' runs
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        eval_logger.debug(f"Could not write video probe record {path}, it is kept in memory only: {e}")
+
+
+def get_video_probe(video_path: str) -> dict:
+    """
+    Return the probe record of `video_path`, reading it from the in-process index or the on-disk
+    index and probing the file only when neither holds a record for its current mtime and size.
+    """
+    stat = os.stat(video_path)
+    memory_key = os.path.realpath(video_path)
+    with _memory_lock:
+        record = _memory_index.get(memory_key)
+    if record is not None and record["mtime_ns"] == stat.st_mtime_ns and record["size"] == stat.st_size:
+        return record
+
+    index_path = _index_path(video_path)
+    record = _read_index(index_path, video_path, stat)
+    if record is None:
+        record = probe_video(video_path)
+        record["path"] = memory_key
+        record["mtime_ns"] = stat.st_mtime_ns
+        record["size"] = stat.st_size
+        _write_index(record, index_path)
+
+    with _memory_lock:
+        _memory_index[memory_key] = record
+    return record
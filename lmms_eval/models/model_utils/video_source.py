@@ -0,0 +1,348 @@
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import av
+import numpy as np
+from loguru import logger as eval_logger
+
+from lmms_eval.models.model_utils.frame_cache import FrameCache, make_frame_key
+from lmms_eval.models.model_utils.frame_store import FrameStore
+from lmms_eval.models.model_utils.load_video import (
+    count_decoded_frames,
+    count_video_packets,
+    frames_to_ndarray,
+    record_video_length_seek,
+    record_video_length_stream,
+    resolve_decode_size,
+    sample_uniform_with_last,
+)
+from lmms_eval.models.model_utils.shm_frame_cache import SharedFrameCache
+from lmms_eval.models.model_utils.video_probe import get_video_probe
+
+try:
+    from decord import VideoReader, cpu
+except ImportError:
+    VideoReader = None
+
+
+########################################
+# Sampling policies
+########################################
+
+# Each policy maps (total_frames, num_frames, fps) to the frame indices a model samples. They
+# reproduce the sampling the models used to implement on their own, so routing a model through
+# VideoSource does not change which frames it sees.
+SAMPLING_REGISTRY: Dict[str, Callable[[int, int, float], np.ndarray]] = {}
+
+
+def register_sampling(name):
+    def decorate(fn):
+        assert name not in SAMPLING_REGISTRY, f"sampling policy named '{name}' conflicts with existing registered policy!"
+        SAMPLING_REGISTRY[name] = fn
+        return fn
+
+    return decorate
+
+
+@register_sampling("uniform")
+def sample_uniform(total_frames, num_frames, fps):
+    return np.linspace(0, total_frames - 1, num_frames, dtype=int)
+
+
+@register_sampling("uniform_with_last")
+def sample_uniform_last(total_frames, num_frames, fps):
+    return sample_uniform_with_last(total_frames, num_frames)
+
+
+@register_sampling("uniform_skip_last")
+def sample_uniform_skip_last(total_frames, num_frames, fps):
+    # VILA never samples the very last frame, which is often broken in its training videos
+    return np.linspace(0, max(total_frames - 2, 0), num_frames, dtype=int)
+
+
+@register_sampling("one_per_second")
+def sample_one_per_second(total_frames, num_frames, fps):
+    # LLaMA-VID encodes one frame per second and ignores num_frames
+    return np.arange(0, total_frames, max(int(round(fps)), 1))
+
+
+@register_sampling("segment_midpoints")
+def sample_segment_midpoints(total_frames, num_frames, fps):
+    # InternVL2: the middle frame of num_frames equal segments
+    seg_size = float(total_frames - 1) / num_frames
+    return np.array([int(seg_size / 2 + np.round(seg_size * idx)) for idx in range(num_frames)])
+
+
+def sample_indices(sampling: str, total_frames: int, num_frames: int, fps: float = 0.0) -> np.ndarray:
+    if total_frames <= 0:
+        raise ValueError("video has no frames")
+    if sampling not in SAMPLING_REGISTRY:
+        raise ValueError(f"Unknown sampling policy {sampling}, expected one of {list(SAMPLING_REGISTRY)}")
+    return np.asarray(SAMPLING_REGISTRY[sampling](total_frames, num_frames, fps), dtype=int)
+
+
+# Sampling that the legacy `video_decode_backend` model arg implied before it only selected a backend
+DEFAULT_SAMPLING = {
+    "decord": "uniform",
+    "pyav": "uniform_with_last",
+}
+
+
+########################################
+# Backends
+########################################
+
+VIDEO_BACKEND_REGISTRY: Dict[str, type] = {}
+
+# Decoder threads used by backends that were not given an explicit count; 0 lets decord/FFmpeg
+# decide. Set per rank from the thread budget (see thread_budget.py) to avoid oversubscribing the node.
+_default_decode_threads = 0
+
+
+def set_default_decode_threads(num_threads: int) -> None:
+    global _default_decode_threads
+    _default_decode_threads = int(num_threads)
+
+
+def register_video_backend(*names):
+    def decorate(cls):
+        for name in names:
+            assert name not in VIDEO_BACKEND_REGISTRY, f"video backend named '{name}' conflicts with existing registered backend!"
+            VIDEO_BACKEND_REGISTRY[name] = cls
+        cls.name = names[0]
+        return cls
+
+    return decorate
+
+
+class VideoBackend:
+    """
+    Decodes the frames a sampling policy selects from one video. `read` returns a uint8
+    (T, H, W, 3) array in the order of the sampled indices (duplicates included), or raises
+    so that VideoSource can fall back to the next backend.
+    """
+
+    name: str = None
+
+    def __init__(self, num_threads: Optional[int] = None, frame_store: Optional[FrameStore] = None) -> None:
+        self.num_threads = num_threads
+        self.frame_store = frame_store
+
+    @property
+    def threads(self) -> int:
+        return _default_decode_threads if self.num_threads is None else self.num_threads
+
+    def open_pyav(self, video_path: str):
+        container = av.open(video_path)
+        if self.threads > 0:
+            stream = container.streams.video[0]
+            stream.thread_type = "AUTO"
+            stream.codec_context.thread_count = self.threads
+        return container
+
+    def read(self, video_path: str, sampling: str, num_frames: int, decode_size=None) -> np.ndarray:
+        raise NotImplementedError
+
+
+def _gather(frames, unique_indices, indices):
+    """Expand frames decoded once per unique index back to the (possibly repeating) sampled order."""
+    if len(frames) != len(unique_indices):
+        raise RuntimeError(f"decoded {len(frames)} frames, expected {len(unique_indices)}")
+    return frames[np.searchsorted(unique_indices, indices)]
+
+
+@register_video_backend("decord")
+class DecordBackend(VideoBackend):
+    def read(self, video_path, sampling, num_frames, decode_size=None):
+        if VideoReader is None:
+            raise ImportError("decord is not installed")
+        if decode_size is None:
+            vr = VideoReader(video_path, ctx=cpu(0), num_threads=self.threads)
+        else:
+            probe = get_video_probe(video_path)
+            width, height = resolve_decode_size(decode_size, probe["height"], probe["width"])
+            vr = VideoReader(video_path, ctx=cpu(0), num_threads=self.threads, width=width, height=height)
+        indices = sample_indices(sampling, len(vr), num_frames, vr.get_avg_fps())
+        return vr.get_batch(indices.tolist()).asnumpy()
+
+
+@register_video_backend("pyav-seek")
+class PyAVSeekBackend(VideoBackend):
+    """Keyframe-aware seeking driven by the persisted probe index; only valid for constant-frame-rate streams."""
+
+    def read(self, video_path, sampling, num_frames, decode_size=None):
+        probe = get_video_probe(video_path)
+        indices = sample_indices(sampling, probe["frames"], num_frames, probe["fps"])
+        unique_indices = np.unique(indices)
+        container = self.open_pyav(video_path)
+        try:
+            frames = record_video_length_seek(container, unique_indices, keyframe_pts=probe["keyframe_pts"])
+        finally:
+            container.close()
+        return _gather(frames_to_ndarray(frames, decode_size), unique_indices, indices)
+
+
+@register_video_backend("pyav-stream")
+class PyAVStreamBackend(VideoBackend):
+    """
+    Sequential decoding up to the last sampled frame; works for every container, including webm/mkv.
+
+    Only the sampled frames are kept, so memory is bounded by `num_frames` whatever the video
+    length. The frame count comes from the probe index or, failing that, a demux-only pass; when
+    the decoder yields fewer frames than there are packets, a decode-and-discard pass counts the
+    decodable frames and the indices are sampled again.
+    """
+
+    def read(self, video_path, sampling, num_frames, decode_size=None):
+        try:
+            probe = get_video_probe(video_path)
+            total_frames, fps = probe["frames"], probe["fps"]
+        except Exception as e:
+            eval_logger.debug(f"Could not probe {video_path}, counting packets instead: {e}")
+            total_frames, fps = self.count(video_path, count_video_packets)
+
+        frames = self.read_indices(video_path, sampling, total_frames, num_frames, fps, decode_size)
+        if frames is None:
+            eval_logger.debug(f"{video_path} has fewer decodable frames than packets, counting decoded frames")
+            total_frames, _ = self.count(video_path, count_decoded_frames)
+            frames = self.read_indices(video_path, sampling, total_frames, num_frames, fps, decode_size)
+        if frames is None:
+            raise RuntimeError(f"could not decode the sampled frames of {video_path}")
+        return frames
+
+    def count(self, video_path, count_fn):
+        container = self.open_pyav(video_path)
+        try:
+            return count_fn(container), float(container.streams.video[0].average_rate or 0)
+        finally:
+            container.close()
+
+    def read_indices(self, video_path, sampling, total_frames, num_frames, fps, decode_size):
+        indices = sample_indices(sampling, total_frames, num_frames, fps)
+        unique_indices = np.unique(indices)
+        container = self.open_pyav(video_path)
+        try:
+            frames = record_video_length_stream(container, unique_indices)
+        finally:
+            container.close()
+        if len(frames) != len(unique_indices):
+            return None
+        return _gather(frames_to_ndarray(frames, decode_size), unique_indices, indices)
+
+
+@register_video_backend("frame-store")
+class FrameStoreBackend(VideoBackend):
+    """Frames materialized by tools/materialize_frames.py; only serves the sampling the store was written with."""
+
+    def read(self, video_path, sampling, num_frames, decode_size=None):
+        frames = self.lookup(video_path, sampling, num_frames)
+        if frames is None:
+            raise KeyError(f"{video_path} is not in the frame store for {sampling}/{num_frames}")
+        return frames
+
+    def lookup(self, video_path, sampling, num_frames) -> Optional[np.ndarray]:
+        if self.frame_store is None or not self.frame_store.matches(num_frames, sampling):
+            return None
+        return self.frame_store.get(video_path)
+
+
+# Fastest first. mp4-like containers carry reliable timestamps, so sparse sampling seeks between
+# keyframes; VP9/webm and mkv files frequently lack a usable index and are decoded sequentially.
+AUTO_BACKENDS = {
+    "seekable": ("pyav-seek", "decord", "pyav-stream"),
+    "sequential": ("pyav-stream", "decord"),
+}
+SEQUENTIAL_CONTAINERS = (".webm", ".mkv")
+# `pyav` is the name the models' `video_decode_backend` arg has always used; like the baseline
+# reader, it goes straight to sequential decoding for containers that cannot be seeked
+BACKEND_ALIASES = {
+    "pyav": {"seekable": ("pyav-seek", "pyav-stream"), "sequential": ("pyav-stream",)},
+}
+
+
+def container_kind(video_path: str) -> str:
+    return "sequential" if video_path.lower().endswith(SEQUENTIAL_CONTAINERS) else "seekable"
+
+
+def auto_backends(video_path: str) -> Tuple[str, ...]:
+    return AUTO_BACKENDS[container_kind(video_path)]
+
+
+########################################
+# VideoSource
+########################################
+
+
+class VideoSource:
+    """
+    Single entry point for turning a video file into sampled uint8 frames, shared by all video models.
+
+    `sample(video_path, num_frames, sampling)` computes the indices of a registered sampling policy,
+    serves them from the frame store, the in-process frame cache or the node-wide shared-memory
+    cache when possible, and otherwise decodes them with the configured backend. `backend` is a registered backend name, an alias
+    such as "pyav", or "auto" to pick the fastest backend for the container. When a backend fails,
+    the remaining backends of the automatic order for that container are tried before giving up.
+    """
+
+    def __init__(
+        self,
+        backend: str = "auto",
+        frame_cache: Optional[FrameCache] = None,
+        frame_store: Optional[FrameStore] = None,
+        shared_cache: Optional[SharedFrameCache] = None,
+        num_threads: Optional[int] = None,
+        fallback: bool = True,
+    ) -> None:
+        if backend != "auto" and backend not in BACKEND_ALIASES and backend not in VIDEO_BACKEND_REGISTRY:
+            raise ValueError(f"Unknown video backend {backend}, expected auto, one of {list(BACKEND_ALIASES)} or {list(VIDEO_BACKEND_REGISTRY)}")
+        self.backend = backend
+        self.frame_cache = frame_cache
+        self.shared_cache = shared_cache
+        self.fallback = fallback
+        self._backends = {name: cls(num_threads=num_threads, frame_store=frame_store) for name, cls in VIDEO_BACKEND_REGISTRY.items()}
+
+    @property
+    def frame_store(self) -> Optional[FrameStore]:
+        return self._backends["frame-store"].frame_store
+
+    def backends_for(self, video_path: str) -> List[str]:
+        if self.backend == "auto":
+            names = list(auto_backends(video_path))
+        else:
+            names = list(BACKEND_ALIASES[self.backend][container_kind(video_path)] if self.backend in BACKEND_ALIASES else (self.backend,))
+        if self.fallback:
+            names += [name for name in auto_backends(video_path) if name not in names]
+        return names
+
+    def stored(self, video_path: str, num_frames: int, sampling: str) -> Optional[np.ndarray]:
+        """Frames of `video_path` from the frame store, or None when it does not hold them."""
+        return self._backends["frame-store"].lookup(video_path, sampling, num_frames)
+
+    def sample(self, video_path: Union[str, Sequence[str]], num_frames: int, sampling: str = "uniform", decode_size=None) -> np.ndarray:
+        """Return the frames of `video_path` selected by `sampling` as a uint8 (T, H, W, 3) array."""
+        if not isinstance(video_path, str):
+            video_path = video_path[0]
+        frames = self.stored(video_path, num_frames, sampling)
+        if frames is not None:
+            return frames
+        if self.frame_cache is None and self.shared_cache is None:
+            return self._decode(video_path, num_frames, sampling, decode_size)
+        # the sampled indices only depend on the file and the sampling spec, so a cache hit skips opening the container at all
+        key = make_frame_key(video_path, (sampling, num_frames, decode_size), self.backend)
+        load = lambda: self._decode(video_path, num_frames, sampling, decode_size)
+        if self.shared_cache is not None:
+            # on a miss of this rank, another rank on the node may already have decoded the clip
+            load_local = load
+            load = lambda: self.shared_cache.get_or_load(key, load_local)
+        if self.frame_cache is None:
+            return load()
+        return self.frame_cache.get_or_load(key, load)
+
+    def _decode(self, video_path, num_frames, sampling, decode_size):
+        error = None
+        for name in self.backends_for(video_path):
+            try:
+                return self._backends[name].read(video_path, sampling, num_frames, decode_size)
+            except Exception as e:
+                eval_logger.debug(f"Video backend {name} failed on {video_path}: {e}")
+                error = e
+        raise RuntimeError(f"Could not decode {video_path} with any of {self.backends_for(video_path)}") from error
@@ -14,6 +14,7 @@ from transformers import AutoModel, AutoTokenizer
 from lmms_eval.api.instance import Instance
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
+from lmms_eval.models.model_utils.prefetch import prefetch_map
 
 eval_logger = logging.getLogger("eval_logger")
 
@@ -27,6 +28,7 @@ from vllm import LLM, SamplingParams
 
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append('Qwen2-VL/')
 sys.path.append('Qwen2-VL/qwen-vl-utils/src')
 from qwen_vl_utils import process_vision_info
@@ -42,6 +44,8 @@ class Qwen2VL(lmms):
         device_map: str = "cuda",
         batch_size: str = "1",
         max_frames_num: int = None,
+        chunk_size: int = 16,  # requests submitted to vLLM per generate call; the current and the next chunk's videos are held in host memory
+        vision_workers: int = 8,  # threads running process_vision_info for the next chunk while vLLM generates
         **kwargs,
     ):
         super().__init__()
@@ -70,6 +74,8 @@ class Qwen2VL(lmms):
 
         self.modality = modality
         self.max_frames_num = max_frames_num
+        self.chunk_size = max(1, int(chunk_size))
+        self.vision_workers = max(1, int(vision_workers))
 
     @property
     def config(self):
@@ -107,53 +113,63 @@ class Qwen2VL(lmms):
                 new_list.append(j)
         return new_list
 
+    def build_input(self, request_args):
+        """Build the vLLM prompt and multi_modal_data of one request; reads and samples the video."""
+        contexts, gen_kwargs, doc_to_visual, doc_id, task, split = request_args
+        visuals = [doc_to_visual(self.task_dict[task][split][doc_id])]
+        visuals = self.flatten(visuals)
+        if self.modality == "image":
+            raise NotImplementedError("Image inference for Qwen2VL is not supported yet.")
+        elif self.modality == "video":
+            assert len(visuals) == 1, f"Only one video is supported, but got {len(visuals)} videos."
+            video_path = visuals[0]
+            messages = [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "video",
+                            "video": f"{video_path}",
+                            # "max_pixels": 360 * 420,
+                            # "nframes": self.max_frames_num,
+                        },
+                        {"type": "text", "text": f"{contexts}"},
+                    ],
+                }
+            ]
+            if self.max_frames_num:
+                messages[0]['content'][0]['nframes'] = self.max_frames_num
+            text = self._processor.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=True
+            )
+            _, video_inputs = process_vision_info(messages)
+            return {
+                "prompt": text,
+                "multi_modal_data": {
+                    "video": video_inputs
+                },
+            }
+        else:
+            raise NotImplementedError
+
     def generate_until(self, requests) -> List[str]:
         res = []
         pbar = tqdm(total=len(requests), disable=(self.rank != 0), desc="Model Responding")
 
-        for contexts, gen_kwargs, doc_to_visual, doc_id, task, split in [reg.args for reg in requests]:
-
-            visuals = [doc_to_visual(self.task_dict[task][split][doc_id])]
-            visuals = self.flatten(visuals)
-            if self.modality == "image":
-                raise NotImplementedError("Image inference for Qwen2VL is not supported yet.")
-            elif self.modality == "video":
-                assert len(visuals) == 1, f"Only one video is supported, but got {len(visuals)} videos."
-                video_path = visuals[0]
-                messages = [
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "video",
-                                "video": f"{video_path}",
-                                # "max_pixels": 360 * 420,
-                                # "nframes": self.max_frames_num,
-                            },
-                            {"type": "text", "text": f"{contexts}"},
-                        ],
-                    }
-                ]
-                if self.max_frames_num:
-                    messages[0]['content'][0]['nframes'] = self.max_frames_num
-                text = self._processor.apply_chat_template(
-                    messages, tokenize=False, add_generation_prompt=True
-                )
-                _, video_inputs = process_vision_info(messages)
-                generated_ids = self._model.generate(
-                    {
-                        "prompt": text,
-                        "multi_modal_data": {
-                            "video": video_inputs
-                        },
-                    },
-                    sampling_params=self.sampling_params
-                )
-                output_text = generated_ids[0].outputs[0].text
-            else:
-                raise NotImplementedError
-            res.append(output_text)
-            pbar.update(1)
+        requests_args = [reg.args for reg in requests]
+        chunks = [requests_args[i : i + self.chunk_size] for i in range(0, len(requests_args), self.chunk_size)]
+        with ThreadPoolExecutor(max_workers=self.vision_workers, thread_name_prefix="lmms_eval_qwen2vl") as pool:
+            # the next chunk's videos are read while vLLM batches the current one
+            prefetched = prefetch_map(lambda chunk: list(pool.map(self.build_input, chunk)), chunks, depth=1)
+            for chunk, inputs, error in prefetched:
+                if error is not None:
+                    raise error
+                # vLLM schedules the whole chunk with continuous batching and returns outputs in input order
+                outputs = self._model.generate(inputs, sampling_params=self.sampling_params, use_tqdm=False)
+                res.extend(output.outputs[0].text for output in outputs)
+                pbar.update(len(chunk))
+                # free the decoded videos before the chunk after next starts building
+                del inputs, outputs
         pbar.close()
         return res
 
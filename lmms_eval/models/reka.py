@@ -15,6 +15,8 @@ from tqdm import tqdm
 from lmms_eval.api.instance import Instance
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
+from lmms_eval.models.model_utils.frame_encoder import FrameEncoder
+from lmms_eval.models.model_utils.video_source import VideoSource
 
 NUM_SECONDS_TO_SLEEP = 30
 
@@ -23,7 +25,6 @@ from loguru import logger
 eval_logger = logger
 
 try:
-    from decord import VideoReader, cpu
     from reka import ChatMessage
     from reka.client import Reka as RekaClient
 except Exception as e:
@@ -37,6 +38,8 @@ class Reka(lmms):
         model_version: str = "reka-edge",
         modality: str = "image",
         max_frames_num: int = 5,
+        frame_format: str = "png",  # png, jpeg or webp; jpeg/webp payloads are much smaller for video frames
+        frame_quality: int = 90,
         timeout: int = 120,
         continual_mode: bool = False,
         response_persistent_folder: str = None,  # We will cache the Gemini API response in this path and use it for future requests
@@ -46,6 +49,8 @@ class Reka(lmms):
         self.model_version = model_version
         self.modality = modality
         self.max_frames_num = max_frames_num
+        self.video_source = VideoSource()
+        self.frame_encoder = FrameEncoder(image_format=frame_format, quality=frame_quality)
         self.timeout = timeout
         self.continual_mode = continual_mode
         if self.continual_mode:
@@ -83,39 +88,13 @@ class Reka(lmms):
 
     def encode_image(self, image):
         if type(image) == list:
-            media_urls = []
-            for img in image:
-                output_buffer = BytesIO()
-                img.save(output_buffer, format="PNG")
-                byte_data = output_buffer.getvalue()
-                base64_str = base64.b64encode(byte_data).decode("utf-8")
-                media_urls.append(f"data:image/jpeg;base64,{base64_str}")
-            return media_urls
+            return [self.frame_encoder.data_url(self.frame_encoder.encode_image(img)) for img in image]
         else:
-            output_buffer = BytesIO()
-            image.save(output_buffer, format="PNG")
-            byte_data = output_buffer.getvalue()
-            base64_str = base64.b64encode(byte_data).decode("utf-8")
-
-            return f"data:image/jpeg;base64,{base64_str}"
+            return self.frame_encoder.data_url(self.frame_encoder.encode_image(image))
 
     def encode_video(self, video_path):
-        vr = VideoReader(video_path, ctx=cpu(0))
-        total_frame_num = len(vr)
-        uniform_sampled_frames = np.linspace(0, total_frame_num - 1, self.max_frames_num, dtype=int)
-        frame_idx = uniform_sampled_frames.tolist()
-        frames = vr.get_batch(frame_idx).asnumpy()
-
-        base64_frames = []
-        for frame in frames:
-            img = Image.fromarray(frame)
-            output_buffer = BytesIO()
-            img.save(output_buffer, format="PNG")
-            byte_data = output_buffer.getvalue()
-            base64_str = base64.b64encode(byte_data).decode("utf-8")
-            base64_frames.append(f"data:image/jpeg;base64,{base64_str}")
-
-        return base64_frames
+        frames = self.frame_encoder.encode_video(self.video_source, video_path, self.max_frames_num, "uniform")
+        return [self.frame_encoder.data_url(frame) for frame in frames]
 
     def generate_until(self, requests) -> List[str]:
         res = []
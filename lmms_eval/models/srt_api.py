@@ -24,6 +24,8 @@ from tqdm import tqdm
 from lmms_eval.api.instance import Instance
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
+from lmms_eval.models.model_utils.frame_encoder import FrameEncoder
+from lmms_eval.models.model_utils.video_source import VideoSource
 
 NUM_SECONDS_TO_SLEEP = 5
 
@@ -38,6 +40,8 @@ class SRT_API(lmms):
         host: str = "127.0.0.1",
         port: int = 30000,
         max_frames_num: int = 32,
+        frame_format: str = "png",  # png, jpeg or webp; jpeg/webp payloads are much smaller for video frames
+        frame_quality: int = 90,
         timeout: int = 60,
         chat_template: str = "chatml-llava",
         tp: int = 8,
@@ -54,6 +58,8 @@ class SRT_API(lmms):
         self.model_version = model_version
         self.modality = modality
         self.max_frames_num = max_frames_num
+        self.video_source = VideoSource(backend="decord", num_threads=1)
+        self.frame_encoder = FrameEncoder(image_format=frame_format, quality=frame_quality)
         self.image_token = "<image>"
         self.timeout = timeout
         self.continual_mode = continual_mode
@@ -109,47 +115,11 @@ class SRT_API(lmms):
 
     # Function to encode the image
     def encode_image(self, image: Image):
-        output_buffer = BytesIO()
-        image.save(output_buffer, format="PNG")
-        byte_data = output_buffer.getvalue()
-        base64_str = base64.b64encode(byte_data).decode("utf-8")
-        return base64_str
+        return self.frame_encoder.encode_image(image)
 
     # Function to encode the video
     def encode_video(self, video_path, for_get_frames_num):
-        try:
-            vr = VideoReader(video_path, ctx=cpu(0), num_threads=1)
-            total_frame_num = len(vr)
-            uniform_sampled_frames = np.linspace(0, total_frame_num - 1, for_get_frames_num, dtype=int)
-            frame_idx = uniform_sampled_frames.tolist()
-            frames = vr.get_batch(frame_idx).asnumpy()
-        except:
-            import av
-
-            container = av.open(video_path)
-
-            frames = []
-            # https://github.com/PyAV-Org/PyAV/issues/1269
-            # https://www.cnblogs.com/beyond-tester/p/17641872.html
-            # context = CodecContext.create("libvpx-vp9", "r")
-            for packet in container.demux(video=0):
-                for frame in packet.decode():
-                    frames.append(frame)
-            total_frames = len(frames)
-            sampled_frm = min(total_frames, for_get_frames_num)
-            indices = np.linspace(0, total_frames - 1, sampled_frm, dtype=int)
-            frames = [frames[i] for i in indices]
-
-        base64_frames = []
-        for frame in frames:
-            img = Image.fromarray(frame)
-            output_buffer = BytesIO()
-            img.save(output_buffer, format="PNG")
-            byte_data = output_buffer.getvalue()
-            base64_str = base64.b64encode(byte_data).decode("utf-8")
-            base64_frames.append(base64_str)
-
-        return base64_frames
+        return self.frame_encoder.encode_video(self.video_source, video_path, for_get_frames_num, "uniform")
 
     def flatten(self, input):
         new_list = []
@@ -187,7 +157,7 @@ class SRT_API(lmms):
         # put the images in the first place
         content = []
         for img in imgs:
-            content.append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img}"}})
+            content.append({"type": "image_url", "image_url": {"url": self.frame_encoder.data_url(img)}})
 
         content.append({"type": "text", "text": contexts})
         messages.append({"role": "user", "content": content})
@@ -19,6 +19,7 @@ from tqdm import tqdm
 from lmms_eval.api.instance import Instance
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
+from lmms_eval.models.model_utils.video_source import VideoSource
 
 eval_logger = logging.getLogger("lmms-eval")
 import sys
@@ -129,6 +130,7 @@ class VILA(lmms):
                 self._tokenizer.pad_token_id = 151643
 
         self.video_decode_backend = video_decode_backend
+        self.video_source = VideoSource(backend=video_decode_backend)
         self.model.eval()
         # self.model.tie_weights()
         self.truncation = truncation
@@ -227,14 +229,10 @@ class VILA(lmms):
             encoding = encoding[-left_truncate_len:]
         return encoding
 
-    def load_video(self, video_path, max_frames_num):
+    def load_video(self, video_path, max_frames_num, sampling="uniform_skip_last"):
         try:
-            vr = VideoReader(video_path, ctx=cpu(0))
-            total_frame_num = len(vr)
-            fps = round(vr.get_avg_fps())
-            frame_idx = np.linspace(0, total_frame_num - 2, max_frames_num, dtype=int)
-            spare_frames = vr.get_batch(frame_idx).asnumpy()
-            return [Image.fromarray(img) for img in spare_frames]
+            frames = self.video_source.sample(video_path, max_frames_num, sampling)
+            return [Image.fromarray(img) for img in frames]
         except Exception as e:
             eval_logger.error(f"Failed to load video {video_path} with error: {e}")
             return [Image.new("RGB", (448, 448), (0, 0, 0))] * max_frames_num
@@ -332,7 +330,7 @@ class VILA(lmms):
                             if self.video_decode_backend == "decord":
                                 images = self.load_video(visual, num_video_frames)
                             elif self.video_decode_backend == "pyav":
-                                images = read_video_pyav(visual, num_frm=num_video_frames)
+                                images = self.load_video(visual, num_video_frames, sampling="uniform_with_last")
                             video = process_images(images, self.model.image_processor, self.model.config).half().cuda()
                             videos.append(video)
                 elif isinstance(visuals[0], Image.Image): # support single image
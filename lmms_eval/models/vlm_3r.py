@@ -1,34 +1,52 @@
-import copy
+import collections
 import math
+import threading
 from datetime import timedelta
-from typing import List, Optional, Tuple, Union
+from typing import List, Optional, Union
 
-import numpy as np
 import torch
 from accelerate import Accelerator, DistributedType, InitProcessGroupKwargs
 from accelerate.state import AcceleratorState
-from decord import VideoReader, cpu
 from loguru import logger as eval_logger
 from tqdm import tqdm
-from transformers import AutoConfig
-
-from lmms_eval.api.instance import Instance
+from transformers import (
+    AutoConfig,
+    GenerationMixin,
+    LogitsProcessorList,
+    StoppingCriteriaList,
+)
+
+from lmms_eval import utils
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
-from lmms_eval.models.model_utils.load_video import read_video_pyav
+from lmms_eval.models.model_utils.auto_batch import (
+    TokenBudgetBatcher,
+    is_auto_batch_size,
+)
+from lmms_eval.models.model_utils.feature_cache import (
+    build_feature_cache,
+    checkpoint_hash,
+)
+from lmms_eval.models.model_utils.frame_cache import build_frame_cache
+from lmms_eval.models.model_utils.frame_store import load_frame_store
+from lmms_eval.models.model_utils.load_video import processor_decode_size
+from lmms_eval.models.model_utils.pixel_cache import (
+    build_tensor_cache,
+    image_processor_hash,
+)
+from lmms_eval.models.model_utils.prefetch import prefetch_map
+from lmms_eval.models.model_utils.prefix_cache import (
+    PrefixEntry,
+    build_prefix_cache,
+    longest_common_prefix,
+)
+from lmms_eval.models.model_utils.shm_frame_cache import build_shm_frame_cache
+from lmms_eval.models.model_utils.video_source import DEFAULT_SAMPLING, VideoSource
 
 import sys; sys.path = ["VLM-3R/"] + sys.path
 try:
-    from llava.constants import (
-        DEFAULT_IM_END_TOKEN,
-        DEFAULT_IM_START_TOKEN,
-        DEFAULT_IMAGE_TOKEN,
-        IGNORE_INDEX,
-        IMAGE_TOKEN_INDEX,
-    )
-    from llava.conversation import SeparatorStyle, conv_templates
+    from llava.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX
     from llava.mm_utils import (
-        KeywordsStoppingCriteria,
         get_model_name_from_path,
         process_images,
         tokenizer_image_token,
@@ -48,9 +66,12 @@ from llava.model.language_model.llava_llama import LlavaConfig
 
 AutoConfig.register("llava_llama", LlavaConfig)
 
+# after the LLaVA imports above, so the mixin resolves llava from the same code base
+from lmms_eval.models.model_utils.llava_video import LlavaVideoMixin
+
 
 @register_model("vlm_3r")
-class Vlm3r(lmms):
+class Vlm3r(LlavaVideoMixin, lmms):
     """
     Vlm3r Model
     """
@@ -61,6 +82,8 @@ class Vlm3r(lmms):
         truncation: Optional[bool] = True,
         device: Optional[str] = "cuda:0",
         batch_size: Optional[Union[int, str]] = 1,
+        max_batch_size: Optional[int] = None,  # with batch_size=auto, max requests per batch (default 64)
+        batch_token_budget: int = 65536,  # with batch_size=auto, max estimated tokens (visual + prompt) per batch, lowered on out-of-memory
         attn_implementation=(
             "sdpa" if torch.__version__ >= "2.1.2" else "eager"
         ),  # inference implementation for attention, can be "sdpa", "eager", "flash_attention_2". Seems FA2 is not effective during inference: https://discuss.huggingface.co/t/flash-attention-has-no-effect-on-inference/73453/5
@@ -77,6 +100,23 @@ class Vlm3r(lmms):
         mm_pooling_position: str = "after",
         overwrite: bool = True,
         video_decode_backend: str = "pyav",
+        frame_cache_mb: int = 1024,  # per-process budget for decoded frames shared by questions on the same video, 0 to disable
+        prefetch_depth: int = 2,  # number of upcoming requests whose videos are decoded and preprocessed ahead of generation, 0 to disable
+        prefetch_workers: int = 2,
+        shm_frame_cache_mb: int = 0,  # node-wide budget in /dev/shm for frames decoded by any rank on the node, 0 to disable
+        pixel_cache_dir: Optional[str] = None,  # directory for preprocessed fp16 pixel_values (safetensors), reused across runs
+        pixel_cache_mb: int = 0,  # in-memory budget for preprocessed pixel_values, 0 to disable
+        feature_cache_dir: Optional[str] = None,  # directory for vision features (safetensors), reused across runs of the same checkpoint
+        feature_cache_mb: int = 0,  # in-memory budget for vision features shared by questions on the same video, 0 to disable
+        # "+"-separated model methods whose tensor outputs are cached, e.g. encode_images+get_2dPool. The default
+        # only covers the 2D vision tower + projector. VLM-3R's 3D (spatial) encoder is defined in the external VLM-3R/
+        # checkout, not in this tree, so its method name cannot be defaulted here: append it to cache the 3D features too
+        # (a name the loaded model does not have is skipped with a warning)
+        feature_cache_methods: str = "encode_images",
+        prefix_cache_size: int = 0,  # number of prompt prefixes (video tokens + shared pre_prompt) whose KV cache is kept for greedy decoding, 0 to disable
+        frame_store: Optional[str] = None,  # directory written by tools/materialize_frames.py, frames are read from it instead of decoding
+        decode_resize: bool = False,  # let the decoder scale frames straight to the image processor's input size
+        decode_resize_tolerance: float = 0.05,  # max mean abs difference of pixel_values vs. native-resolution decoding, checked on the first video
         delay_load: bool = False,
         tie_weights: bool = True,
         model_name: str = None,
@@ -104,6 +144,9 @@ class Vlm3r(lmms):
         else:
             self.model_name = get_model_name_from_path(pretrained)
         self.video_decode_backend = video_decode_backend
+        self.video_sampling = DEFAULT_SAMPLING.get(video_decode_backend, "uniform_with_last")
+        self.prefetch_depth = int(prefetch_depth)
+        self.prefetch_workers = int(prefetch_workers)
         # self._config = AutoConfig.from_pretrained(self.pretrained)
         self.overwrite = overwrite
         self.mm_resampler_type = mm_resampler_type
@@ -111,6 +154,12 @@ class Vlm3r(lmms):
         self.mm_spatial_pool_out_channels = int(mm_spatial_pool_out_channels)
         self.mm_spatial_pool_mode = mm_spatial_pool_mode
         self.max_frames_num = int(max_frames_num)
+        self.video_source = VideoSource(
+            backend=video_decode_backend,
+            frame_cache=build_frame_cache(frame_cache_mb),
+            frame_store=load_frame_store(frame_store, self.max_frames_num, self.video_sampling),
+            shared_cache=build_shm_frame_cache(shm_frame_cache_mb),
+        )
         self.mm_resampler_location = mm_pooling_position
         self.mm_newline_position = mm_newline_position
         self.delay_load = delay_load
@@ -178,11 +227,38 @@ class Vlm3r(lmms):
             )
 
         self._config = self._model.config
+        self.decode_size = processor_decode_size(self._image_processor) if decode_resize else None
+        if decode_resize and self.decode_size is None:
+            eval_logger.warning(f"decode_resize is not supported for {type(self._image_processor).__name__}, decoding at native resolution")
+        self.decode_resize_tolerance = float(decode_resize_tolerance)
+        self._decode_resize_checked = self.decode_size is None
+        self.pixel_cache = build_tensor_cache(pixel_cache_dir, pixel_cache_mb)
+        self._image_processor_hash = image_processor_hash(self._image_processor)
+        self._numeric_vocab = None  # built on the first numeric_answer request
+        # vision features only depend on the frames and the checkpoint, so every question on a video reuses them
+        self.feature_cache = build_feature_cache(
+            self._model,
+            feature_cache_methods,
+            feature_cache_dir,
+            feature_cache_mb,
+            checkpoint_hash(pretrained, model_base=model_base, mm_spatial_pool_stride=mm_spatial_pool_stride, mm_spatial_pool_mode=mm_spatial_pool_mode, mm_resampler_type=mm_resampler_type, mm_newline_position=mm_newline_position),
+        )
+        self.prefix_cache = build_prefix_cache(prefix_cache_size)
+        self._decode_resize_lock = threading.Lock()
         self.model.eval()
         if tie_weights:
             self.model.tie_weights()
         self.truncation = truncation
-        self.batch_size_per_gpu = int(batch_size)
+        # batch_size=auto batches requests up to a token budget, see TokenBudgetBatcher
+        self.auto_batch = TokenBudgetBatcher(batch_token_budget, max_batch_size) if is_auto_batch_size(batch_size) else None
+        self.batch_size_per_gpu = self.auto_batch.max_batch_size if self.auto_batch is not None else int(batch_size)
+        # pooled patches of one frame, the unit of the per-request cost estimate
+        num_patches_per_side = getattr(self._model.get_vision_tower(), "num_patches_per_side", 24)
+        self.visual_tokens_per_frame = math.ceil(num_patches_per_side / self.mm_spatial_pool_stride) ** 2
+        if self.batch_size_per_gpu > 1:
+            # batched prompts must end where generation starts; LLaVA re-pads the expanded embeddings by the config's side
+            self._tokenizer.padding_side = "left"
+            self._model.config.tokenizer_padding_side = "left"
         self.conv_template = conv_template
         self.use_cache = use_cache
         self.truncate_context = truncate_context
@@ -256,6 +332,10 @@ class Vlm3r(lmms):
     def batch_size(self):
         return self.batch_size_per_gpu
 
+    @property
+    def batch_sizes(self):
+        return self.auto_batch.batch_sizes if self.auto_batch is not None else {}
+
     @property
     def device(self):
         return self._device
@@ -277,77 +357,9 @@ class Vlm3r(lmms):
             encoding = encoding[-left_truncate_len:]
         return encoding
 
-    def load_video(self, video_path, max_frames_num):
-        vr = VideoReader(video_path, ctx=cpu(0))
-        total_frame_num = len(vr)
-        # fps = round(vr.get_avg_fps())
-        # frame_idx = [i for i in range(0, len(vr), fps)]
-        uniform_sampled_frames = np.linspace(0, total_frame_num - 1, max_frames_num, dtype=int)
-        frame_idx = uniform_sampled_frames.tolist()
-        spare_frames = vr.get_batch(frame_idx).asnumpy()
-        return spare_frames  # (frames, height, width, channels)
-
     def tok_decode(self, tokens):
         return self.tokenizer.decode(tokens)
 
-    def loglikelihood(self, requests: List[Instance]) -> List[Tuple[float, bool]]:
-        res = []
-        pbar = tqdm(total=len(requests), disable=(self.rank != 0), desc="Model Responding")
-
-        for contexts, doc_to_target, doc_to_visual, doc_id, task, split in [reg.args for reg in requests]:
-            # encode, pad, and truncate contexts for this batch
-            if type(doc_to_target) == str:
-                continuation = doc_to_target
-            else:
-                continuation = doc_to_target(self.task_dict[task][split][doc_id])
-            visuals = [doc_to_visual(self.task_dict[task][split][doc_id])]
-            visuals = self.flatten(visuals)
-            videos = []
-            for visual in visuals:
-                video = self.load_video(visual, self.max_frames_num)
-                video = self._image_processor.preprocess(video, return_tensors="pt")["pixel_values"].half().cuda()
-                videos.append(video)
-
-            qs = contexts
-            if self.model.config.mm_use_im_start_end:
-                qs = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + "\n" + qs
-            else:
-                qs = DEFAULT_IMAGE_TOKEN + "\n" + qs
-
-            conv = conv_templates[self.conv_template].copy()
-            conv.append_message(conv.roles[0], qs)
-            conv.append_message(conv.roles[1], None)
-            prompt = conv.get_prompt()
-
-            contxt_id = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).to(self.device)
-
-            conv = conv_templates[self.conv_template].copy()
-            conv.append_message(conv.roles[0], qs)
-            conv.append_message(conv.roles[1], continuation)
-            prompt = conv.get_prompt()
-
-            input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).cuda()
-            attention_masks = input_ids.ne(self.tokenizer.pad_token_id).long().cuda()
-
-            labels = input_ids.clone()
-            # Context part no need to calculate for loss
-            labels[0, : contxt_id.shape[1]] = -100
-
-            with torch.inference_mode():
-                outputs = self.model(input_ids=input_ids, labels=labels, images=videos, modalities="video")
-
-            loss = outputs["loss"]
-            # loss = torch.exp(loss)
-            logits = outputs["logits"]
-            greedy_tokens = logits.argmax(dim=-1)
-            cont_toks = input_ids[:, contxt_id.shape[1] :]  # [1, seq]
-            greedy_tokens = greedy_tokens[:, contxt_id.shape[1] : input_ids.shape[1]]  # [1, seq]
-            max_equal = (greedy_tokens == cont_toks).all()
-            res.append((float(loss.item()), bool(max_equal)))
-            pbar.update(1)
-        pbar.close()
-        return res
-
     def flatten(self, input):
         new_list = []
         for i in input:
@@ -355,51 +367,90 @@ class Vlm3r(lmms):
                 new_list.append(j)
         return new_list
 
+    def shared_prefixes(self, requests_args, visuals_list):
+        """
+        Longest common prompt prefix (as token ids) of the requests on each video, keyed by the
+        video paths. Only prefixes that cover the video tokens and leave every request at least
+        one token of its own are returned.
+        """
+        groups = collections.defaultdict(list)
+        for (contexts, *_), visuals in zip(requests_args, visuals_list):
+            if visuals is not None:
+                prompt, _ = self.build_prompt(contexts, len(visuals))
+                groups[tuple(visuals)].append(tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX))
+        prefixes = {}
+        for video_paths, input_ids in groups.items():
+            if len(input_ids) < 2:
+                continue
+            prefix = longest_common_prefix(input_ids)
+            if len(prefix) >= min(len(ids) for ids in input_ids):
+                prefix = prefix[:-1]
+            if IMAGE_TOKEN_INDEX in prefix:
+                prefixes[video_paths] = tuple(prefix)
+        return prefixes
+
+    def prefill_prefix(self, prefix_ids, videos):
+        """Run the prompt prefix with its videos through the language model and keep only its KV cache."""
+        (_, position_ids, attention_mask, _, inputs_embeds, _) = self.model.prepare_inputs_labels_for_multimodal(prefix_ids, None, None, None, None, videos, modalities=["video" for _ in videos])
+        # the base model skips the LM head, whose logits over thousands of visual tokens are never used
+        outputs = self.model.get_model()(inputs_embeds=inputs_embeds, attention_mask=attention_mask, position_ids=position_ids, use_cache=True)
+        return PrefixEntry(outputs.past_key_values, inputs_embeds.shape[1])
+
+    def generate_from_prefix(self, entry, suffix_ids, gen_kwargs, stop_str, logits_processor=None):
+        """
+        Greedy decoding of a prompt suffix on top of a cached prefix; returns the new token ids like `generate` does.
+
+        Runs the public `generate` of transformers on input ids whose cached positions hold padding:
+        `generate` only feeds the positions `past_key_values` does not cover, so the suffix is all
+        the model sees. LLaVA's own `generate` is bypassed because it turns input ids into embeddings.
+        """
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        input_ids = torch.cat([suffix_ids.new_full((1, entry.length), pad_token_id), suffix_ids], dim=1)
+        stopping_criteria = StoppingCriteriaList([utils.StopSequenceCriteria([stop_str], self.tokenizer, initial_decoder_input_length=input_ids.shape[1])] if stop_str else [])
+        try:
+            output_ids = GenerationMixin.generate(
+                self.model,
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=self.prefix_cache.fork(entry),
+                use_cache=True,
+                do_sample=False,
+                num_beams=1,
+                max_new_tokens=gen_kwargs["max_new_tokens"],
+                stopping_criteria=stopping_criteria,
+                logits_processor=logits_processor,
+            )
+        finally:
+            self.prefix_cache.release(entry)
+        return output_ids[:, input_ids.shape[1] :]
+
     def generate_until(self, requests) -> List[str]:
         res = []
+        if self.batch_size > 1:
+            return self.generate_until_batched(requests)
         pbar = tqdm(total=len(requests), disable=(self.rank != 0), desc="Model Responding")
 
-        for contexts, gen_kwargs, doc_to_visual, doc_id, task, split in [reg.args for reg in requests]:
+        requests_args = [reg.args for reg in requests]
+        visuals_list = [self.resolve_visuals(args) for args in requests_args]
+        # prompts on the same video share everything up to the question; that prefix is prefilled once
+        shared_prefixes = self.shared_prefixes(requests_args, visuals_list) if self.prefix_cache is not None else {}
+        # decode and preprocess the next requests' videos on worker threads while the GPU generates
+        prefetched = prefetch_map(self.load_videos, visuals_list, depth=self.prefetch_depth, num_workers=self.prefetch_workers)
+        for (contexts, gen_kwargs, doc_to_visual, doc_id, task, split), (visuals, videos, error) in zip(requests_args, prefetched):
             # encode, pad, and truncate contexts for this batch
-            visuals = [doc_to_visual(self.task_dict[task][split][doc_id])]
-            if visuals != [None]:
-                visuals = self.flatten(visuals)
-                videos = []
-                try:
-                    for visual in visuals:
-                        if self.video_decode_backend == "decord":
-                            video = self.load_video(visual, self.max_frames_num)
-                        elif self.video_decode_backend == "pyav":
-                            video = read_video_pyav(visual, num_frm=self.max_frames_num)
-                        # video = self.load_video(visual, self.max_frames_num)
-                        video = self._image_processor.preprocess(video, return_tensors="pt")["pixel_values"].half().cuda()
-                        videos.append(video)
-                except Exception as e:
-                    eval_logger.info(f"{e}")
+            if visuals is not None:
+                if error is not None:
+                    eval_logger.info(f"{error}")
                     eval_logger.info(f"Video {visuals} can not load, check the source")
                     video_path = "\n".join(visuals)
                     res.append(f"Video {video_path} can not load, check the source")
                     pbar.update(1)
                     continue
-
-                qs = contexts
-                if self.model.config.mm_use_im_start_end:
-                    qs = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + "\n" + qs
-                else:
-                    qs = DEFAULT_IMAGE_TOKEN * len(videos) + "\n" + qs
+                videos = [video.cuda() for video in videos]
             else:
                 videos = None
-                qs = contexts
 
-            # This is much safer for llama3, as we now have some object type in it
-            if "llama_3" in self.conv_template:
-                conv = copy.deepcopy(conv_templates[self.conv_template])
-            else:
-                conv = conv_templates[self.conv_template].copy()
-
-            conv.append_message(conv.roles[0], qs)
-            conv.append_message(conv.roles[1], None)
-            prompt = conv.get_prompt()
+            prompt, stop_str = self.build_prompt(contexts, len(videos) if videos is not None else 0)
 
             input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).cuda()
             pad_token_ids = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
@@ -407,9 +458,8 @@ class Vlm3r(lmms):
                 pad_token_ids = 0  # lmms-lab/llama3-llava-8b is trained on this pad token id. You may need to customize this for other models.
             attention_masks = input_ids.ne(pad_token_ids).long().cuda()
 
-            stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
-            keywords = [stop_str]
-            stopping_criteria = KeywordsStoppingCriteria(keywords, self.tokenizer, input_ids)
+            # llava's generate runs on inputs_embeds, so the returned ids are only the new tokens
+            stopping_criteria = utils.StopSequenceCriteria([stop_str], self.tokenizer)
 
             cur_prompt = contexts
 
@@ -421,21 +471,42 @@ class Vlm3r(lmms):
                 gen_kwargs["top_p"] = None
             if "num_beams" not in gen_kwargs:
                 gen_kwargs["num_beams"] = 1
-            with torch.inference_mode():
-                output_ids = self.model.generate(
-                    inputs=input_ids,
-                    images=videos,
-                    attention_mask=attention_masks,
-                    modalities=["video" for _ in videos] if videos is not None else None,
-                    use_cache=self.use_cache,
-                    stopping_criteria=[stopping_criteria],
-                    do_sample=True if gen_kwargs["temperature"] > 0 else False,
-                    temperature=gen_kwargs["temperature"],
-                    top_p=gen_kwargs["top_p"],
-                    num_beams=gen_kwargs["num_beams"],
-                    max_new_tokens=gen_kwargs["max_new_tokens"],
-                )
-                # output_ids = model.generate(inputs=input_ids, images=video, attention_mask=attention_masks, modalities="video", do_sample=True, temperature=0.2, use_cache=True, stopping_criteria=[stopping_criteria])
+            options = self.doc_options(task, split, doc_id) if gen_kwargs.get("option_scoring") else None
+            if options:
+                # multiple-choice: one forward pass over the prompt, the answer is the most likely option letter
+                with torch.inference_mode(), self.feature_scope(visuals, videos):
+                    res.append(self.score_options(input_ids, attention_masks, videos, [options])[0])
+                pbar.update(1)
+                continue
+            # open questions are constrained to a single number when numeric_answer is set
+            logits_processor = LogitsProcessorList([self.numeric_logits_processor(stop_str)]) if gen_kwargs.get("numeric_answer") and not self.doc_options(task, split, doc_id) else None
+            prefix_ids = shared_prefixes.get(tuple(visuals)) if visuals is not None else None
+            if prefix_ids is not None and gen_kwargs["temperature"] == 0 and gen_kwargs["num_beams"] == 1 and tuple(input_ids[0, : len(prefix_ids)].tolist()) == prefix_ids:
+                with torch.inference_mode():
+                    prefix_key = (tuple(self.pixel_cache_key(visual) for visual in visuals), prefix_ids)
+                    entry = self.prefix_cache.get(prefix_key)
+                    if entry is None:
+                        with self.feature_scope(visuals, videos):
+                            entry = self.prefill_prefix(input_ids[:, : len(prefix_ids)], videos)
+                        self.prefix_cache.put(prefix_key, entry)
+                    output_ids = self.generate_from_prefix(entry, input_ids[:, len(prefix_ids) :], gen_kwargs, stop_str, logits_processor)
+            else:
+                with torch.inference_mode(), self.feature_scope(visuals, videos):
+                    output_ids = self.model.generate(
+                        inputs=input_ids,
+                        images=videos,
+                        attention_mask=attention_masks,
+                        modalities=["video" for _ in videos] if videos is not None else None,
+                        use_cache=self.use_cache,
+                        stopping_criteria=[stopping_criteria],
+                        do_sample=True if gen_kwargs["temperature"] > 0 else False,
+                        temperature=gen_kwargs["temperature"],
+                        top_p=gen_kwargs["top_p"],
+                        num_beams=gen_kwargs["num_beams"],
+                        max_new_tokens=gen_kwargs["max_new_tokens"],
+                        logits_processor=logits_processor,
+                    )
+                    # output_ids = model.generate(inputs=input_ids, images=video, attention_mask=attention_masks, modalities="video", do_sample=True, temperature=0.2, use_cache=True, stopping_criteria=[stopping_criteria])
 
             outputs = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
             # inputs = self.tokenizer.batch_decode(input_ids % self.tokenizer.vocab_size, skip_special_tokens=True)[0].strip()
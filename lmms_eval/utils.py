@@ -38,6 +38,7 @@ import torch
 import transformers
 from jinja2 import BaseLoader, Environment, StrictUndefined
 from loguru import logger as eval_logger
+from packaging import version
 
 SPACING = " " * 47
 HIGHER_IS_BETTER_SYMBOLS = {
@@ -681,6 +682,65 @@ def create_iterator(raw_iterator, rank, world_size, limit=None):
     return islice(raw_iterator, rank, limit, world_size)
 
 
+def create_grouped_shards(doc_ids, group_keys, world_size, group_costs=None) -> List[List[int]]:
+    """
+    Split `doc_ids` among ranks so that all docs sharing a group key (e.g. a video) land on the
+    same rank, and return the doc ids of every rank. Groups are assigned largest cost first to
+    the least loaded rank (greedy bin-packing), ties going to the lowest rank and to the first
+    group in doc order. A rank's docs keep their original order.
+
+    `group_costs` maps a group key to its estimated cost; the number of docs in the group by default.
+    """
+    groups = collections.OrderedDict()
+    for doc_id, key in zip(doc_ids, group_keys):
+        groups.setdefault(key, []).append(doc_id)
+    costs = {key: (group_costs[key] if group_costs is not None else len(ids)) for key, ids in groups.items()}
+    keys = list(groups)
+    loads = [0.0] * world_size
+    shards = [[] for _ in range(world_size)]
+    for index in sorted(range(len(keys)), key=lambda i: (-costs[keys[i]], i)):
+        target = min(range(world_size), key=lambda r: (loads[r], r))
+        loads[target] += costs[keys[index]]
+        shards[target].extend(groups[keys[index]])
+    return [sorted(shard) for shard in shards]
+
+
+def compute_on_rank0(fn: Callable[[], Any]) -> Any:
+    """
+    Run `fn` on rank 0 only and return its (picklable) result on every rank; a plain call outside
+    torch.distributed. An exception raised by `fn` is still broadcast, so the other ranks fail with
+    a RuntimeError naming it instead of waiting in the broadcast until the distributed timeout.
+    """
+    if not (torch.distributed.is_available() and torch.distributed.is_initialized()) or torch.distributed.get_world_size() == 1:
+        return fn()
+    if torch.distributed.get_rank() == 0:
+        try:
+            payload = [(fn(), None)]
+        except Exception as e:
+            torch.distributed.broadcast_object_list([(None, f"{type(e).__name__}: {e}")], src=0)
+            raise
+    else:
+        payload = [None]
+    torch.distributed.broadcast_object_list(payload, src=0)
+    result, error = payload[0]
+    if error is not None:
+        raise RuntimeError(f"Rank 0 failed: {error}")
+    return result
+
+
+def video_duration(visuals) -> float:
+    """Total duration in seconds of the video files in `visuals` from the probe index, 1 for anything that cannot be probed."""
+    duration = 0.0
+    for visual in visuals:
+        try:
+            from lmms_eval.models.model_utils.video_probe import get_video_probe
+
+            duration += max(get_video_probe(visual)["duration"], 1e-3)
+        except Exception:
+            duration += 1.0
+    return duration or 1.0
+
+
 def pad_and_concat(
     max_length: int,
     tensors: List[torch.Tensor],
@@ -781,6 +841,77 @@ class MultiTokenEOSCriteria(transformers.StoppingCriteria):
         return False not in self.done_tracker
 
 
+@functools.lru_cache(maxsize=None)
+def stop_sequence_token_ids(tokenizer: transformers.PreTrainedTokenizer, sequence: str) -> Optional[Tuple[int, ...]]:
+    """
+    Token ids of a stop sequence, or None when its tokenization is ambiguous. Only a sequence that
+    is a single special or added token (`</s>`, `<|im_end|>`, ...) is always generated as exactly
+    that token; anything else, e.g. "###" or "\\n\\n", may come out of the model split or merged
+    differently. Memoized, so each conv template separator is tokenized once per tokenizer.
+    """
+    ids = tokenizer.encode(sequence, add_special_tokens=False)
+    if len(ids) == 1 and (ids[0] in tokenizer.all_special_ids or sequence in tokenizer.get_added_vocab()):
+        return tuple(ids)
+    return None
+
+
+class StopSequenceCriteria(transformers.StoppingCriteria):
+    """
+    Criteria to stop each sequence of a batch on any of the given stop sequences.
+
+    Stop sequences with an unambiguous tokenization are matched on the token-id suffix of the
+    whole batch at once, without decoding; the others fall back to decoding the last few tokens,
+    like MultiTokenEOSCriteria. Rows are tracked independently: on transformers versions that
+    support it, finished rows are reported per row, otherwise generation stops once all rows are done.
+    """
+
+    per_row = version.parse(transformers.__version__) >= version.parse("4.39.0")
+
+    def __init__(
+        self,
+        stop_sequences: List[str],
+        tokenizer: transformers.PreTrainedTokenizer,
+        initial_decoder_input_length: int = 0,
+        batch_size: int = 1,
+    ) -> None:
+        self.initial_decoder_input_length = initial_decoder_input_length
+        self.done_tracker = [False] * batch_size
+        self.tokenizer = tokenizer
+        self.token_sequences = []
+        self.text_sequences = []
+        for sequence in stop_sequences:
+            ids = stop_sequence_token_ids(tokenizer, sequence)
+            if ids is None:
+                self.text_sequences.append(sequence)
+            else:
+                self.token_sequences.append(torch.tensor(ids, dtype=torch.long))
+        # same 2 extra tokens of lookback as MultiTokenEOSCriteria for the text fallback
+        self.text_lookback = max((len(tokenizer.encode(sequence, add_special_tokens=False)) + 2 for sequence in self.text_sequences), default=0)
+
+    def update(self, input_ids: torch.LongTensor) -> List[bool]:
+        """Update and return the per-row done flags for the current `input_ids`."""
+        generated = input_ids[:, self.initial_decoder_input_length :]
+        done = torch.zeros(generated.shape[0], dtype=torch.bool, device=generated.device)
+        for sequence_ids in self.token_sequences:
+            n = sequence_ids.shape[0]
+            if generated.shape[1] >= n:
+                done |= (generated[:, -n:] == sequence_ids.to(generated.device)).all(dim=1)
+        done = done.tolist()
+        if self.text_sequences and generated.shape[1] > 0:
+            tails = self.tokenizer.batch_decode(generated[:, -self.text_lookback :])
+            done = [d or any(sequence in tail for sequence in self.text_sequences) for d, tail in zip(done, tails)]
+        if len(self.done_tracker) != len(done):
+            self.done_tracker = [False] * len(done)
+        self.done_tracker = [tracked or d for tracked, d in zip(self.done_tracker, done)]
+        return self.done_tracker
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done_tracker = self.update(input_ids)
+        if self.per_row:
+            return torch.tensor(done_tracker, dtype=torch.bool, device=input_ids.device)
+        return False not in done_tracker
+
+
 def stop_sequences_criteria(
     tokenizer: transformers.PreTrainedTokenizer,
     stop_sequences: List[str],
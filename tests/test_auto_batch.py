@@ -0,0 +1,102 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from lmms_eval.models.model_utils.auto_batch import (
+    TokenBudgetBatcher,
+    is_auto_batch_size,
+)
+
+
+class FakeModel:
+    """Answers each request with its own id and runs out of memory above `max_tokens` per batch."""
+
+    def __init__(self, max_tokens, error=torch.cuda.OutOfMemoryError):
+        self.max_tokens = max_tokens
+        self.error = error
+        self.batches = []
+        self.ooms = 0
+
+    def __call__(self, batch):
+        cost = sum(tokens for _, tokens in batch)
+        if cost > self.max_tokens:
+            self.ooms += 1
+            raise self.error(f"CUDA out of memory. Tried to allocate {cost} tokens")
+        self.batches.append(len(batch))
+        return [f"answer {request_id}" for request_id, _ in batch]
+
+
+def cost(request):
+    return request[1]
+
+
+def answer_all(batcher, requests, model):
+    results = []
+    for batch in batcher.batches(requests, cost):
+        results.extend(batcher.run(batch, model, cost))
+    return results
+
+
+REQUESTS = [(i, 100 + 10 * (i % 7)) for i in range(50)]
+EXPECTED = [f"answer {i}" for i in range(50)]
+
+
+def test_no_oom_fills_the_budget():
+    batcher = TokenBudgetBatcher(token_budget=1000, max_batch_size=64)
+    model = FakeModel(max_tokens=1000)
+    assert answer_all(batcher, REQUESTS, model) == EXPECTED
+    assert all(size <= 9 for size in model.batches) and max(model.batches) >= 7
+    assert batcher.token_budget == 1000
+    assert batcher.batch_sizes["generate_until"]
+
+
+@pytest.mark.parametrize("error", [torch.cuda.OutOfMemoryError, RuntimeError], ids=["OutOfMemoryError", "RuntimeError"])
+def test_oom_halves_without_losing_requests(error):
+    batcher = TokenBudgetBatcher(token_budget=4000, max_batch_size=64)
+    model = FakeModel(max_tokens=500, error=error)
+    assert answer_all(batcher, REQUESTS, model) == EXPECTED
+    assert batcher.token_budget <= 4000 // 2
+    assert all(size <= 4 for size in model.batches)
+    assert set(batcher.batch_sizes["generate_until"]) == set(model.batches)
+
+
+def test_batches_formed_before_an_oom_are_split_again():
+    batcher = TokenBudgetBatcher(token_budget=2000, max_batch_size=64)
+    model = FakeModel(max_tokens=700)
+    # formed up front, as when prefetched ahead of the model
+    batches = list(batcher.batches(REQUESTS, cost))
+    results = batcher.run(batches[0], model, cost)
+    ooms = model.ooms
+    assert ooms > 0
+    for batch in batches[1:]:
+        results.extend(batcher.run(batch, model, cost))
+    assert results == EXPECTED
+    # the later batches are split to the lowered budget before they reach the model
+    assert model.ooms == ooms
+
+
+def test_max_batch_size():
+    batcher = TokenBudgetBatcher(token_budget=10**6, max_batch_size=8)
+    model = FakeModel(max_tokens=10**6)
+    assert answer_all(batcher, REQUESTS, model) == EXPECTED
+    assert max(model.batches) == 8
+
+
+def test_other_errors_and_single_request_oom_propagate():
+    batcher = TokenBudgetBatcher(token_budget=1000)
+
+    def broken(batch):
+        raise ValueError("not an OOM")
+
+    with pytest.raises(ValueError):
+        batcher.run(REQUESTS[:4], broken, cost)
+    with pytest.raises(torch.cuda.OutOfMemoryError):
+        batcher.run(REQUESTS[:1], FakeModel(max_tokens=10), cost)
+
+
+def test_batch_size_values():
+    assert is_auto_batch_size("auto")
+    assert not is_auto_batch_size(1)
+    assert not is_auto_batch_size("4")
+    with pytest.raises(ValueError):
+        is_auto_batch_size("auto:4")
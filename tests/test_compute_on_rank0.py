@@ -0,0 +1,52 @@
+import os
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from lmms_eval.utils import compute_on_rank0
+
+pytestmark = pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def worker(rank, world_size, port, fail, results):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+
+        def fn():
+            if fail:
+                raise FileExistsError("video.mp4 does not exist")
+            return [rank, "shards"]
+
+        try:
+            results[rank] = ("ok", compute_on_rank0(fn))
+        except Exception as e:
+            results[rank] = ("error", f"{type(e).__name__}: {e}")
+    finally:
+        dist.destroy_process_group()
+
+
+def run(fail, world_size=3):
+    with mp.Manager() as manager:
+        results = manager.dict()
+        mp.spawn(worker, args=(world_size, free_port(), fail, results), nprocs=world_size)
+        return [results[rank] for rank in range(world_size)]
+
+
+def test_result_of_rank0_on_every_rank():
+    assert run(fail=False) == [("ok", [0, "shards"])] * 3
+
+
+def test_error_on_rank0_fails_every_rank():
+    results = run(fail=True)
+    assert results[0] == ("error", "FileExistsError: video.mp4 does not exist")
+    assert results[1:] == [("error", "RuntimeError: Rank 0 failed: FileExistsError: video.mp4 does not exist")] * 2
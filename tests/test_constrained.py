@@ -0,0 +1,49 @@
+import itertools
+
+import pytest
+import torch
+
+from lmms_eval.models.model_utils.constrained import (
+    COMPLETE_NUMBER_PATTERN,
+    NumericLogitsProcessor,
+)
+
+PIECES = ["0", "1", "42", " 7", " -", "-", ".", ".5", "3.", "-1", "1.2.3", "--", " ", "a", "<|im_end|>", "</s>"]
+VOCAB = {token_id: piece for token_id, piece in enumerate(PIECES) if piece.strip() and set(piece.strip()) <= set("0123456789.-")}
+EOS, STOP = PIECES.index("</s>"), PIECES.index("<|im_end|>")
+
+
+def reference_allowed(generated):
+    """The allowed tokens after `generated`, checking every vocab piece against the generated text."""
+    text = "".join(VOCAB.get(token_id, "") for token_id in generated)
+    allowed = {token_id for token_id, piece in VOCAB.items() if NumericLogitsProcessor._valid(text, piece)}
+    if COMPLETE_NUMBER_PATTERN.fullmatch(text.strip()) or not allowed:
+        allowed |= {EOS, STOP}
+    return allowed
+
+
+def reachable(sequence):
+    return all(token_id in reference_allowed(sequence[:i]) for i, token_id in enumerate(sequence))
+
+
+SEQUENCES = [list(sequence) for length in range(4) for sequence in itertools.product(sorted(VOCAB), repeat=length) if reachable(sequence)]
+
+
+@pytest.mark.parametrize("batch", [SEQUENCES[i : i + 16] for i in range(0, len(SEQUENCES), 16)])
+def test_numeric_masks_match_the_reference(batch):
+    length = max(len(generated) for generated in batch)
+    prompt = torch.full((len(batch), 5), PIECES.index("a"))
+    # pad shorter rows the way finished rows are padded, with a token outside the numeric vocab
+    generated = torch.tensor([generated + [PIECES.index(" ")] * (length - len(generated)) for generated in batch], dtype=torch.long).reshape(len(batch), length)
+    processor = NumericLogitsProcessor(VOCAB, [EOS, STOP])
+    processor(prompt, torch.zeros(len(batch), len(PIECES)))
+    scores = processor(torch.cat([prompt, generated], dim=1), torch.zeros(len(batch), len(PIECES)))
+    for row, sequence in enumerate(batch):
+        assert set(torch.nonzero(scores[row] == 0).flatten().tolist()) == reference_allowed(sequence)
+
+
+def test_numeric_rows_leave_other_rows_untouched():
+    processor = NumericLogitsProcessor(VOCAB, [EOS, STOP], rows=[True, False])
+    scores = processor(torch.zeros((2, 3), dtype=torch.long), torch.zeros(2, len(PIECES)))
+    assert torch.isinf(scores[0]).any()
+    assert not torch.isinf(scores[1]).any()
@@ -0,0 +1,117 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("safetensors")
+
+from lmms_eval.models.model_utils.feature_cache import VisionFeatureCache
+from lmms_eval.models.model_utils.pixel_cache import TensorCache
+
+
+class TinyVisionModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.projector = torch.nn.Linear(12, 8)
+        self.calls = 0
+
+    def encode_images(self, images):
+        self.calls += 1
+        return self.projector(images.flatten(1))
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return TinyVisionModel().eval()
+
+
+def wrap(model, cache):
+    feature_cache = VisionFeatureCache(cache, checkpoint="tiny")
+    feature_cache.wrap(model, ["encode_images"])
+    return feature_cache
+
+
+def test_same_video_is_a_hit(model):
+    feature_cache = wrap(model, TensorCache(max_bytes=1024**2))
+    images = torch.randn(4, 3, 2, 2)
+    with torch.no_grad(), feature_cache.scope("video.mp4"):
+        first = model.encode_images(images)
+    # the next question on the same video
+    with torch.no_grad(), feature_cache.scope("video.mp4"):
+        second = model.encode_images(images)
+    assert model.calls == 1
+    assert (feature_cache.hits, feature_cache.misses) == (1, 1)
+    assert torch.equal(first, second)
+
+
+def test_other_key_or_shape_is_a_miss(model):
+    feature_cache = wrap(model, TensorCache(max_bytes=1024**2))
+    with torch.no_grad():
+        with feature_cache.scope("a.mp4"):
+            model.encode_images(torch.randn(4, 3, 2, 2))
+        with feature_cache.scope("b.mp4"):
+            model.encode_images(torch.randn(4, 3, 2, 2))
+        with feature_cache.scope("a.mp4"):
+            model.encode_images(torch.randn(6, 3, 2, 2))
+    assert model.calls == 3
+    assert (feature_cache.hits, feature_cache.misses) == (0, 3)
+
+
+def test_calls_outside_a_scope_are_not_cached(model):
+    feature_cache = wrap(model, TensorCache(max_bytes=1024**2))
+    images = torch.randn(4, 3, 2, 2)
+    with torch.no_grad():
+        model.encode_images(images)
+        model.encode_images(images)
+    assert model.calls == 2
+    assert (feature_cache.hits, feature_cache.misses) == (0, 0)
+
+
+def test_disk_round_trip(model, tmp_path):
+    images = torch.randn(4, 3, 2, 2)
+    with torch.no_grad(), wrap(model, TensorCache(cache_dir=str(tmp_path))).scope("video.mp4"):
+        first = model.encode_images(images)
+    assert list(tmp_path.glob("*.safetensors"))
+
+    # a new run: fresh model instance and in-memory state, same cache directory
+    reloaded = TinyVisionModel().eval()
+    reloaded.load_state_dict(model.state_dict())
+    feature_cache = wrap(reloaded, TensorCache(cache_dir=str(tmp_path)))
+    with torch.no_grad(), feature_cache.scope("video.mp4"):
+        second = reloaded.encode_images(images)
+    assert reloaded.calls == 0
+    assert feature_cache.hits == 1
+    assert torch.equal(first, second)
+
+
+def test_batched_videos_are_cached_per_video(model):
+    feature_cache = wrap(model, TensorCache(max_bytes=1024**2))
+    a, b, c = torch.randn(4, 3, 2, 2), torch.randn(2, 3, 2, 2), torch.randn(3, 3, 2, 2)
+    with torch.no_grad():
+        with feature_cache.scope(("a.mp4",), [4]):
+            alone = model.encode_images(a)
+        # the same video in another batch, next to a new one and a repeated one
+        with feature_cache.scope(("b.mp4", "a.mp4", "b.mp4"), [2, 4, 2]):
+            batched = model.encode_images(torch.cat([b, a, b]))
+        with feature_cache.scope(("c.mp4", "b.mp4"), [3, 2]):
+            model.encode_images(torch.cat([c, b]))
+    assert model.calls == 3
+    # a, then b (once for both copies), then c
+    assert feature_cache.misses == 3
+    assert torch.allclose(batched[2:6], alone)
+    assert torch.allclose(batched[:2], batched[6:])
+    assert torch.allclose(batched, model.projector(torch.cat([b, a, b]).flatten(1)))
+
+
+def test_per_video_calls_match_their_video(model):
+    feature_cache = wrap(model, TensorCache(max_bytes=1024**2))
+    a, b = torch.randn(4, 3, 2, 2), torch.randn(2, 3, 2, 2)
+    with torch.no_grad():
+        with feature_cache.scope(("b.mp4",), [2]):
+            model.encode_images(b)
+        # one call per video, e.g. pooling
+        with feature_cache.scope(("a.mp4", "b.mp4"), [4, 2]):
+            model.encode_images(a)
+            second = model.encode_images(b)
+    assert model.calls == 2
+    assert feature_cache.hits == 1
+    assert torch.allclose(second, model.projector(b.flatten(1)))
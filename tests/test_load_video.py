@@ -0,0 +1,163 @@
+import os
+from fractions import Fraction
+
+import numpy as np
+import pytest
+import torch
+
+av = pytest.importorskip("av")
+
+from lmms_eval.models.model_utils import video_probe
+from lmms_eval.models.model_utils.llava_video import LlavaVideoMixin
+from lmms_eval.models.model_utils.load_video import (
+    SeekUnreliableError,
+    record_video_length_seek,
+    record_video_length_stream,
+)
+from lmms_eval.models.model_utils.video_probe import get_video_probe, probe_video
+from lmms_eval.models.model_utils.video_source import VideoSource
+
+NUM_FRAMES = 96
+
+
+def synthetic_frame(index, height=48, width=64):
+    """A frame whose content identifies its index: a moving square over a gradient."""
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    frame[..., 0] = np.linspace(0, 255, width, dtype=np.uint8)[None, :]
+    frame[..., 1] = (index * 7) % 256
+    y, x = (index * 3) % (height - 8), (index * 5) % (width - 8)
+    frame[y : y + 8, x : x + 8, 2] = 255
+    return frame
+
+
+def write_video(path, num_frames=NUM_FRAMES, fps=24, gop=12, frame_pts=None):
+    """Write an H.264 mp4; `frame_pts` (in 1/1000 s) gives a variable frame rate."""
+    with av.open(str(path), "w") as container:
+        stream = container.add_stream("libx264", rate=fps)
+        stream.width, stream.height, stream.pix_fmt = 64, 48, "yuv420p"
+        stream.codec_context.gop_size = gop
+        stream.options = {"keyint_min": str(gop), "sc_threshold": "0"}
+        if frame_pts is not None:
+            stream.codec_context.time_base = Fraction(1, 1000)
+        for index in range(num_frames):
+            frame = av.VideoFrame.from_ndarray(synthetic_frame(index), format="rgb24")
+            if frame_pts is not None:
+                frame.pts, frame.time_base = frame_pts[index], Fraction(1, 1000)
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    return str(path)
+
+
+def uniform_with_last(total_frames, num_frames):
+    """The indices read_video_pyav samples: evenly spaced, plus the last frame."""
+    indices = np.linspace(0, total_frames - 1, num_frames, dtype=int)
+    if total_frames - 1 not in indices:
+        indices = np.append(indices, total_frames - 1)
+    return indices
+
+
+def decode(video_path, read_fn, indices, **kwargs):
+    with av.open(video_path) as container:
+        frames = read_fn(container, indices, **kwargs)
+        return [frame.pts for frame in frames], np.stack([frame.to_ndarray(format="rgb24") for frame in frames])
+
+
+INDICES = [
+    uniform_with_last(NUM_FRAMES, 8),
+    uniform_with_last(NUM_FRAMES, 32),
+    np.array([0, 1, 2, 50, 51, 95]),
+    np.array([40]),
+]
+
+
+@pytest.mark.parametrize("gop", [12, 48, 250], ids=["cfr", "cfr_gop48", "sparse_keyframes"])
+@pytest.mark.parametrize("indices", INDICES, ids=["8", "32", "clustered", "single"])
+@pytest.mark.parametrize("use_keyframes", [False, True], ids=["gap_heuristic", "keyframe_table"])
+def test_seek_matches_stream_decode(tmp_path, gop, indices, use_keyframes):
+    video_path = write_video(tmp_path / f"cfr_{gop}.mp4", gop=gop)
+    keyframe_pts = probe_video(video_path)["keyframe_pts"] if use_keyframes else None
+
+    baseline_pts, baseline_pixels = decode(video_path, record_video_length_stream, indices)
+    seek_pts, seek_pixels = decode(video_path, record_video_length_seek, indices, keyframe_pts=keyframe_pts)
+
+    assert len(baseline_pts) == len(np.unique(indices))
+    assert seek_pts == baseline_pts
+    assert np.array_equal(seek_pixels, baseline_pixels)
+
+
+def test_seek_refuses_variable_frame_rate(tmp_path):
+    # irregular frame durations between 20 and 80 ms: frame index no longer maps to pts linearly
+    rng = np.random.default_rng(0)
+    frame_pts = np.concatenate([[0], np.cumsum(rng.integers(20, 80, NUM_FRAMES - 1))]).tolist()
+    video_path = write_video(tmp_path / "vfr.mp4", frame_pts=frame_pts)
+    indices = uniform_with_last(NUM_FRAMES, 16)
+
+    baseline_pts, baseline_pixels = decode(video_path, record_video_length_stream, indices)
+    try:
+        seek_pts, seek_pixels = decode(video_path, record_video_length_seek, indices)
+    except SeekUnreliableError:
+        return
+    # if the seek path accepts the stream, it must still return exactly the baseline frames
+    assert seek_pts == baseline_pts
+    assert np.array_equal(seek_pixels, baseline_pixels)
+
+
+@pytest.mark.parametrize("extension", ["mp4", "mkv"])
+def test_probe_frame_count_matches_the_container(tmp_path, extension):
+    video_path = write_video(tmp_path / f"video.{extension}")
+    probe = probe_video(video_path)
+    with av.open(video_path) as container:
+        stream_frames = container.streams.video[0].frames
+    # mkv headers carry no frame count, the demuxed packets stand in
+    assert probe["frames"] == (stream_frames or NUM_FRAMES)
+    assert probe["packets"] == NUM_FRAMES
+
+
+def test_probe_index_is_shared_outside_the_dataset(tmp_path, monkeypatch):
+    monkeypatch.setattr(video_probe, "PROBE_INDEX_DIR", str(tmp_path / "index"))
+    monkeypatch.setattr(video_probe, "_memory_index", {})
+    dataset_dir = tmp_path / "dataset"
+    dataset_dir.mkdir()
+    video_path = write_video(dataset_dir / "video.mp4")
+    record = get_video_probe(video_path)
+    # nothing is written next to the videos, and other users can read the record
+    assert os.listdir(dataset_dir) == ["video.mp4"]
+    (index_file,) = (tmp_path / "index").iterdir()
+    assert index_file.stat().st_mode & 0o777 == 0o644
+    # a new process reads the record instead of probing again
+    monkeypatch.setattr(video_probe, "_memory_index", {})
+    monkeypatch.setattr(video_probe, "probe_video", None)
+    assert get_video_probe(video_path) == record
+
+
+@pytest.mark.parametrize("extension,first_backend", [("mp4", "pyav-seek"), ("mkv", "pyav-stream"), ("webm", "pyav-stream")])
+def test_pyav_backend_decodes_unseekable_containers_sequentially(extension, first_backend):
+    assert VideoSource("pyav").backends_for(f"video.{extension}")[0] == first_backend
+    assert VideoSource("pyav", fallback=False).backends_for(f"video.{extension}")[-1] == "pyav-stream"
+
+
+class PassthroughProcessor:
+    def preprocess(self, video, return_tensors):
+        return {"pixel_values": torch.from_numpy(np.ascontiguousarray(video))}
+
+
+class ScoringModel(LlavaVideoMixin):
+    def __init__(self, max_frames_num):
+        self.video_source = VideoSource("pyav")
+        self.video_sampling = "uniform_with_last"
+        self.max_frames_num = max_frames_num
+        self._image_processor = PassthroughProcessor()
+        self.pixel_cache = None
+
+
+@pytest.mark.parametrize("num_frames", [1, 8])
+def test_loglikelihood_keeps_uniform_sampling(tmp_path, num_frames):
+    video_path = write_video(tmp_path / "video.mp4")
+    (video,) = ScoringModel(num_frames).load_videos([video_path], scoring=True)
+    # the frames decord's uniform sampling picked before VideoSource, whatever the generation backend
+    indices = np.linspace(0, NUM_FRAMES - 1, num_frames, dtype=int)
+    _, expected = decode(video_path, record_video_length_stream, indices)
+    assert video.shape[0] == num_frames
+    assert np.array_equal(video.numpy(), expected)
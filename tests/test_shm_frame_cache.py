@@ -0,0 +1,76 @@
+import gc
+import os
+
+import numpy as np
+
+from lmms_eval.models.model_utils.shm_frame_cache import (
+    DATA_SUFFIX,
+    LOCK_SUFFIX,
+    SharedFrameCache,
+)
+
+
+def frames(seed, nbytes=1000):
+    return np.random.default_rng(seed).integers(0, 255, size=nbytes, dtype=np.uint8)
+
+
+def files(cache, suffix):
+    return sorted(name for name in os.listdir(cache.cache_dir) if name.endswith(suffix))
+
+
+def test_entries_are_shared_and_mapped(tmp_path):
+    cache = SharedFrameCache(max_bytes=10_000, cache_dir=str(tmp_path / "shm"))
+    cache.get_or_load("a", lambda: frames(0))
+    other = SharedFrameCache(max_bytes=10_000, cache_dir=str(tmp_path / "shm"))
+    second = other.get_or_load("a", lambda: frames(1))
+    np.testing.assert_array_equal(second, frames(0))
+    assert (cache.misses, other.hits) == (1, 1)
+    assert isinstance(second, np.memmap) and not second.flags.writeable
+
+
+def test_eviction_skips_mapped_entries(tmp_path):
+    cache = SharedFrameCache(max_bytes=3_000, cache_dir=str(tmp_path / "shm"))
+    held = cache.get_or_load(0, lambda: frames(0))
+    for i in range(1, 10):
+        cache.get_or_load(i, lambda i=i: frames(i))
+    assert cache.nbytes() <= cache.max_bytes
+    # the mapped entry outlives younger unmapped ones, evicted entries take their lock files with them
+    assert len(files(cache, DATA_SUFFIX)) == 2 and len(files(cache, LOCK_SUFFIX)) == 2
+    assert cache.get(0) is not None and cache.get(8) is None and cache.get(9) is not None
+    np.testing.assert_array_equal(held, frames(0))
+
+    del held
+    gc.collect()
+    cache.get_or_load(10, lambda: frames(10))
+    assert cache.get(0) is None
+
+
+def test_entries_that_do_not_fit_next_to_mapped_ones_are_not_written(tmp_path):
+    cache = SharedFrameCache(max_bytes=3_000, cache_dir=str(tmp_path / "shm"))
+    held = [cache.get_or_load(i, lambda i=i: frames(i)) for i in range(3)]
+    assert isinstance(held[1], np.memmap) and not isinstance(held[2], np.memmap)
+    np.testing.assert_array_equal(held[2], frames(2))
+    assert cache.nbytes() <= cache.max_bytes and cache.get(2) is None
+
+
+def test_stale_locks_are_removed(tmp_path):
+    cache = SharedFrameCache(max_bytes=3_000, cache_dir=str(tmp_path / "shm"))
+    # too large for the budget, so nothing is written next to its lock file
+    cache.get_or_load("large", lambda: frames(0, nbytes=5_000))
+    assert len(files(cache, LOCK_SUFFIX)) == 1
+    cache.get_or_load("small", lambda: frames(1))
+    assert len(files(cache, LOCK_SUFFIX)) == 1 and len(files(cache, DATA_SUFFIX)) == 1
+
+
+def test_last_process_removes_the_cache(tmp_path):
+    cache_dir = str(tmp_path / "shm")
+    cache = SharedFrameCache(max_bytes=10_000, cache_dir=cache_dir)
+    other = SharedFrameCache(max_bytes=10_000, cache_dir=cache_dir)
+    held = cache.get_or_load("a", lambda: frames(0))
+    cache.close()
+    assert other.get("a") is not None
+    other.close()
+    assert not os.path.exists(cache_dir)
+    # mappings stay readable after their files are gone, and the directory comes back on the next use
+    np.testing.assert_array_equal(held, frames(0))
+    assert SharedFrameCache(max_bytes=10_000, cache_dir=cache_dir).get("a") is None
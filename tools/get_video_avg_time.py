@@ -4,6 +4,7 @@ import av
 from av.codec.context import CodecContext
 from tqdm import tqdm
 
+from lmms_eval.models.model_utils.video_probe import get_video_probe
 from lmms_eval.tasks import get_task_dict, include_path, initialize_tasks
 
 tasks = ["worldqa_gen", "activitynetqa", "nextqa_oe_val", "nextqa_oe_test", "videochatgpt_gen", "egoschema"]
@@ -43,15 +44,18 @@ if __name__ == "__main__":
         data_stats[task_name] = 0
         for doc in tqdm(docs, desc=f"Processing {task_name}"):
             video_path = doc_to_visual(doc)
-            container = av.open(video_path[0])
-
-            if "webm" not in video_path[0] and "mkv" not in video_path[0]:
-                try:
-                    video_length = record_video_length_stream(container)  # in seconds
-                except:
+            try:
+                # read from (or build) the persistent probe index, so repeated runs do not touch the container
+                video_length = get_video_probe(video_path[0])["duration"]  # in seconds
+            except Exception:
+                container = av.open(video_path[0])
+                if "webm" not in video_path[0] and "mkv" not in video_path[0]:
+                    try:
+                        video_length = record_video_length_stream(container)  # in seconds
+                    except:
+                        video_length = record_video_length_packet(container)
+                else:
                     video_length = record_video_length_packet(container)
-            else:
-                video_length = record_video_length_packet(container)
 
             data_stats[task_name] += video_length
 
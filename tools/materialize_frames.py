@@ -0,0 +1,86 @@
+"""
+Decode the sampled frames of every video used by a task once and write them to memory-mapped
+uint8 shards, so evaluation runs can read them with `frame_store=<dir>` instead of decoding MP4s.
+
+Example:
+    python tools/materialize_frames.py --tasks vsibench --max_frames_num 32 --sampling uniform_with_last
+
+The store defaults to `$HF_HOME/<dataset_kwargs.cache_dir>_frames/<sampling>_<max_frames_num>`,
+next to the videos of the task. `uniform_with_last` matches the pyav decode path of the models
+(the default `video_decode_backend`), `uniform` matches the decord path.
+"""
+
+import argparse
+import os
+
+from loguru import logger as eval_logger
+from tqdm import tqdm
+
+from lmms_eval.evaluator_utils import get_task_list
+from lmms_eval.models.model_utils.frame_store import SAMPLING_POLICIES, FrameStoreWriter
+from lmms_eval.models.model_utils.prefetch import prefetch_map
+from lmms_eval.models.model_utils.video_source import DEFAULT_SAMPLING, VideoSource
+from lmms_eval.tasks import TaskManager, get_task_dict
+
+# decode with the backend of the model path each sampling policy matches, so the stored pixels are identical
+BACKENDS = {sampling: backend for backend, sampling in DEFAULT_SAMPLING.items()}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=str, required=True, help="Tasks whose videos are materialized. Separate each task with comma")
+    parser.add_argument("--max_frames_num", type=int, default=32, help="Number of frames sampled per video, as passed to the model")
+    parser.add_argument("--sampling", type=str, default="uniform_with_last", choices=SAMPLING_POLICIES, help="Frame sampling policy of the model's decode path")
+    parser.add_argument("--output", type=str, default=None, help="Store directory, defaults to a sibling of the task's HF cache dir")
+    parser.add_argument("--shard_size_gb", type=float, default=4.0, help="Maximum size of one shard file")
+    parser.add_argument("--num_workers", type=int, default=4, help="Number of videos decoded in parallel")
+    parser.add_argument("--include_path", type=str, default=None, help="Additional path to include if there are external tasks")
+    return parser.parse_args()
+
+
+def collect_videos(task):
+    videos = []
+    seen = set()
+    for doc in task.eval_docs:
+        visuals = task.doc_to_visual(doc)
+        for visual in visuals or []:
+            if isinstance(visual, str) and visual not in seen:
+                seen.add(visual)
+                videos.append(visual)
+    return videos
+
+
+def materialize(videos, store_dir, root, args):
+    writer = FrameStoreWriter(store_dir, root=root, max_frames_num=args.max_frames_num, sampling=args.sampling, shard_bytes=int(args.shard_size_gb * 1024**3))
+    videos = [video for video in videos if video not in writer]
+    eval_logger.info(f"Materializing {len(videos)} videos into {store_dir}")
+
+    source = VideoSource(backend=BACKENDS[args.sampling])
+    try:
+        for video, frames, error in tqdm(prefetch_map(lambda path: source.sample(path, args.max_frames_num, args.sampling), videos, depth=2 * args.num_workers, num_workers=args.num_workers), total=len(videos)):
+            if error is not None:
+                eval_logger.warning(f"Could not decode {video}, it will be decoded at evaluation time: {error}")
+                continue
+            writer.add(video, frames)
+    finally:
+        writer.close()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    hf_home = os.path.expanduser(os.getenv("HF_HOME", "~/.cache/huggingface/"))
+    task_manager = TaskManager("INFO", include_path=args.include_path)
+    task_dict = get_task_dict(args.tasks.split(","), task_manager)
+
+    for task_output in get_task_list(task_dict):
+        task = task_output.task
+        if task is None:
+            continue
+        cache_dir = (task.config.dataset_kwargs or {}).get("cache_dir")
+        if cache_dir is None:
+            eval_logger.warning(f"Task {task_output.task_name} has no dataset_kwargs.cache_dir, skipping")
+            continue
+        root = os.path.join(hf_home, cache_dir)
+        store_dir = args.output or os.path.join(hf_home, f"{cache_dir}_frames", f"{args.sampling}_{args.max_frames_num}")
+
+        materialize(collect_videos(task), store_dir, root, args)